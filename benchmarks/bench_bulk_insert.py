@@ -0,0 +1,87 @@
+'''
+Compare adding counts one POST at a time with adding them through POST /api/counts/bulk, through
+the test client of an app created with TestConfig (whose database is used, and whose tables are
+created and dropped, as in the tests). Run from the root of the project:
+
+    python -m benchmarks.bench_bulk_insert --counts 10000 --single 500
+
+Adding counts one at a time is slow, so only --single of them are added that way and the time for
+all of them is extrapolated from the rate.
+'''
+import argparse
+import random
+import time
+
+from bicycles import create_app, db
+from config import TestConfig
+
+# bounding box of the DVRPC region, (south, west, north, east)
+BOUNDS = (39.5, -75.9, 40.6, -74.4)
+
+
+def random_counts(rng, n):
+    south, west, north, east = BOUNDS
+    counts = []
+    for _ in range(n):
+        lat = round(rng.uniform(south, north), 6)
+        lon = round(rng.uniform(west, east), 6)
+        direction = rng.choice(['N', 'E', 'S', 'W'])
+        counts.append({
+            'x': lon, 'y': lat, 'latitude': lat, 'longitude': lon,
+            'objectid': rng.randrange(1, 100000),
+            'setdate': f"2019-{rng.randrange(1, 13):02}-{rng.randrange(1, 29):02}",
+            'mcd': 4210160103,
+            'road': 'market st eastbound lanes',
+            'cntdir': rng.choice(['both', 'east', 'west', 'north', 'south']),
+            'fromlmt': '16th st',
+            'tolmt': '15th st',
+            'type': 'Bicycle 2',
+            'factor': 0,
+            'axle': rng.choice([0, 1, 1.02]),
+            'outdir': direction,
+            'indir': {'N': 'S', 'E': 'W', 'S': 'N', 'W': 'E'}[direction],
+            'aadb': rng.randrange(1300),
+            'co_name': rng.choice(['Bucks', 'Chester', 'Delaware', 'Montgomery', 'Philadelphia']),
+            'mun_name': 'Central',
+            'bikepedgro': 'Mixed',
+        })
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--counts", type=int, default=10000)
+    parser.add_argument("--single", type=int, default=500)
+    args = parser.parse_args()
+
+    app = create_app(config_class=TestConfig)
+    client = app.test_client()
+    counts = random_counts(random.Random(0), args.counts)
+
+    with app.app_context():
+        db.create_all()
+        try:
+            print(f"{db.engine.dialect.name}, {args.counts} counts")
+
+            start = time.perf_counter()
+            for count in counts[:args.single]:
+                response = client.post("/api/counts", json=count)
+                assert response.status_code == 201, response.get_json()
+            elapsed = time.perf_counter() - start
+            rate = args.single / elapsed
+            print(f"{'one POST per count':<24}{rate:10.0f} counts/s   "
+                  f"{args.counts / rate:8.2f}s for all (extrapolated from {args.single})")
+
+            start = time.perf_counter()
+            response = client.post("/api/counts/bulk", json=counts)
+            assert response.status_code == 201, response.get_json()
+            elapsed = time.perf_counter() - start
+            print(f"{'POST /api/counts/bulk':<24}{args.counts / elapsed:10.0f} counts/s   "
+                  f"{elapsed:8.2f}s")
+        finally:
+            db.session.remove()
+            db.drop_all()
+
+
+if __name__ == "__main__":
+    main()
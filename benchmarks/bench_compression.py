@@ -0,0 +1,130 @@
+'''
+Measure the CPU time and the bandwidth saved by compressing responses of the API with gzip and
+brotli (if installed) at each level, on synthetic data (see benchmarks/synthetic.py) loaded as in
+benchmarks/bench_endpoints.py.
+
+    python -m benchmarks.bench_compression --scale 10k [--bandwidth 10 100 1000]
+
+Three bodies are compressed: a page of counts, all counts streamed as newline-delimited JSON
+(compressed chunk by chunk and flushed after each, as the app does) and counts/stats by county,
+facility, year and month. For each level this reports the compressed size, the time to compress
+and decompress, and the time to send the body at each bandwidth, in Mbit/s, including both: the
+level with the lowest time is the best one for clients at that bandwidth. Responses served from
+the response cache have their compressed bodies cached too, so for them only the size counts;
+the endpoint section measures requests for the same cached page, compressed or not.
+'''
+import argparse
+import statistics
+import tempfile
+import time
+import zlib
+
+from bicycles import compression, create_app, db
+from benchmarks.bench_endpoints import load_data, scale
+from config import TestConfig
+
+GZIP_LEVELS = (1, 3, 6, 9)
+BROTLI_LEVELS = (0, 1, 4, 5, 6, 9, 11)
+
+BODIES = {
+    "counts page": "/api/counts?limit=1000",
+    "counts stream": "/api/counts?stream=1",
+    "counts/stats": "/api/counts/stats?group_by=co_name,bikepedfac,setyear,month"
+                    "&metrics=count,avg_aadb,max_aadb",
+}
+
+
+def timed(function, repeat):
+    '''Return the result of function and the median seconds it took over repeat calls.'''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return result, statistics.median(times)
+
+
+def compress_chunks(chunks, encoding, level):
+    compressor = compression.Compressor(encoding, level)
+    return b"".join([compressor.compress(chunk, flush=True) for chunk in chunks]
+                    + [compressor.finish()])
+
+
+def decompress(data, encoding):
+    if encoding == "br":
+        return compression.brotli.decompress(data)
+    return zlib.decompress(data, 31)
+
+
+def bench_body(name, chunks, repeat, bandwidths):
+    size = sum(len(chunk) for chunk in chunks)
+    print(f"\n{name}: {size / 1000:.1f} kB in {len(chunks)} chunk(s)")
+    print(f"{'':<12}{'size kB':>9}{'ratio':>7}{'comp ms':>9}{'MB/s':>8}{'dec ms':>8}"
+          + "".join(f"{f'{b} Mbit/s':>14}" for b in bandwidths))
+
+    def row(label, compressed_size, compress_s, decompress_s):
+        seconds = [compress_s + compressed_size * 8 / (b * 1e6) + decompress_s for b in bandwidths]
+        transfers = "".join(f"{s * 1000:11.1f} ms" for s in seconds)
+        speed = size / compress_s / 1e6 if compress_s else float("inf")
+        print(f"{label:<12}{compressed_size / 1000:9.1f}{size / compressed_size:7.1f}"
+              f"{compress_s * 1000:9.2f}{speed:8.1f}{decompress_s * 1000:8.2f}{transfers}")
+
+    row("identity", size, 0, 0)
+    levels = [("gzip", level) for level in GZIP_LEVELS]
+    if compression.brotli is not None:
+        levels += [("br", level) for level in BROTLI_LEVELS]
+    for encoding, level in levels:
+        compressed, compress_s = timed(lambda: compress_chunks(chunks, encoding, level), repeat)
+        _, decompress_s = timed(lambda: decompress(compressed, encoding), repeat)
+        row(f"{encoding} {level}", len(compressed), compress_s, decompress_s)
+
+
+def bench_endpoint(client, url, requests):
+    print(f"\nGET {url}, cached ({requests} requests)")
+    encodings = ["identity", "gzip"] + (["br"] if compression.brotli is not None else [])
+    for encoding in encodings:
+        headers = {"Accept-Encoding": encoding}
+        client.get(url, headers=headers)  # cache the body, and its compressed one
+        times = []
+        for _ in range(requests):
+            start = time.perf_counter()
+            response = client.get(url, headers=headers)
+            times.append(time.perf_counter() - start)
+        print(f"{encoding:<12}{len(response.data) / 1000:9.1f} kB   "
+              f"median {statistics.median(times) * 1000:7.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--scale", type=scale, default="10k",
+                        help="10k, 100k or 1m, or a number of counts (default 10k)")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="times each body is compressed, reporting the median")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--bandwidth", type=float, nargs="+", default=[10, 100, 1000],
+                        help="client bandwidths, in Mbit/s (default 10 100 1000)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", help="keep generated data here, to reuse it")
+    args = parser.parse_args()
+
+    app = create_app(config_class=TestConfig)
+    client = app.test_client()
+    with app.app_context():
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                load_data(app, args.scale, args.seed, args.data_dir or tmp)
+            if compression.brotli is None:
+                print("brotli isn't installed: gzip only")
+            for name, url in BODIES.items():
+                response = client.get(url)
+                chunks = list(response.response) if "stream" in url else [response.data]
+                bench_body(name, [chunk if isinstance(chunk, bytes) else chunk.encode()
+                                  for chunk in chunks], args.repeat, args.bandwidth)
+            bench_endpoint(client, BODIES["counts page"], args.requests)
+        finally:
+            db.session.remove()
+            db.drop_all()
+
+
+if __name__ == "__main__":
+    main()
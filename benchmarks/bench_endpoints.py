@@ -0,0 +1,363 @@
+'''
+Measure latency percentiles and throughput of every endpoint of the API, reads and writes, on
+synthetic data (see benchmarks/synthetic.py) at a given scale, and write the results as JSON so
+that they can be compared between commits.
+
+Requests are made one at a time through the test client of an app created with TestConfig, whose
+database is used, and whose tables are created and dropped, as in the tests; --database-url
+replaces the database, e.g. with a scratch PostgreSQL (and PostGIS) database. The data is loaded
+with flask load-counts and flask load-weather, and the indexes made with flask indexes create.
+The app's response cache is kept, as in production; with --no-cache it is disabled. Run from the
+root of the project:
+
+    python -m benchmarks.bench_endpoints run --scale 100k --output before.json
+    (change something)
+    python -m benchmarks.bench_endpoints run --scale 100k --output after.json
+    python -m benchmarks.bench_endpoints compare before.json after.json
+
+compare exits with status 1 if the median latency of any endpoint grew by more than --threshold,
+and by more than --min-ms, so that noise in the fastest endpoints isn't reported.
+Writes are measured after all the reads, and each write request changes the data the next ones
+see, as a client's would.
+'''
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from sqlalchemy import text
+
+from bicycles import create_app, db
+from bicycles.api import MAX_PAGE_SIZE, encode_cursor
+from bicycles.commands import indexes_cli, load_counts, load_weather
+from bicycles.validation import ALLOWED_VALUES, FACILITIES
+from benchmarks.bench_spatial import percentiles
+from benchmarks.synthetic import YEARS, CountGenerator, write_weather
+from config import TestConfig
+
+SCALES = {"10k": 10000, "100k": 100000, "1m": 1000000}
+
+
+class Case:
+    '''
+    An endpoint measured with requests from make_request(), a function returning the method, path
+    and JSON body (or None) of a request. Heavy cases, returning many counts, are run with fewer
+    requests.
+    '''
+
+    def __init__(self, name, make_request, expected=(200,), heavy=False, batch=None):
+        self.name = name
+        self.make_request = make_request
+        self.expected = expected
+        self.heavy = heavy
+        self.batch = batch
+
+
+def make_cases(rng, rows, generator, batch_size):
+    '''Return the cases measured on rows counts, reads first.'''
+    lats = [site["latitude"] for site in generator.sites]
+    lons = [site["longitude"] for site in generator.sites]
+    created = []  # recordnums of counts added by POST, deleted by DELETE
+
+    def random_cursor():
+        setdate = datetime.datetime(rng.randint(*YEARS), rng.randint(3, 11), rng.randint(1, 28),
+                                    tzinfo=datetime.timezone.utc)
+        return encode_cursor(setdate, rng.randrange(1, rows + 1))
+
+    def point():
+        return (f"lat={rng.uniform(min(lats), max(lats)):.6f}"
+                f"&lon={rng.uniform(min(lons), max(lons)):.6f}")
+
+    def post():
+        return "POST", "/api/counts", generator.params()
+
+    def delete():
+        return "DELETE", f"/api/counts/{created.pop()}", None
+
+    def patch():
+        recordnums = rng.sample(range(1, rows + 1), batch_size)
+        return "PATCH", "/api/counts", [{"recordnum": recordnum,
+                                         "fields": {"aadb": rng.randrange(1, 1300)}}
+                                        for recordnum in recordnums]
+
+    reads = [
+        Case("GET /api/counts/<recordnum>",
+             lambda: ("GET", f"/api/counts/{rng.randrange(1, rows + 1)}", None)),
+        Case("GET /api/counts?limit=100",
+             lambda: ("GET", "/api/counts?limit=100", None)),
+        Case(f"GET /api/counts?limit={MAX_PAGE_SIZE}",
+             lambda: ("GET", f"/api/counts?limit={MAX_PAGE_SIZE}", None), heavy=True),
+        Case("GET /api/counts?limit=100&after=<cursor>",
+             lambda: ("GET", f"/api/counts?limit=100&after={random_cursor()}", None),
+             expected=(200, 404)),
+        Case("GET /api/counts?bikepedfac=<facility>&limit=100",
+             lambda: ("GET", f"/api/counts?bikepedfac={rng.choice(FACILITIES)}&limit=100", None),
+             expected=(200, 404)),
+        Case("GET /api/counts?prcp=<inches>&limit=100",
+             lambda: ("GET", f"/api/counts?prcp={rng.choice([0.1, 0.5, 1])}&limit=100", None),
+             expected=(200, 404)),
+        Case("GET /api/counts", lambda: ("GET", "/api/counts", None), heavy=True),
+        Case("GET /api/counts?stream=1", lambda: ("GET", "/api/counts?stream=1", None),
+             heavy=True),
+        Case("GET /api/counts/closest?lat&lon",
+             lambda: ("GET", f"/api/counts/closest?{point()}", None)),
+        Case("GET /api/counts/closest?lat&lon&k=20&radius=1000",
+             lambda: ("GET", f"/api/counts/closest?{point()}&k=20&radius=1000", None),
+             expected=(200, 404)),
+        Case("GET /api/facilities", lambda: ("GET", "/api/facilities", None)),
+        Case("GET /api/admin/pool", lambda: ("GET", "/api/admin/pool", None)),
+    ]
+
+    writes = [
+        Case("POST /api/counts", post, expected=(201,)),
+        Case("PUT /api/counts/<recordnum>",
+             lambda: ("PUT", f"/api/counts/{rng.randrange(1, rows + 1)}",
+                      {"aadb": rng.randrange(1, 1300),
+                       "cntdir": rng.choice(ALLOWED_VALUES["cntdir"])})),
+        Case(f"PATCH /api/counts ({batch_size} patches)", patch, batch=batch_size),
+        Case(f"POST /api/counts/bulk ({batch_size} counts)",
+             lambda: ("POST", "/api/counts/bulk",
+                      [generator.params() for _ in range(batch_size)]),
+             expected=(201,), batch=batch_size),
+        Case("DELETE /api/counts/<recordnum>", delete),
+    ]
+    return reads + writes, created
+
+
+def measure(client, case, requests, warmup, created):
+    '''Make warmup and then requests requests of case, and return their statistics.'''
+    times = []
+    statuses = {}
+    size = 0
+    for i in range(warmup + requests):
+        method, path, body = case.make_request()
+        start = time.perf_counter()
+        response = client.open(path, method=method, json=body)
+        data = response.get_data()
+        response.close()
+        elapsed = time.perf_counter() - start
+
+        if case.name == "POST /api/counts" and response.status_code == 201:
+            created.append(int(response.headers["Location"].rsplit("/", 1)[1]))
+        if response.status_code not in case.expected:
+            raise AssertionError(f"{case.name}: {method} {path} returned "
+                                 f"{response.status_code}: {data[:200]!r}")
+        if i < warmup:
+            continue
+        times.append(elapsed)
+        statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+        size += len(data)
+
+    p = percentiles(times)
+    result = {
+        "requests": requests,
+        "mean_ms": sum(times) * 1000 / requests,
+        "p50_ms": p[50],
+        "p90_ms": p[90],
+        "p99_ms": p[99],
+        "max_ms": max(times) * 1000,
+        "requests_per_s": requests / sum(times),
+        "bytes_per_request": size // requests,
+        "statuses": statuses,
+    }
+    if case.batch:
+        result["counts_per_s"] = result["requests_per_s"] * case.batch
+    return result
+
+
+def git_commit():
+    '''Return the current commit and whether the working tree has changes, if in a git repo.'''
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def load_data(app, rows, seed, data_dir):
+    '''
+    Create the tables and load rows synthetic counts and their weather, generated with seed (or
+    reused from data_dir, if generated there before), returning the seconds each load took.
+    '''
+    rng = random.Random(seed)
+    generator = CountGenerator(rng)
+    counts_path = os.path.join(data_dir, f"counts_{rows}_{seed}.csv")
+    weather_path = os.path.join(data_dir, f"weather_{YEARS[0]}_{YEARS[1]}_{seed}.csv")
+    if not os.path.exists(counts_path):
+        generator.write(counts_path, rows)
+    if not os.path.exists(weather_path):
+        write_weather(weather_path, rng)
+
+    db.create_all()
+    postgresql = db.engine.dialect.name == "postgresql"
+    if postgresql:
+        postgis = db.session.execute(text(
+            "SELECT count(*) FROM pg_extension WHERE extname = 'postgis'")).scalar()
+        if not postgis:
+            raise SystemExit("PostgreSQL databases need the postgis extension, as the app does")
+        db.session.execute(text("ALTER TABLE bicycle_count ALTER COLUMN geom "
+                                "TYPE geometry(Point, 4326) USING NULL"))
+        db.session.commit()
+
+    runner = app.test_cli_runner()
+    timings = {}
+    for name, command, arguments in (("load_counts_s", load_counts, [counts_path]),
+                                     ("load_weather_s", load_weather, [weather_path]),
+                                     ("create_indexes_s", indexes_cli, ["create"])):
+        start = time.perf_counter()
+        result = runner.invoke(command, arguments)
+        if result.exit_code != 0:
+            raise SystemExit(f"{command.name} failed:\n{result.output}{result.exception or ''}")
+        timings[name] = time.perf_counter() - start
+    if postgresql:
+        db.session.execute(text("ANALYZE bicycle_count"))
+        db.session.execute(text("ANALYZE weather"))
+        db.session.commit()
+    return generator, timings
+
+
+def run(args):
+    class Config(TestConfig):
+        if args.database_url:
+            SQLALCHEMY_DATABASE_URI = args.database_url
+        if args.no_cache:
+            CACHE_TYPE = "null"
+        ADMIN_TOKEN = "bench"
+
+    rows = args.scale
+    app = create_app(config_class=Config)
+    client = app.test_client()
+    # for /api/admin/pool
+    client.environ_base["HTTP_AUTHORIZATION"] = "Bearer bench"
+    commit, dirty = git_commit()
+
+    with app.app_context():
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                generator, setup = load_data(app, rows, args.seed, args.data_dir or tmp)
+            dialect = db.engine.dialect
+            meta = {
+                "commit": commit,
+                "dirty": dirty,
+                "database": dialect.name,
+                "server_version": ".".join(str(n) for n in dialect.server_version_info or ()),
+                "rows": rows,
+                "seed": args.seed,
+                "requests": args.requests,
+                "cache": not args.no_cache,
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "started": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            }
+            print(f"{dialect.name}, {rows} counts, loaded in {setup['load_counts_s']:.1f}s")
+            print(f"{'endpoint':<52}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'req/s':>9}")
+
+            rng = random.Random(args.seed)
+            cases, created = make_cases(rng, rows, generator, args.batch_size)
+            results = {}
+            for case in cases:
+                requests = max(3, args.requests // 50) if case.heavy else args.requests
+                result = measure(client, case, requests, args.warmup, created)
+                results[case.name] = result
+                print(f"{case.name:<52}{result['p50_ms']:>9.2f}{result['p90_ms']:>9.2f}"
+                      f"{result['p99_ms']:>9.2f}{result['requests_per_s']:>9.0f}")
+        finally:
+            db.session.remove()
+            db.drop_all()
+
+    output = {"meta": meta, "setup": setup, "endpoints": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+        print(f"results written to {args.output}")
+
+
+def compare(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    for name, results in (("base", base), ("new", new)):
+        meta = results["meta"]
+        print(f"{name}: {meta['commit'] or '-'}{' (changed)' if meta['dirty'] else ''}, "
+              f"{meta['database']}, {meta['rows']} counts")
+    if (base["meta"]["database"], base["meta"]["rows"]) != (new["meta"]["database"],
+                                                            new["meta"]["rows"]):
+        print("warning: the results are of different databases or scales")
+
+    print(f"{'endpoint':<52}{'p50 ms':>17}{'change':>9}{'p99 ms':>17}{'change':>9}")
+    regressions = []
+    for name, after in new["endpoints"].items():
+        before = base["endpoints"].get(name)
+        if before is None:
+            print(f"{name:<52}{'new':>17}")
+            continue
+        p50 = after["p50_ms"] / before["p50_ms"] - 1
+        p99 = after["p99_ms"] / before["p99_ms"] - 1
+        flag = ""
+        if p50 > args.threshold and after["p50_ms"] - before["p50_ms"] > args.min_ms:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<52}{before['p50_ms']:>8.2f}{after['p50_ms']:>9.2f}{p50:>+9.0%}"
+              f"{before['p99_ms']:>8.2f}{after['p99_ms']:>9.2f}{p99:>+9.0%}{flag}")
+
+    if regressions:
+        print(f"{len(regressions)} endpoint(s) slower by more than {args.threshold:.0%}")
+        sys.exit(1)
+
+
+def scale(value):
+    '''Parse a scale: 10k, 100k or 1m, or a number of counts.'''
+    if value.lower() in SCALES:
+        return SCALES[value.lower()]
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"scale must be one of {', '.join(SCALES)}, "
+                                         "or a number of counts")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="measure the endpoints")
+    run_parser.add_argument("--scale", type=scale, default="10k",
+                            help="10k, 100k or 1m, or a number of counts (default 10k)")
+    run_parser.add_argument("--requests", type=int, default=200,
+                            help="requests per endpoint; heavy ones get 1/50 of these")
+    run_parser.add_argument("--warmup", type=int, default=5)
+    run_parser.add_argument("--batch-size", type=int, default=100,
+                            help="counts per request to counts/bulk and PATCH counts")
+    run_parser.add_argument("--database-url", help="instead of TestConfig's database")
+    run_parser.add_argument("--no-cache", action="store_true", help="disable the response cache")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--data-dir", help="keep generated data here, to reuse it")
+    run_parser.add_argument("--output", help="file to write the results to, as JSON")
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser("compare", help="compare two results files")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.1,
+                                help="largest growth of median latency allowed (default 0.1)")
+    compare_parser.add_argument("--min-ms", type=float, default=0.25,
+                                help="growth of median latency ignored (default 0.25 ms)")
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
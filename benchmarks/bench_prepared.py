@@ -0,0 +1,122 @@
+'''
+Compare planning and execution time of the API's read statements sent as plain SQL, as psycopg2
+sends them, with the same statements run as prepared statements (see bicycles/statements.py), on
+a scaled-up dataset in PostgreSQL, over a mix of distinct parameters: random recordnums for one
+count, random points in the DVRPC region for closest().
+
+Data is generated server-side into temporary tables named bicycle_count and weather, which take
+precedence over any tables of the same names, so nothing in the target database is changed:
+
+    python -m benchmarks.bench_prepared postgresql://user@host/db --rows 100000
+
+closest() needs PostGIS, and is skipped if the postgis extension isn't installed.
+'''
+import argparse
+import json
+import random
+import time
+
+from sqlalchemy import create_engine, text
+
+from bicycles import api
+from bicycles.statements import PreparedStatement
+from benchmarks.bench_bulk_insert import BOUNDS
+
+SETUP = [
+    '''
+    CREATE TEMP TABLE bicycle_count AS
+    SELECT lon AS x, lat AS y, g AS objectid, g AS recordnum,
+           DATE '2010-01-01' + (random() * 3650)::int + interval '20 hours' AS setdate,
+           2019 AS setyear, '' AS comments, 4210160103 AS mcd, 0 AS route,
+           'walnut st westbound lanes' AS road, 'west' AS cntdir, '36th st' AS fromlmt,
+           '34th st' AS tolmt, 'Bicycle 2' AS type, lat AS latitude, lon AS longitude,
+           0 AS factor, 0.0::float AS axle, 'E' AS outdir, 'W' AS indir,
+           (random() * 1300)::int AS aadb, now() AS updated, 'Philadelphia' AS co_name,
+           'Central' AS mun_name, md5(g::text) AS globalid, 'Project' AS program,
+           'Mixed' AS bikepedgro, 'Bike Lane' AS bikepedfac, {geom} AS geom, NULL::date AS set_date
+    FROM (SELECT g, :west + random() * (:east - :west) AS lon,
+                 :south + random() * (:north - :south) AS lat
+          FROM generate_series(1, :rows) g) points
+    ''',
+    "UPDATE bicycle_count SET set_date = DATE(setdate)",
+    "ALTER TABLE bicycle_count ADD PRIMARY KEY (recordnum)",
+    "CREATE INDEX ON bicycle_count (set_date)",
+    '''
+    CREATE TEMP TABLE weather AS
+    SELECT 'USW00013739'::varchar AS station, d::date AS date, round(random()::numeric, 2)::float
+           AS prcp, 50 AS tavg, 60 AS tmax, 40 AS tmin
+    FROM generate_series(DATE '2010-01-01', DATE '2020-01-01', interval '1 day') d
+    ''',
+    "ALTER TABLE weather ADD PRIMARY KEY (station, date)",
+    "ANALYZE bicycle_count",
+    "ANALYZE weather",
+]
+
+
+def explain(conn, sql, params):
+    plan = conn.execute(text("EXPLAIN (ANALYZE, FORMAT JSON) " + sql), params).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]["Planning Time"], plan[0]["Execution Time"]
+
+
+def measure(conn, statement, param_sets, warmup=10):
+    '''
+    Return mean planning and execution time (from EXPLAIN ANALYZE) and mean wall time, in ms, of
+    running statement, a text() construct, with each of param_sets, after warmup runs (prepared
+    statements switch to a generic plan after five).
+    '''
+    for params in param_sets[:warmup]:
+        conn.execute(statement, params).fetchall()
+    times = [explain(conn, statement.text, params) for params in param_sets]
+    start = time.perf_counter()
+    for params in param_sets:
+        conn.execute(statement, params).fetchall()
+    wall = (time.perf_counter() - start) * 1000 / len(param_sets)
+    return (sum(p for p, _ in times) / len(times), sum(e for _, e in times) / len(times), wall)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("database_url")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    south, west, north, east = BOUNDS
+    engine = create_engine(args.database_url)
+    with engine.connect() as conn:
+        postgis = conn.execute(text(
+            "SELECT count(*) FROM pg_extension WHERE extname = 'postgis'")).scalar()
+        geom = "ST_SetSRID(ST_MakePoint(lon, lat), 4326)" if postgis else "NULL::text"
+        for statement in SETUP:
+            conn.execute(text(statement.format(geom=geom)),
+                         {"rows": args.rows, "south": south, "west": west, "north": north,
+                          "east": east})
+        if postgis:
+            conn.execute(text("CREATE INDEX ON bicycle_count USING gist (geom)"))
+
+        station = "USW00013739"
+        cases = [("count", api.count_statement(),
+                  [{"record_num": rng.randrange(1, args.rows + 1), "weather_station": station}
+                   for _ in range(args.requests)])]
+        if postgis:
+            cases.append(("closest k=5", api.closest_statement(5, False),
+                          [{"lon": rng.uniform(west, east), "lat": rng.uniform(south, north),
+                            "weather_station": station} for _ in range(args.requests)]))
+        else:
+            print("postgis is not installed; skipping closest()")
+
+        print(f"{args.rows} counts, {args.requests} distinct parameter sets, mean ms per request")
+        print(f"{'statement':<14}{'sent as':<10}{'planning':>10}{'execution':>11}{'wall':>9}")
+        for name, statement, param_sets in cases:
+            prepared = PreparedStatement(statement, conn.dialect)
+            conn.connection.cursor().execute(prepared.prepare)
+            for mode, executed in (("plain", statement), ("prepared", prepared.execute)):
+                planning, execution, wall = measure(conn, executed, param_sets)
+                print(f"{name:<14}{mode:<10}{planning:>10.3f}{execution:>11.3f}{wall:>9.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+'''
+Micro-benchmark of result serialization: the previous path, a dict per row encoded by json.dumps()
+with a fallback encoder for Decimal and datetime values, against the compiled RowSerializer.
+
+Both are run on the same typed result rows of bicycle_count joined to weather, built in an
+in-memory SQLite database. Run from the root of the project (config must be importable):
+
+    python -m benchmarks.bench_serializer --rows 100000
+'''
+import argparse
+import datetime
+import decimal
+import json
+import random
+import time
+
+from sqlalchemy import create_engine, func, select
+
+from bicycles.models import BicycleCount, Weather
+from bicycles.serializers import serializer_for
+
+
+def alchemyencoder(obj):
+    """JSON encoder function for SQLAlchemy special classes."""
+    if isinstance(obj, datetime.date):
+        return obj.isoformat()
+    elif isinstance(obj, decimal.Decimal):
+        return float(obj)
+
+
+def dict_path(rows):
+    return json.dumps([dict(r) for r in rows], default=alchemyencoder)
+
+
+def compiled_path(rows):
+    return serializer_for(rows[0].keys()).rows(rows)
+
+
+def load_rows(n):
+    '''Create n counts and a year of weather in SQLite and return the joined, typed rows.'''
+    engine = create_engine("sqlite://")
+    BicycleCount.__table__.create(engine)
+    Weather.__table__.create(engine)
+
+    rng = random.Random(0)
+    start = datetime.datetime(2018, 1, 1)
+    counts = []
+    for i in range(n):
+        lat = round(rng.uniform(39.8, 40.4), 6)
+        lon = round(rng.uniform(-75.7, -74.6), 6)
+        setdate = start + datetime.timedelta(days=rng.randrange(365))
+        counts.append({
+            "recordnum": i + 1, "x": lon, "y": lat, "latitude": lat, "longitude": lon,
+            "objectid": i, "setdate": setdate, "setyear": 2018, "comments": "",
+            "mcd": 4210160103, "route": 0, "road": "walnut st westbound lanes", "cntdir": "west",
+            "fromlmt": "36th st", "tolmt": "34th st", "type": "Bicycle 2", "factor": 0,
+            "axle": 1.02, "outdir": "E", "indir": "W", "aadb": rng.randrange(1, 1300),
+            "updated": setdate, "co_name": "Philadelphia", "mun_name": "Central",
+            "globalid": "bc0fefb6-cae7-4541-b748-52197ec8d113", "program": "Project",
+            "bikepedgro": "Mixed", "bikepedfac": "Bike Lane",
+            "geom": "0101000020E61000003E05C07806CB52C0F982161230FA4340",
+        })
+    weather = [{"station": "USW00013739", "name": "PHILADELPHIA INTERNATIONAL AIRPORT, PA US",
+                "date": (start + datetime.timedelta(days=d)).date(), "prcp": rng.choice([0, 0.12]),
+                "tavg": 50, "tmax": 60, "tmin": 40} for d in range(365)]
+
+    with engine.begin() as conn:
+        conn.execute(BicycleCount.__table__.insert(), counts)
+        conn.execute(Weather.__table__.insert(), weather)
+
+    b, w = BicycleCount.__table__, Weather.__table__
+    query = select([b, w.c.prcp, w.c.tavg, w.c.tmax, w.c.tmin]).select_from(
+        b.outerjoin(w, func.date(b.c.setdate) == w.c.date))
+    return engine.execute(query).fetchall()
+
+
+def best_of(fn, rows, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(rows)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = load_rows(args.rows)
+    assert json.loads(dict_path(rows)) == json.loads(compiled_path(rows))
+
+    baseline = best_of(dict_path, rows, args.repeat)
+    compiled = best_of(compiled_path, rows, args.repeat)
+
+    print(f"{len(rows)} rows, best of {args.repeat}")
+    print(f"dict + json.dumps(default=alchemyencoder): {baseline:.3f}s "
+          f"({len(rows) / baseline:,.0f} rows/s)")
+    print(f"compiled RowSerializer:                    {compiled:.3f}s "
+          f"({len(rows) / compiled:,.0f} rows/s)")
+    print(f"speedup: {baseline / compiled:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
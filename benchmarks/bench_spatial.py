@@ -0,0 +1,97 @@
+'''
+Benchmark k-nearest queries of the in-process GridIndex and, if a PostGIS database is given, of
+the PostGIS query closest() uses otherwise, on the same random points across the DVRPC region.
+
+    python -m benchmarks.bench_spatial --points 1000000 [--database-url postgresql://...]
+
+PostGIS data is loaded into a temporary table, so nothing in the database is changed.
+'''
+import argparse
+import io
+import random
+import statistics
+import time
+
+from sqlalchemy import create_engine, text
+
+from bicycles.spatial import GridIndex
+
+# bounding box of the DVRPC region, (south, west, north, east)
+BOUNDS = (39.5, -75.9, 40.6, -74.4)
+
+
+def random_points(rng, n):
+    south, west, north, east = BOUNDS
+    return [(i, rng.uniform(south, north), rng.uniform(west, east)) for i in range(n)]
+
+
+def percentiles(times):
+    times = sorted(t * 1000 for t in times)
+    return {p: times[min(int(len(times) * p / 100), len(times) - 1)] for p in (50, 90, 99)}
+
+
+def report(name, times):
+    p = percentiles(times)
+    print(f"{name:<28}mean {statistics.mean(times) * 1000:8.3f} ms   p50 {p[50]:8.3f} ms   "
+          f"p90 {p[90]:8.3f} ms   p99 {p[99]:8.3f} ms")
+
+
+def bench_index(points, queries, k):
+    start = time.perf_counter()
+    index = GridIndex.from_points(points)
+    print(f"GridIndex built in {time.perf_counter() - start:.2f}s "
+          f"(cell size {index.cell_size:.0f} m)")
+
+    times = []
+    for lat, lon in queries:
+        start = time.perf_counter()
+        index.nearest(lat, lon, k)
+        times.append(time.perf_counter() - start)
+    report(f"GridIndex k={k}", times)
+
+
+def bench_postgis(database_url, points, queries, k):
+    engine = create_engine(database_url)
+    with engine.connect() as conn:
+        conn.execute(text("CREATE TEMP TABLE bench_point (recordnum INT PRIMARY KEY, "
+                          "latitude FLOAT, longitude FLOAT, geom geometry(Point, 4326))"))
+        data = io.StringIO("".join(f"{n}\t{lat}\t{lon}\n" for n, lat, lon in points))
+        cursor = conn.connection.cursor()
+        cursor.copy_expert("COPY bench_point (recordnum, latitude, longitude) FROM STDIN", data)
+        conn.execute(text("UPDATE bench_point SET geom = ST_SetSRID(ST_MakePoint(longitude, "
+                          "latitude), 4326)"))
+        conn.execute(text("CREATE INDEX ON bench_point USING gist (geom)"))
+        conn.execute(text("ANALYZE bench_point"))
+
+        query = text("SELECT recordnum, ST_Distance(geom::geography, ST_SetSRID(ST_MakePoint("
+                     ":lon, :lat), 4326)::geography) AS distance FROM bench_point "
+                     "ORDER BY geom <-> ST_SetSRID(ST_MakePoint(:lon, :lat), 4326) LIMIT :k")
+        times = []
+        for lat, lon in queries:
+            start = time.perf_counter()
+            conn.execute(query, {"lat": lat, "lon": lon, "k": k}).fetchall()
+            times.append(time.perf_counter() - start)
+        report(f"PostGIS round trip k={k}", times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--points", type=int, default=1000000)
+    parser.add_argument("--queries", type=int, default=10000)
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument("--database-url")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    points = random_points(rng, args.points)
+    south, west, north, east = BOUNDS
+    queries = [(rng.uniform(south, north), rng.uniform(west, east)) for _ in range(args.queries)]
+
+    print(f"{args.points} points, {args.queries} queries")
+    bench_index(points, queries, args.k)
+    if args.database_url:
+        bench_postgis(args.database_url, points, queries, args.k)
+
+
+if __name__ == "__main__":
+    main()
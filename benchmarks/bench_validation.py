@@ -0,0 +1,50 @@
+'''
+Time checking the parameters of new counts, one at a time with check_new_count() and all at once
+with check_new_counts(), on synthetic records. No app or database is needed. Run from the root of
+the project:
+
+    python -m benchmarks.bench_validation --records 100000
+
+--invalid of the records get a bad value, so that building error messages is timed too.
+'''
+import argparse
+import random
+import time
+
+from bicycles import api
+from benchmarks.bench_bulk_insert import random_counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--records", type=int, default=100000)
+    parser.add_argument("--invalid", type=float, default=0.1)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    records = random_counts(rng, args.records)
+    for record in rng.sample(records, int(args.records * args.invalid)):
+        record[rng.choice(["aadb", "cntdir", "setdate", "latitude"])] = "bad"
+
+    def one_at_a_time():
+        return [api.check_new_count(record) for record in records]
+
+    def batch():
+        return api.check_new_counts(records)
+
+    assert one_at_a_time() == batch()
+
+    print(f"{args.records} records, {args.invalid:.0%} invalid, best of {args.repeat}")
+    for name, check in (("check_new_count()", one_at_a_time), ("check_new_counts()", batch)):
+        elapsed = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            check()
+            elapsed.append(time.perf_counter() - start)
+        best = min(elapsed)
+        print(f"{name:<20}{best:8.3f}s {args.records / best:12.0f} records/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+'''
+Compare query plans of the counts/weather join on DATE(setdate) with the join on the stored,
+indexed set_date column, on a scaled-up dataset in PostgreSQL.
+
+Data is generated server-side into temporary tables, so nothing in the target database is
+changed:
+
+    python -m benchmarks.explain_weather_join postgresql://user@host/db --rows 1000000
+'''
+import argparse
+import json
+
+from sqlalchemy import create_engine, text
+
+SETUP = [
+    '''
+    CREATE TEMP TABLE bench_count (
+        recordnum SERIAL PRIMARY KEY,
+        setdate TIMESTAMP WITH TIME ZONE NOT NULL,
+        set_date DATE,
+        bikepedfac TEXT,
+        aadb INT,
+        road TEXT,
+        comments TEXT
+    )
+    ''',
+    '''
+    INSERT INTO bench_count (setdate, bikepedfac, aadb, road, comments)
+    SELECT DATE '2010-01-01' + (random() * 3650)::int + interval '20 hours',
+           (ARRAY['Multiuse Trail', 'Sidepath', 'Striped Shoulder', 'Bike Lane', 'Mixed Traffic',
+                  'Buffered Bike Lane', 'Sharrow', ''])[1 + (random() * 7)::int],
+           (random() * 1300)::int,
+           'walnut st westbound lanes',
+           repeat('x', (random() * 40)::int)
+    FROM generate_series(1, :rows)
+    ''',
+    "UPDATE bench_count SET set_date = DATE(setdate)",
+    '''
+    CREATE TEMP TABLE bench_weather AS
+    SELECT 'USW00013739'::text AS station, d::date AS date,
+           CASE WHEN random() < 0.7 THEN 0 ELSE round((random() * 2)::numeric, 2) END::float
+               AS prcp,
+           50 AS tavg, 60 AS tmax, 40 AS tmin
+    FROM generate_series(DATE '2010-01-01', DATE '2020-01-01', interval '1 day') d
+    ''',
+    "ALTER TABLE bench_weather ADD PRIMARY KEY (date)",
+    "CREATE INDEX ON bench_count (setdate, recordnum)",
+    "CREATE INDEX ON bench_count (set_date)",
+    "ANALYZE bench_count",
+    "ANALYZE bench_weather",
+]
+
+JOINS = {
+    "DATE(setdate)": "DATE(b.setdate) = w.date",
+    "set_date": "b.set_date = w.date",
+}
+
+QUERIES = {
+    "all counts": "ORDER BY b.setdate, b.recordnum",
+    "prcp >= 1.5": "WHERE w.prcp >= 1.5 ORDER BY b.setdate, b.recordnum",
+    "prcp >= 1.98": "WHERE w.prcp >= 1.98 ORDER BY b.setdate, b.recordnum",
+    "first page": "ORDER BY b.setdate, b.recordnum LIMIT 100",
+}
+
+
+def explain(conn, join, query):
+    sql = ("EXPLAIN (ANALYZE, FORMAT JSON) SELECT b.*, w.prcp, w.tavg, w.tmax, w.tmin "
+           "FROM bench_count b LEFT JOIN bench_weather w ON " + join + " " + query)
+    plan = conn.execute(text(sql)).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]
+
+
+def join_node(plan):
+    '''Return the type of the first join node in a plan.'''
+    nodes = [plan]
+    while nodes:
+        node = nodes.pop(0)
+        if "Join" in node["Node Type"] or node["Node Type"] == "Nested Loop":
+            return node["Node Type"]
+        nodes.extend(node.get("Plans", []))
+    return "-"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("database_url")
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    engine = create_engine(args.database_url)
+    with engine.connect() as conn:
+        for statement in SETUP:
+            conn.execute(text(statement), {"rows": args.rows})
+
+        print(f"{args.rows} counts, best execution time of {args.repeat}")
+        print(f"{'query':<14}{'join on':<16}{'join node':<18}"
+              f"{'planning ms':>12}{'execution ms':>14}")
+        for name, query in QUERIES.items():
+            for join_name, join in JOINS.items():
+                plans = [explain(conn, join, query) for _ in range(args.repeat)]
+                best = min(plans, key=lambda p: p["Execution Time"])
+                print(f"{name:<14}{join_name:<16}{join_node(best['Plan']):<18}"
+                      f"{best['Planning Time']:>12.2f}{best['Execution Time']:>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
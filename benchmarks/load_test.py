@@ -0,0 +1,343 @@
+'''
+Drive the API with concurrent clients making a mix of reads and writes, and report throughput,
+error rate and latency percentiles over time, to see how a deployment behaves under load (lock
+contention, pool exhaustion) and to size its worker processes and connection pools.
+
+Each of --concurrency threads makes one request at a time over a keep-alive HTTP connection,
+choosing each from --mix, as long as --duration lasts. Requests are made to --url, e.g. a
+gunicorn server started with the number of workers being sized:
+
+    python -m benchmarks.load_test --url http://localhost:8000 --concurrency 32 \\
+        --mix counts=40,closest=30,count=20,put=5,post=5
+
+Without --url the app is served in this process by a threaded werkzeug server, on a temporary
+SQLite database (or --database-url) loaded with --scale synthetic counts as by
+benchmarks.bench_endpoints, with any --config values set, e.g. --config DB_POOL_SIZE=2.
+
+The kinds of request in the mix are:
+
+- count: GET /api/counts/<recordnum>
+- counts: GET /api/counts, a page of 100 after a random cursor
+- closest: GET /api/counts/closest near a random count
+- facilities: GET /api/facilities
+- put: PUT /api/counts/<recordnum>, changing aadb
+- post: POST /api/counts
+- patch: PATCH /api/counts, changing aadb of 20 counts
+
+Responses with a status of 500 or more, and requests that fail or time out, are errors. At the end
+the state of the connection pool is fetched from /api/admin/pool (of one worker process, if there
+are several), with the server's ADMIN_TOKEN given with --admin-token; the app served here gets
+one of its own.
+'''
+import argparse
+import datetime
+import http.client
+import json
+import logging
+import os
+import random
+import secrets
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from bicycles.api import encode_cursor
+from benchmarks.bench_endpoints import scale
+from benchmarks.bench_spatial import percentiles
+from benchmarks.synthetic import YEARS, CountGenerator
+
+DEFAULT_MIX = "counts=40,closest=30,count=20,put=5,post=5"
+
+# recordnums of counts sampled to make requests about
+SAMPLE_SIZE = 10000
+
+
+class Workload:
+    '''Requests of each kind of the mix, about a sample of existing counts.'''
+
+    def __init__(self, sample, generator):
+        self.sample = sample  # (recordnum, latitude, longitude)
+        self.generator = generator
+
+    def request(self, kind, rng):
+        '''Return the method, path and JSON body (or None) of a request of kind.'''
+        recordnum, latitude, longitude = rng.choice(self.sample)
+        if kind == "count":
+            return "GET", f"/api/counts/{recordnum}", None
+        if kind == "counts":
+            setdate = datetime.datetime(rng.randint(*YEARS), rng.randint(3, 11),
+                                        rng.randint(1, 28), tzinfo=datetime.timezone.utc)
+            cursor = urllib.parse.quote(encode_cursor(setdate, recordnum))
+            return "GET", f"/api/counts?limit=100&after={cursor}", None
+        if kind == "closest":
+            return "GET", (f"/api/counts/closest?lat={latitude + rng.gauss(0, 0.01):.6f}"
+                           f"&lon={longitude + rng.gauss(0, 0.01):.6f}"), None
+        if kind == "facilities":
+            return "GET", "/api/facilities", None
+        if kind == "put":
+            return "PUT", f"/api/counts/{recordnum}", {"aadb": rng.randrange(1, 1300)}
+        if kind == "post":
+            return "POST", "/api/counts", self.generator.params()
+        if kind == "patch":
+            recordnums = {rng.choice(self.sample)[0] for _ in range(20)}
+            return "PATCH", "/api/counts", [{"recordnum": n,
+                                             "fields": {"aadb": rng.randrange(1, 1300)}}
+                                            for n in recordnums]
+        raise ValueError(f"Unknown kind of request: {kind}")
+
+
+class Client:
+    '''HTTP/1.1 client of one thread, reconnecting whenever the server closes the connection.'''
+
+    def __init__(self, url, timeout):
+        parts = urllib.parse.urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.timeout = timeout
+        self.connection = None
+
+    def request(self, method, path, body=None, headers=None):
+        '''Make a request and return its status and body.'''
+        headers = dict(headers or {})
+        if body is not None:
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(self.host, self.port,
+                                                         timeout=self.timeout)
+        try:
+            self.connection.request(method, path, body, headers)
+            response = self.connection.getresponse()
+            return response.status, response.read()
+        except Exception:
+            self.connection.close()
+            self.connection = None
+            raise
+
+
+def sample_counts(client):
+    '''Return (recordnum, latitude, longitude) of up to SAMPLE_SIZE counts of the server.'''
+    status, body = client.request("GET", f"/api/counts?limit={SAMPLE_SIZE}")
+    if status != 200:
+        raise SystemExit(f"GET /api/counts returned {status}; load some counts first")
+    return [(row["recordnum"], float(row["latitude"]), float(row["longitude"]))
+            for row in json.loads(body)]
+
+
+def parse_mix(value):
+    '''Parse a mix such as counts=40,closest=30 to a list of kinds and one of their weights.'''
+    kinds, weights = [], []
+    for item in value.split(","):
+        kind, _, weight = item.partition("=")
+        if kind not in ("count", "counts", "closest", "facilities", "put", "post", "patch"):
+            raise argparse.ArgumentTypeError(f"unknown kind of request: {kind}")
+        kinds.append(kind)
+        weights.append(float(weight or 1))
+    return kinds, weights
+
+
+class Results:
+    '''Outcome of every request, (end time, kind, seconds, status or None if it failed).'''
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def since(self, index):
+        with self._lock:
+            return self.records[index:], len(self.records)
+
+
+def summarize(records, seconds):
+    '''Return throughput, error rate and latency percentiles of records, made over seconds.'''
+    if not records:
+        return {"requests": 0, "requests_per_s": 0.0, "errors": 0, "error_rate": 0.0}
+    errors = sum(1 for *_, status in records if status is None or status >= 500)
+    p = percentiles([elapsed for _, _, elapsed, _ in records])
+    return {
+        "requests": len(records),
+        "requests_per_s": len(records) / seconds,
+        "errors": errors,
+        "error_rate": errors / len(records),
+        "p50_ms": p[50],
+        "p90_ms": p[90],
+        "p99_ms": p[99],
+        "max_ms": max(elapsed for _, _, elapsed, _ in records) * 1000,
+    }
+
+
+def worker(url, timeout, workload, kinds, weights, seed, stop, results):
+    rng = random.Random(seed)
+    client = Client(url, timeout)
+    while not stop.is_set():
+        kind = rng.choices(kinds, weights)[0]
+        method, path, body = workload.request(kind, rng)
+        start = time.perf_counter()
+        try:
+            status, _ = client.request(method, path, body)
+        except Exception:
+            status = None
+        results.add((time.perf_counter(), kind, time.perf_counter() - start, status))
+
+
+def run(url, args):
+    kinds, weights = args.mix
+    mix = ",".join(f"{kind}={weight:g}" for kind, weight in zip(kinds, weights))
+    rng = random.Random(args.seed)
+    client = Client(url, args.timeout)
+    workload = Workload(sample_counts(client), CountGenerator(rng))
+
+    stop = threading.Event()
+    results = Results()
+    threads = [threading.Thread(target=worker, daemon=True,
+                                args=(url, args.timeout, workload, kinds, weights,
+                                      args.seed + i + 1, stop, results))
+               for i in range(args.concurrency)]
+
+    print(f"{args.concurrency} clients, mix {mix}, {args.duration}s, {url}")
+    print(f"{'time s':>7}{'req/s':>9}{'errors':>8}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}"
+          f"{'max ms':>9}")
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+
+    timeline = []
+    index = 0
+    window_start = start
+    while window_start - start < args.duration:
+        time.sleep(max(0.0, min(window_start + args.interval, start + args.duration)
+                       - time.perf_counter()))
+        now = time.perf_counter()
+        records, index = results.since(index)
+        window = summarize(records, now - window_start)
+        window["time_s"] = now - start
+        timeline.append(window)
+        print(f"{window['time_s']:>7.0f}{window['requests_per_s']:>9.0f}"
+              f"{window['error_rate']:>8.1%}{window.get('p50_ms', 0):>9.1f}"
+              f"{window.get('p90_ms', 0):>9.1f}{window.get('p99_ms', 0):>9.1f}"
+              f"{window.get('max_ms', 0):>9.1f}")
+        window_start = now
+
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    records = [record for record in results.records if record[0] <= start + args.duration]
+    by_kind = {kind: summarize([r for r in records if r[1] == kind], args.duration)
+               for kind in kinds}
+    total = summarize(records, args.duration)
+    print(f"{'kind':<12}{'req/s':>9}{'errors':>8}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}")
+    for kind, summary in list(by_kind.items()) + [("all", total)]:
+        print(f"{kind:<12}{summary['requests_per_s']:>9.1f}{summary['error_rate']:>8.1%}"
+              f"{summary.get('p50_ms', 0):>9.1f}{summary.get('p90_ms', 0):>9.1f}"
+              f"{summary.get('p99_ms', 0):>9.1f}")
+
+    pool = None
+    try:
+        status, body = client.request("GET", "/api/admin/pool",
+                                      headers={"Authorization": f"Bearer {args.admin_token}"})
+        if status == 200:
+            pool = json.loads(body)
+            waits = pool["wait_seconds"]
+            print(f"pool: {pool['pool']}, {waits['count']} checkouts waited "
+                  f"{waits['sum']:.2f}s in all, {pool['timeouts']} timeouts")
+        else:
+            print(f"GET /api/admin/pool returned {status}; give the server's ADMIN_TOKEN with "
+                  f"--admin-token")
+    except Exception as e:
+        print(f"could not fetch /api/admin/pool: {e}")
+
+    return {
+        "meta": {"url": url, "concurrency": args.concurrency, "mix": mix,
+                 "duration_s": args.duration, "elapsed_s": elapsed, "seed": args.seed},
+        "total": total,
+        "by_kind": by_kind,
+        "timeline": timeline,
+        "pool": pool,
+    }
+
+
+def serve(args):
+    '''Serve the app on synthetic data in a background thread; return its URL and a cleanup.'''
+    from werkzeug.serving import make_server
+
+    from bicycles import create_app, db
+    from benchmarks.bench_endpoints import load_data
+    from config import TestConfig
+
+    tmp = tempfile.TemporaryDirectory()
+    overrides = {"SQLALCHEMY_DATABASE_URI": args.database_url
+                 or "sqlite:///" + os.path.join(tmp.name, "bicycles.db"),
+                 "ADMIN_TOKEN": args.admin_token}
+    for item in args.config:
+        name, _, value = item.partition("=")
+        try:
+            overrides[name] = json.loads(value)
+        except ValueError:
+            overrides[name] = value
+    app = create_app(config_class=type("Config", (TestConfig,), overrides))
+
+    with app.app_context():
+        load_data(app, args.scale, args.seed, args.data_dir or tmp.name)
+        db.session.remove()
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)  # not every request
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def cleanup():
+        server.shutdown()
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+        tmp.cleanup()
+
+    return f"http://127.0.0.1:{server.server_port}", cleanup
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--url", help="server to test, instead of serving the app here")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX,
+                        help=f"kinds of request and their weights (default {DEFAULT_MIX})")
+    parser.add_argument("--duration", type=float, default=60, help="seconds (default 60)")
+    parser.add_argument("--interval", type=float, default=5,
+                        help="seconds between reports (default 5)")
+    parser.add_argument("--timeout", type=float, default=30, help="of each request, in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write the results to, as JSON")
+    parser.add_argument("--admin-token", default=secrets.token_urlsafe(),
+                        help="ADMIN_TOKEN of the server, to fetch /api/admin/pool")
+    served = parser.add_argument_group("without --url")
+    served.add_argument("--scale", type=scale, default="10k")
+    served.add_argument("--database-url")
+    served.add_argument("--data-dir", help="keep generated data here, to reuse it")
+    served.add_argument("--config", action="append", default=[], metavar="NAME=VALUE",
+                        help="config value of the app, as JSON or text")
+    args = parser.parse_args()
+
+    cleanup = None
+    url = args.url
+    if url is None:
+        url, cleanup = serve(args)
+    try:
+        results = run(url, args)
+    finally:
+        if cleanup:
+            cleanup()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
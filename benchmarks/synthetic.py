@@ -0,0 +1,157 @@
+'''
+Generate synthetic bicycle counts and weather, at any scale, modeled on the data in data/:
+
+- counts are taken from the sites in data/bicycle_counts.csv (a count's road, limits, direction,
+  municipality, facility, program and so on), moved a little around the site, with the AADB of
+  the site scaled by a random factor, and set on a random day of the counting season (the months
+  and days of the real counts) in any of --years
+- weather for every day of --years is the weather of the same day in
+  data/weather_summaries_2018.csv, with temperatures shifted by a random amount and precipitation
+  drawn from the days of the same month
+
+The files are written in the formats of their models, to be loaded with flask load-counts and
+flask load-weather:
+
+    python -m benchmarks.synthetic --rows 100000 --counts counts.csv --weather weather.csv
+'''
+import argparse
+import calendar
+import csv
+import datetime
+import os
+import random
+import uuid
+
+from bicycles import commands
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+COUNTS_CSV = os.path.join(DATA, "bicycle_counts.csv")
+WEATHER_CSV = os.path.join(DATA, "weather_summaries_2018.csv")
+
+YEARS = (2010, 2019)
+
+# standard deviation of the distance of counts from their site, in degrees (about 1 km)
+SITE_SPREAD = 0.01
+# standard deviation of the log of the factor scaling the AADB of a site
+AADB_SPREAD = 0.35
+# standard deviation of the shift of a day's temperatures, in degrees Fahrenheit
+TEMPERATURE_SPREAD = 4
+
+
+def read_sites(path=COUNTS_CSV):
+    '''
+    Return the header of path and the counts in it that load-counts accepts, as dicts of column
+    values.
+    '''
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.reader(f)
+        header = commands.normalize_header(next(reader))
+        converters = [commands.LOAD_COLUMNS[name] for name in header]
+        sites = []
+        for cells in reader:
+            values, errors = commands.convert_count(header, converters, cells)
+            if not errors:
+                sites.append(values)
+    return header, sites
+
+
+def format_timestamp(value):
+    '''Format a timestamp as in ArcGIS exports, e.g. 2018-03-29T00:00:00.000Z.'''
+    return value.astimezone(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+class CountGenerator:
+    '''Random counts at the sites of data/bicycle_counts.csv.'''
+
+    def __init__(self, rng, years=YEARS, path=COUNTS_CSV):
+        self.rng = rng
+        self.years = years
+        self.header, self.sites = read_sites(path)
+        # days of the counting season, with the frequency they have in the real counts
+        self.days = [(site["setdate"].month, min(site["setdate"].day, 28)) for site in self.sites]
+
+    def count(self, recordnum):
+        '''Return the column values of a count with recordnum, as read_sites() does.'''
+        rng = self.rng
+        values = dict(rng.choice(self.sites))
+        latitude = round(values["latitude"] + rng.gauss(0, SITE_SPREAD), 6)
+        longitude = round(values["longitude"] + rng.gauss(0, SITE_SPREAD), 6)
+        month, day = rng.choice(self.days)
+        setdate = datetime.datetime(rng.randint(*self.years), month, day,
+                                    tzinfo=datetime.timezone.utc)
+        values.update(
+            recordnum=recordnum, objectid=recordnum,
+            x=longitude, y=latitude, latitude=latitude, longitude=longitude,
+            aadb=max(1, round(values["aadb"] * rng.lognormvariate(0, AADB_SPREAD))),
+            setdate=setdate, setyear=setdate.year, set_date=setdate.date(),
+            updated=setdate + datetime.timedelta(days=rng.randint(7, 60)),
+            globalid=str(uuid.UUID(int=rng.getrandbits(128), version=4)))
+        return values
+
+    def params(self):
+        '''Return the parameters of a new count for POST /api/counts.'''
+        values = self.count(None)
+        params = {name: values[name] for name in self.header
+                  if values[name] is not None
+                  and name not in ("recordnum", "setyear", "updated", "globalid")}
+        params["objectid"] = self.rng.randrange(1, 1000000)
+        params["setdate"] = values["setdate"].strftime("%Y-%m-%d")
+        return params
+
+    def write(self, path, rows):
+        '''Write rows counts, with recordnums from 1, to path in the format of the real counts.'''
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow([name.upper() for name in self.header])
+            for recordnum in range(1, rows + 1):
+                values = self.count(recordnum)
+                values["setdate"] = format_timestamp(values["setdate"])
+                values["updated"] = format_timestamp(values["updated"])
+                writer.writerow(["" if values[name] is None else values[name]
+                                 for name in self.header])
+
+
+def write_weather(path, rng, years=YEARS, source=WEATHER_CSV):
+    '''Write daily summaries of every day of years to path, in the format of NOAA's CSVs.'''
+    with open(source, newline="", encoding="utf-8-sig") as f:
+        reader = csv.DictReader(f)
+        days = {}
+        for row in reader:
+            date = datetime.date.fromisoformat(row["DATE"])
+            days[date.month, date.day] = row
+    precipitation = {}
+    for (month, _), row in days.items():
+        precipitation.setdefault(month, []).append(row["PRCP"])
+
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["STATION", "NAME", "DATE", "PRCP", "TAVG", "TMAX", "TMIN"])
+        for year in range(years[0], years[1] + 1):
+            for month in range(1, 13):
+                for day in range(1, calendar.monthrange(year, month)[1] + 1):
+                    row = days[month, min(day, 28) if month == 2 else day]
+                    shift = round(rng.gauss(0, TEMPERATURE_SPREAD))
+                    temperatures = [int(row[name]) + shift for name in ("TAVG", "TMAX", "TMIN")]
+                    writer.writerow([row["STATION"], row["NAME"],
+                                     datetime.date(year, month, day).isoformat(),
+                                     rng.choice(precipitation[month])] + temperatures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--counts", default="counts.csv", help="file to write counts to")
+    parser.add_argument("--weather", default="weather.csv", help="file to write weather to")
+    parser.add_argument("--years", type=int, nargs=2, default=YEARS, metavar=("FIRST", "LAST"))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    CountGenerator(rng, tuple(args.years)).write(args.counts, args.rows)
+    write_weather(args.weather, rng, tuple(args.years))
+    print(f"wrote {args.rows} counts to {args.counts} and weather for {args.years[0]}-"
+          f"{args.years[1]} to {args.weather}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,14 +2,42 @@ from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 
 from config import ProductionConfig
+from .caching import ResponseCache
+from .compression import ResponseCompression
+from .metrics import RequestMetrics
+from .pool import PoolMetrics
+from .statements import PreparedStatements
+from .spatial import SpatialIndex
+from .timing import RequestTiming
 
 db = SQLAlchemy()
+cache = ResponseCache()
+spatial_index = SpatialIndex()
+prepared = PreparedStatements()
+pool_metrics = PoolMetrics()
+request_timing = RequestTiming()
+request_metrics = RequestMetrics()
+response_compression = ResponseCompression()
 
 
 def create_app(config_class=ProductionConfig):
     app = Flask(__name__)
     app.config.from_object(config_class)
+    # station whose weather is joined to counts (Philadelphia International Airport)
+    app.config.setdefault("WEATHER_STATION", "USW00013739")
+    # keep the rollups of counts/stats up to date, and answer it from them, once count_rollup has
+    # been created and filled (see rollups.py)
+    app.config.setdefault("ROLLUPS", False)
+    # token that /api/admin/pool requires, disabled while None (see auth.py)
+    app.config.setdefault("ADMIN_TOKEN", None)
+    pool_metrics.init_app(app)
     db.init_app(app)
+    cache.init_app(app)
+    spatial_index.init_app(app)
+    prepared.init_app(app)
+    request_timing.init_app(app)
+    request_metrics.init_app(app)
+    response_compression.init_app(app)
 
     # import blueprints
     from .main import main_bp
@@ -21,4 +49,12 @@ def create_app(config_class=ProductionConfig):
     app.register_blueprint(api_bp, url_prefix="/api")
     app.register_blueprint(doc_bp, url_prefix="/api/documentation")
 
+    # register cli commands
+    from .commands import indexes_cli, load_counts, load_weather, rollups_cli
+
+    app.cli.add_command(indexes_cli)
+    app.cli.add_command(rollups_cli)
+    app.cli.add_command(load_counts)
+    app.cli.add_command(load_weather)
+
     return app
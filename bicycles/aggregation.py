@@ -0,0 +1,142 @@
+'''
+Statistics of the AADB of counts, grouped by dimensions of the counts and of their weather,
+computed by the database with GROUP BY so that only one row per group is sent back.
+
+Percentiles are nearest-rank percentiles (the least value with at least p percent of the values
+at or below it), which is PostgreSQL's percentile_disc(). Other databases, which don't have it,
+rank the values of each group with window functions (SQLite 3.25 and MySQL 8 or later).
+'''
+import decimal
+import functools
+import re
+
+from sqlalchemy import text
+
+# dimensions counts can be grouped by: name -> (expression, or expression by dialect, whether the
+# weather is needed)
+DIMENSIONS = {
+    'co_name': ("b.co_name", False),
+    'mun_name': ("b.mun_name", False),
+    'bikepedfac': ("b.bikepedfac", False),
+    'setyear': ("b.setyear", False),
+    'month': ({'postgresql': "EXTRACT(MONTH FROM b.set_date)",
+               'mysql': "MONTH(b.set_date)",
+               'sqlite': "CAST(strftime('%m', b.set_date) AS INTEGER)"}, False),
+    'prcp_bin': (None, True),  # built from PRCP_BINS
+}
+
+# lower bounds of the precipitation bins, in inches: a count's prcp_bin is the greatest bound
+# that isn't above the precipitation of its day (and null if there is no weather for the day)
+PRCP_BINS = (0, 0.01, 0.1, 0.5, 1)
+
+# dimensions whose values are integers, which some databases return as decimals
+INTEGER_DIMENSIONS = ('setyear', 'month')
+
+# metrics of aadb other than percentiles (pNN_aadb)
+METRICS = {
+    'count': "COUNT(*)",
+    'sum_aadb': "SUM(aadb)",
+    'avg_aadb': "AVG(aadb)",
+    'min_aadb': "MIN(aadb)",
+    'max_aadb': "MAX(aadb)",
+}
+PERCENTILE = re.compile(r"p([1-9][0-9]?)_aadb")
+
+DEFAULT_METRICS = ('count', 'avg_aadb')
+
+
+def prcp_bin_expression():
+    cases = " ".join(f"WHEN w.prcp >= {bound} THEN {bound}" for bound in reversed(PRCP_BINS[1:]))
+    return f"CASE WHEN w.prcp IS NULL THEN NULL {cases} ELSE {PRCP_BINS[0]} END"
+
+
+def parse_list(value, default=()):
+    '''Split a comma-separated query string parameter, without empty items or duplicates.'''
+    if not value:
+        return tuple(default)
+    return tuple(dict.fromkeys(item.strip() for item in value.split(",") if item.strip()))
+
+
+def check_group_by(group_by):
+    '''Return an error message if any of group_by isn't a dimension, or None.'''
+    unknown = [name for name in group_by if name not in DIMENSIONS]
+    if unknown:
+        return (f"Unknown dimension(s): {', '.join(unknown)}. group_by must be one or more of "
+                + ", ".join(DIMENSIONS))
+
+
+def check_metrics(metrics):
+    '''Return an error message if any of metrics isn't a metric, or None.'''
+    if not metrics:
+        return "metrics must not be empty."
+    unknown = [name for name in metrics if name not in METRICS and not PERCENTILE.fullmatch(name)]
+    if unknown:
+        return (f"Unknown metric(s): {', '.join(unknown)}. metrics must be one or more of "
+                + ", ".join(METRICS) + ", or pNN_aadb for the NNth percentile (1-99)")
+
+
+@functools.lru_cache(maxsize=256)
+def stats_statement(group_by, metrics, dialect):
+    '''
+    Return the statement computing metrics of the counts in each group of the dimensions
+    group_by, ordered by group, for a database of dialect. Bind with_station() parameters if
+    any dimension needs the weather.
+    '''
+    expressions = []
+    weather = False
+    for name in group_by:
+        expression, needs_weather = DIMENSIONS[name]
+        if name == 'prcp_bin':
+            expression = prcp_bin_expression()
+        elif isinstance(expression, dict):
+            expression = expression[dialect]
+        expressions.append(expression)
+        weather = weather or needs_weather
+
+    percentiles = {name: int(PERCENTILE.fullmatch(name).group(1))
+                   for name in metrics if name not in METRICS}
+    ranked = percentiles and dialect != 'postgresql'
+
+    inner = [f"{expression} AS {name}" for expression, name in zip(expressions, group_by)]
+    inner.append("b.aadb AS aadb")
+    if ranked:
+        # rank the (non-null) values of each group, for the nearest-rank percentiles
+        partition = ", ".join(expressions)
+        partition_nulls = ", ".join(expressions + ["b.aadb IS NULL"])
+        inner.append(f"ROW_NUMBER() OVER (PARTITION BY {partition_nulls} ORDER BY b.aadb) "
+                     "AS aadb_rank")
+        inner.append(f"COUNT(b.aadb) OVER ({'PARTITION BY ' + partition if partition else ''}) "
+                     "AS aadb_n")
+
+    outer = list(group_by)
+    for name in metrics:
+        if name in METRICS:
+            outer.append(f"{METRICS[name]} AS {name}")
+        elif ranked:
+            # the least value ranked at or above the percentile, in integers to be exact
+            outer.append(f"MIN(CASE WHEN aadb IS NOT NULL AND aadb_rank * 100 >= "
+                         f"{percentiles[name]} * aadb_n THEN aadb END) AS {name}")
+        else:
+            outer.append(f"percentile_disc({percentiles[name] / 100}) WITHIN GROUP "
+                         f"(ORDER BY aadb) AS {name}")
+
+    sql = f"SELECT {', '.join(inner)} FROM bicycle_count b"
+    if weather:
+        sql += " LEFT JOIN weather w ON b.set_date = w.date AND w.station = :weather_station"
+    sql = f"SELECT {', '.join(outer)} FROM ({sql}) s"
+    if group_by:
+        positions = ", ".join(str(position) for position in range(1, len(group_by) + 1))
+        sql += f" GROUP BY {positions} ORDER BY {positions}"
+    return text(sql), weather
+
+
+def group_values(row):
+    '''Return the JSON-serializable values of a row of the statement of stats_statement().'''
+    values = {}
+    for name, value in row.items():
+        if isinstance(value, decimal.Decimal):
+            value = float(value)
+        if name in INTEGER_DIMENSIONS and value is not None:
+            value = int(value)
+        values[name] = value
+    return values
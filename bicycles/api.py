@@ -1,62 +1,44 @@
+import base64
+import binascii
+import functools
+import hashlib
 import json
 import datetime
-import decimal
 import uuid
+from urllib.parse import urlencode
 
-from flask import request, Blueprint, Response, jsonify, make_response, url_for
-from sqlalchemy import text
+from flask import (request, Blueprint, Response, current_app, jsonify, make_response,
+                   stream_with_context, url_for)
+from sqlalchemy import bindparam, func, select, text
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
-from sqlalchemy.inspection import inspect
 from werkzeug.exceptions import BadRequest
 
-from bicycles import db
+from bicycles import db, cache, pool_metrics, prepared, response_compression, spatial_index
+from . import compression, rollups
+from .aggregation import (DEFAULT_METRICS, check_group_by, check_metrics, group_values,
+                          parse_list, stats_statement)
+from .auth import token_required
+from .metrics import count_rows
 from .models import BicycleCount
+from .serializers import serializer_for
+from .timing import phase
+from .validation import FACILITIES, CountValidator, parse_setdate
 
 api_bp = Blueprint("api", __name__)  # url prefix of /api set in init
+api_bp.after_request(response_compression.compress_response)
 
 
-def alchemyencoder(obj):
-    """JSON encoder function for SQLAlchemy special classes."""
-    if isinstance(obj, datetime.date):
-        return obj.isoformat()
-    elif isinstance(obj, decimal.Decimal):
-        return float(obj)
+# compiled once from the model, rather than on every call
+count_validator = CountValidator(BicycleCount.__table__)
+
+# facility types counts can be filtered by, which are also the only ones they can be given
+FACILITY_SET = frozenset(FACILITIES)
 
 
 def check_required_fields(params):
     '''When creating a new count, check params submitted against required fields.'''
-
-    # required fields for creating new count
-    required_fields = [
-        'x',
-        'y',
-        'objectid',
-        'setdate',
-        'mcd',
-        'road',
-        'cntdir',
-        'fromlmt',
-        'tolmt',
-        'type',
-        'latitude',
-        'longitude',
-        'factor',
-        'axle',
-        'outdir',
-        'indir',
-        'aadb',
-        'co_name',
-        'mun_name',
-        'bikepedgro',
-    ]
-
-    missing_params = []
-
-    for field in required_fields:
-        if field not in params.keys():
-            missing_params.append(field)
-
-    return missing_params
+    return count_validator.missing(params)
 
 
 def check_params(params):
@@ -64,83 +46,609 @@ def check_params(params):
     Check user-submitted parameters, in PUT and POST requests, against allowed parameters,
     type of parameters, and allowed content of parameters.
     '''
-    # get field names from db, to check for unknown parameters submitted
-    table = inspect(BicycleCount)
-    field_names = [field.name for field in table.c]
-
-    unknown_params = []
-    bad_params = []
-
-    type_int = ['objectid', 'mcd', 'route', 'factor', 'aadb']
-    type_float = ['x', 'y', 'latitude', 'longitude']
-    type_string = [
-        'road',
-        'fromlmt',
-        'tolmt',
-        'type',
-        'mun_name',
-        'program',
-        'bikepedgro',
-        'bikepedfac',
-    ]
-    cnt_dir = ['both', 'east', 'west', 'north', 'south']
-    axle = [0, 1, 1.02]
-    in_out_dir = ['E', 'W', 'N', 'S']
-    counties = [
-        'Bucks',
-        'Chester',
-        'Delaware',
-        'Montgomery',
-        'Philadelphia',
-        'Burlington',
-        'Camden',
-        'Gloucester',
-        'Mercer',
-    ]
-
-    # check for unknown parameters and parameter type/content
-    for k, v in params.items():
-        if k not in field_names:
-            unknown_params.append(k)
-
-        # check types
-        if k in type_int and type(v) is not int:
-            bad_params.append(k + " must be an integer")
-        if k in type_float and type(v) is not float:
-            bad_params.append(k + " must be a float")
-        if k in type_string and type(v) is not str:
-            bad_params.append(k + " must be text")
-
-        # check values
-        if k == 'cntdir' and v not in cnt_dir:
-            bad_params.append(k + " must be one of " + ", ".join(cnt_dir))
-        if k == 'axle' and v not in axle:
-            bad_params.append(k + " must be one of " + ", ".join(str(n) for n in axle))
-        if k in ['indir', 'outdir'] and v not in in_out_dir:
-            bad_params.append(k + " must be one of " + ", ".join(in_out_dir))
-        if k == 'co_name' and v not in counties:
-            bad_params.append(k + " must be one of " + ", ".join(counties))
-
-        # check SETDate
-        # since all values in sample had no time values, just require date in format YYYY-MM-DD,
-        # and then convert to datetime when inserting/updating
-        if k == 'setdate':
+    return count_validator.check(params)
+
+
+def count_errors(missing_params, unknown_params, bad_params):
+    '''Return the messages for the errors found in the parameters of a count.'''
+    errors = []
+    if missing_params:
+        errors.append("Missing required parameters: " + ", ".join(missing_params))
+    if unknown_params:
+        errors.append("Unknown parameter(s) submitted: " + ", ".join(unknown_params))
+    if bad_params:
+        errors.append("Error(s) in submitted parameters: " + "; ".join(bad_params))
+    return errors
+
+
+def check_new_count(params):
+    '''
+    Return the errors in the parameters of a new count, with the messages a POST to counts()
+    would respond with, or an empty list if there are none.
+    '''
+    return check_new_counts([params])[0]
+
+
+def check_new_counts(records):
+    '''
+    Return the errors in the parameters of each of a list of new counts, as check_new_count()
+    does, checking them all in one pass.
+    '''
+    errors = [None] * len(records)
+    checked = []
+    for index, params in enumerate(records):
+        if not isinstance(params, dict):
+            errors[index] = ["Count must be a JSON object."]
+        elif not params:
+            errors[index] = ["No parameters submitted."]
+        else:
+            checked.append(index)
+
+    results = count_validator.check_many([records[index] for index in checked])
+    for index, result in zip(checked, results):
+        errors[index] = count_errors(*result)
+    return errors
+
+
+def new_count_values(params):
+    '''
+    Return the column values of a new count from its checked parameters, adding the fields that
+    are set by the API rather than the client.
+    '''
+    values = dict(params)
+    values["setdate"] = parse_setdate(values["setdate"])
+    values["setyear"] = values["setdate"].year
+    values["set_date"] = values["setdate"].date()
+    values["updated"] = datetime.datetime.now(datetime.timezone.utc)
+    values["globalid"] = str(uuid.uuid4())  # ideally, this would check against existing GlobalIDs
+    return values
+
+
+def check_patch(patch):
+    '''
+    Return the errors in one patch of a PATCH to counts, a {"recordnum": ..., "fields": {...}}
+    object, with the messages a PUT to count() would respond with, or an empty list if there are
+    none.
+    '''
+    if not isinstance(patch, dict) or set(patch) != {"recordnum", "fields"}:
+        return ["Patch must be a JSON object with recordnum and fields."]
+
+    errors = []
+    if type(patch["recordnum"]) is not int:
+        errors.append("recordnum must be an integer")
+
+    fields = patch["fields"]
+    if not isinstance(fields, dict) or not fields:
+        errors.append("fields must be a JSON object of the parameters to change")
+        return errors
+
+    if "recordnum" in fields:
+        errors.append("recordnum cannot be changed")
+
+    errors.extend(count_errors([], *check_params(fields)))
+    return errors
+
+
+def changed_count_values(params):
+    '''
+    Return the column values to update from the checked parameters of a PUT or PATCH, without the
+    fields clients can't change, and with the fields derived from them.
+    '''
+    values = {k: v for k, v in params.items() if k not in ("setyear", "globalid", "set_date")}
+
+    # keep setyear and set_date in sync with setdate
+    if "setdate" in values:
+        values["setdate"] = parse_setdate(values["setdate"])
+        values["setyear"] = values["setdate"].year
+        values["set_date"] = values["setdate"].date()
+
+    values["updated"] = datetime.datetime.now(datetime.timezone.utc)
+    return values
+
+
+def encode_cursor(setdate, recordnum):
+    '''
+    Encode the sort key of the last row of a page as an opaque cursor for the next page; setdate
+    may be None.
+    '''
+    if isinstance(setdate, datetime.date):
+        setdate = setdate.isoformat()
+    token = json.dumps([setdate, recordnum], separators=(",", ":"))
+    return base64.urlsafe_b64encode(token.encode()).decode()
+
+
+def decode_cursor(cursor):
+    '''
+    Decode a cursor created by encode_cursor() back into its (setdate, recordnum) sort key, with
+    setdate None if the count has none. Raises ValueError if the cursor is malformed.
+    '''
+    try:
+        setdate, recordnum = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, TypeError, UnicodeDecodeError, ValueError):
+        raise ValueError(f"{cursor} is not a valid cursor")
+
+    if not (setdate is None or isinstance(setdate, str)) or type(recordnum) is not int:
+        raise ValueError(f"{cursor} is not a valid cursor")
+
+    if setdate is None:
+        return None, recordnum
+    return datetime.datetime.fromisoformat(setdate), recordnum
+
+
+def wants_stream():
+    '''
+    Check whether the client asked for a streamed response, either with the stream query string
+    parameter or by preferring newline-delimited JSON in the Accept header.
+    '''
+    if request.args.get("stream") == "1":
+        return True
+    best = request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"])
+    return best == "application/x-ndjson"
+
+
+# number of rows fetched from the server-side cursor at a time when streaming
+STREAM_BATCH_SIZE = 1000
+
+
+def stream_response(statement, bind_params=None, keys=None):
+    '''
+    Execute statement with a server-side cursor and return a Response that streams the results as
+    newline-delimited JSON, one row per line, as the client consumes them. Only one batch of rows
+    is held in memory at a time. Returns None if there are no results.
+
+    Rows are written with keys, the first columns of the results (all of them if None).
+    '''
+    result = db.session.execute(statement.execution_options(stream_results=True), bind_params)
+    with phase("fetch"):
+        rows = result.fetchmany(STREAM_BATCH_SIZE)
+    count_rows(len(rows))
+
+    if not rows:
+        result.close()
+        return None
+
+    serializer = serializer_for(keys or result.keys())
+
+    def generate(rows):
+        try:
+            while rows:
+                with phase("serialize"):
+                    chunk = "".join([serializer.row(r) + "\n" for r in rows])
+                yield chunk
+                with phase("fetch"):
+                    rows = result.fetchmany(STREAM_BATCH_SIZE)
+                count_rows(len(rows))
+        finally:
+            result.close()
+
+    return Response(stream_with_context(generate(rows)), mimetype='application/x-ndjson')
+
+
+def counts_response(serialized, next_cursor=None):
+    '''
+    Return the Response for a page of counts, with a Link header to the next page if there is
+    one.
+    '''
+    response = Response(serialized, mimetype='application/json')
+    if next_cursor:
+        args = request.args.to_dict()
+        args["after"] = next_cursor
+        # url_root[:-1] removes duplicate "/"
+        next_page = request.url_root[:-1] + url_for('api.counts', **args)
+        response.headers['Link'] = f'<{next_page}>; rel="next"'
+    return response
+
+
+def with_station(bind_params=None):
+    '''
+    Return bind_params with the weather station whose weather is joined to counts, set by the
+    WEATHER_STATION config variable.
+    '''
+    return dict(bind_params or {}, weather_station=current_app.config["WEATHER_STATION"])
+
+
+def make_etag(*parts):
+    '''
+    Return an ETag that changes whenever any of parts changes. The parts include the table
+    version, which every write to the counts or weather bumps in its transaction, so the ETag of a
+    response changes with the data it is made from, whichever worker process made the change.
+    '''
+    return hashlib.sha1(json.dumps(parts, default=str).encode()).hexdigest()
+
+
+def set_validators(response, etag, last_modified=None):
+    '''
+    Set the ETag (weak, as the body may be sent with different encodings) and Last-Modified
+    headers of response.
+    '''
+    response.set_etag(etag, weak=True)
+    if isinstance(last_modified, datetime.datetime):
+        response.last_modified = last_modified
+    return response
+
+
+def not_modified(etag, last_modified=None):
+    '''
+    Return a 304 Not Modified Response if the ETag of the client's copy (If-None-Match) matches
+    etag, otherwise None. If-Modified-Since is not used, since the ETag identifies the data more
+    precisely than a time to the second.
+    '''
+    if request.if_none_match.contains_weak(etag):
+        return set_validators(Response(status=304), etag, last_modified)
+    return None
+
+
+def read_bulk_body():
+    '''
+    Return the records (counts or patches) in the request body of a bulk request, either a JSON
+    array or newline-delimited JSON with one record per line. Raises ValueError, with the message
+    for the client, if the body can't be read.
+    '''
+    if request.mimetype == "application/x-ndjson":
+        records = []
+        for line_number, line in enumerate(request.get_data(as_text=True).splitlines(), 1):
+            if not line.strip():
+                continue
             try:
-                datetime.datetime.strptime(v, "%Y-%m-%d")
+                records.append(json.loads(line))
             except ValueError:
-                bad_params.append(k + " must be in the format 'YYYY-MM-DD")
+                raise ValueError(f"Unable to process JSON content on line {line_number}.")
+        return records
+
+    if not request.is_json:
+        raise ValueError("Request body must be submitted in json or newline-delimited json "
+                         "format")
+
+    try:
+        records = request.get_json()
+    except BadRequest:
+        raise ValueError("Unable to process submitted JSON content.")
+
+    if not isinstance(records, list):
+        raise ValueError("Request body must be a JSON array.")
+    return records
+
+
+def point_geom(longitude, latitude):
+    '''Return the SQL expression of the PostGIS point of a count, from its coordinates.'''
+    return func.ST_SetSRID(func.ST_MakePoint(longitude, latitude), 4326)
+
+
+def insert_count(values):
+    '''
+    Insert a new count, from new_count_values(), in the current transaction and return its
+    recordnum.
+
+    This takes one round trip: on PostgreSQL geom is computed by the INSERT itself, and the
+    recordnum is returned by it (SQLAlchemy adds RETURNING recordnum). Values are bound as
+    parameters, so the statement is the same for every count with the same fields.
+    '''
+    values = dict(values)
+    if db.engine.dialect.name == "postgresql":
+        values["geom"] = point_geom(values["longitude"], values["latitude"])
+
+    table = BicycleCount.__table__
+    return db.session.execute(table.insert().values(values)).inserted_primary_key[0]
+
+
+def update_count(recordnum, values):
+    '''
+    Update a count with values, from changed_count_values(), in the current transaction. Returns
+    the number of counts updated (0 if there is no such count) and, if its coordinates changed,
+    its new (latitude, longitude), otherwise None.
+
+    On PostgreSQL this takes one round trip: geom is recomputed by the UPDATE itself, from the new
+    coordinates (or the current one of those not changed), and the coordinates are returned by it.
+    '''
+    table = BicycleCount.__table__
+    moved = "latitude" in values or "longitude" in values
+
+    if db.engine.dialect.name == "postgresql":
+        values = dict(values)
+        if moved:
+            values["geom"] = point_geom(values.get("longitude", table.c.longitude),
+                                        values.get("latitude", table.c.latitude))
+        rows = db.session.execute(
+            table.update().where(table.c.recordnum == recordnum).values(values)
+            .returning(table.c.latitude, table.c.longitude)).fetchall()
+        return len(rows), (tuple(rows[0]) if moved and len(rows) == 1 else None)
+
+    matched = db.session.execute(
+        table.update().where(table.c.recordnum == recordnum).values(values)).rowcount
+    if not moved or matched != 1:
+        return matched, None
+    if "latitude" in values and "longitude" in values:
+        return matched, (values["latitude"], values["longitude"])
+    return matched, tuple(db.session.execute(
+        select([table.c.latitude, table.c.longitude]).where(table.c.recordnum == recordnum))
+        .fetchone())
+
+
+def insert_counts(rows):
+    '''
+    Insert new counts, from new_count_values(), in the current transaction and return their
+    recordnums in the same order.
+
+    On PostgreSQL counts are inserted BULK_BATCH_SIZE at a time by multi-row INSERTs, which set
+    geom and return the recordnums in the same statement. MySQL and SQLite can't return the keys
+    generated by a multi-row INSERT, so there each count is inserted by its own statement.
+    '''
+    if db.engine.dialect.name != "postgresql":
+        table = BicycleCount.__table__
+        return [db.session.execute(table.insert().values(row)).inserted_primary_key[0]
+                for row in rows]
+
+    # psycopg2 fills in the VALUES of each statement from one template, which is much faster
+    # than compiling a SQLAlchemy construct of thousands of rows
+    from psycopg2.extras import execute_values
+
+    # every row of a multi-row INSERT must have the same columns, so optional fields submitted
+    # for only some counts split them into separate statements
+    batches = {}
+    for row in rows:
+        batches.setdefault(tuple(sorted(row)), []).append(row)
+
+    cursor = db.session.connection().connection.cursor()
+    recordnums = {}
+    for columns, batch in batches.items():
+        # column names are safe to interpolate, as check_params() rejects unknown ones
+        sql = (f"INSERT INTO bicycle_count ({', '.join(columns)}, geom) VALUES %s "
+               "RETURNING globalid, recordnum")
+        template = ("(" + ", ".join(f"%({column})s" for column in columns)
+                    + ", ST_SetSRID(ST_MakePoint(%(longitude)s, %(latitude)s), 4326))")
+        # the order of RETURNING rows isn't guaranteed, so they are matched back up by globalid
+        recordnums.update(execute_values(cursor, sql, batch, template,
+                                         page_size=BULK_BATCH_SIZE, fetch=True))
+
+    return [recordnums[row["globalid"]] for row in rows]
+
+
+def recordnums_in(recordnums, sql):
+    '''
+    Execute sql, a SELECT with a "recordnum IN :recordnums" condition, for the given recordnums
+    and return all of its rows. On PostgreSQL the recordnums are sent as one array parameter;
+    elsewhere they are sent BULK_BATCH_SIZE at a time, as databases limit the number of
+    parameters of a statement.
+    '''
+    if db.engine.dialect.name == "postgresql":
+        statement = text(sql.replace("IN :recordnums", "= ANY(:recordnums)"))
+        return db.session.execute(statement, {"recordnums": list(recordnums)}).fetchall()
+
+    statement = text(sql).bindparams(bindparam("recordnums", expanding=True))
+    recordnums = list(recordnums)
+    rows = []
+    for start in range(0, len(recordnums), BULK_BATCH_SIZE):
+        rows.extend(db.session.execute(
+            statement, {"recordnums": recordnums[start:start + BULK_BATCH_SIZE]}))
+    return rows
+
+
+def update_counts(changes):
+    '''
+    Apply changes, a dict of recordnum: column values from changed_count_values(), in the current
+    transaction, and recompute geom of the counts whose coordinates changed. Returns the
+    (recordnum, latitude, longitude) of those counts.
+
+    Changes to the same set of columns are applied together: on PostgreSQL by one UPDATE ... FROM
+    (VALUES ...) per BULK_BATCH_SIZE counts, and elsewhere by one executemany() UPDATE. geom is
+    then recomputed from the stored coordinates by one more UPDATE.
+    '''
+    table = BicycleCount.__table__
+    dialect = db.engine.dialect
+    postgresql = dialect.name == "postgresql"
+
+    batches = {}
+    for recordnum, values in changes.items():
+        batches.setdefault(tuple(sorted(values)), []).append(dict(values, b_recordnum=recordnum))
+
+    if postgresql:
+        # psycopg2 fills in the VALUES from one template, as in insert_counts()
+        from psycopg2.extras import execute_values
+        cursor = db.session.connection().connection.cursor()
+
+    for columns, batch in batches.items():
+        if not postgresql:
+            # the SET clause is made from the keys of the parameters of the first count
+            statement = table.update().where(table.c.recordnum == bindparam("b_recordnum"))
+            db.session.execute(statement, batch)
+            continue
+
+        # column names are safe to interpolate, as check_params() rejects unknown ones. Values are
+        # cast to the type of their column, as PostgreSQL can't infer the types of a VALUES list.
+        sql = (f"UPDATE bicycle_count AS b SET {', '.join(f'{c} = v.{c}' for c in columns)} "
+               f"FROM (VALUES %s) AS v (recordnum, {', '.join(columns)}) "
+               "WHERE b.recordnum = v.recordnum")
+        template = ("(%(b_recordnum)s, "
+                    + ", ".join(f"%({c})s::{table.c[c].type.compile(dialect=dialect)}"
+                                for c in columns)
+                    + ")")
+        execute_values(cursor, sql, batch, template, page_size=BULK_BATCH_SIZE)
+
+    moved = [recordnum for recordnum, values in changes.items()
+             if "latitude" in values or "longitude" in values]
+    if not moved:
+        return []
+
+    if not postgresql:
+        return recordnums_in(moved, "SELECT recordnum, latitude, longitude FROM bicycle_count "
+                                    "WHERE recordnum IN :recordnums")
+    return db.session.execute(
+        text("UPDATE bicycle_count "
+             "SET geom = ST_SetSRID(ST_MakePoint(longitude, latitude), 4326) "
+             "WHERE recordnum = ANY(:recordnums) RETURNING recordnum, latitude, longitude"),
+        {"recordnums": moved}).fetchall()
+
+
+# largest page of counts that can be requested with the limit parameter
+MAX_PAGE_SIZE = 10000
+
+# columns of counts returned by the API (set_date is only used for the weather join)
+count_columns = [column.name for column in BicycleCount.__table__.c if column.name != "set_date"]
+
+# columns of the weather joined to counts that are returned with them
+weather_columns = ["prcp", "tavg", "tmax", "tmin"]
+
+# fields that can be selected with the fields parameter, in the order they are returned
+FIELDS = tuple(count_columns + weather_columns)
+
+
+def parse_fields(value, allowed=FIELDS):
+    '''
+    Return the fields selected by the fields query string parameter, a comma-separated list, in
+    the order of allowed, or None if it wasn't given (all fields). Raises ValueError, with the
+    message for the client, if any of them aren't allowed.
+    '''
+    if value is None:
+        return None
+    names = {name.strip() for name in value.split(",") if name.strip()}
+    unknown = sorted(names.difference(allowed))
+    if unknown:
+        raise ValueError(f"Unknown field(s): {', '.join(unknown)}. Fields must be any of "
+                         + ", ".join(allowed))
+    if not names:
+        raise ValueError("fields must name at least one field.")
+    return tuple(name for name in allowed if name in names)
+
+
+def select_columns(fields=None, extra=()):
+    '''
+    Return the SELECT list of fields (all of FIELDS if None), as a list, followed by the columns of
+    counts in extra that aren't among them, which the API needs but the client didn't ask for.
+    '''
+    fields = FIELDS if fields is None else fields
+    return ([("w." if name in weather_columns else "b.") + name for name in fields]
+            + ["b." + name for name in extra if name not in fields])
+
+
+# join on the stored set_date rather than DATE(b.setdate), which can't use an index on setdate,
+# to the weather of one station (the :weather_station bind parameter, see with_station())
+from_clause = ("FROM bicycle_count b LEFT JOIN weather w "
+               "ON b.set_date = w.date AND w.station = :weather_station")
+
+
+def from_counts(columns, weather=False):
+    '''
+    Return the FROM clause of a SELECT of columns of counts. The weather is only joined if any of
+    the columns, or conditions added by the caller (weather), are from it: it is at most one row
+    per count, so leaving it out doesn't change the counts selected.
+    '''
+    if weather or any(column.startswith("w.") for column in columns):
+        return from_clause
+    return "FROM bicycle_count b"
 
-        # Other checks would go here (Mun_name, against allowed value for facilities, etc.)
 
-    return unknown_params, bad_params
+def query_sql(fields=None, extra=(), weather=False):
+    '''Return the SELECT of counts with fields (all if None) and extra, as select_columns().'''
+    columns = select_columns(fields, extra)
+    return "SELECT " + ", ".join(columns) + " " + from_counts(columns, weather)
 
 
-sql_query = ("SELECT b.*, w.prcp, w.tavg, w.tmax, w.tmin FROM bicycle_count b LEFT JOIN weather "
-             "w ON DATE(b.setdate) = w.date")
+sql_query = query_sql()
+
+# largest number of counts that can be requested from closest()
+MAX_CLOSEST = 100
+
+# counts closest in degrees that PostGIS ranks by distance in metres, per count returned. In the
+# region a degree of longitude is 0.77 of one of latitude, so the k counts closest in metres are
+# among the few k closest in degrees unless the counts around the point are very uneven.
+CLOSEST_CANDIDATES = 4
+
+# Statements of the read endpoints, built once per combination of filters and fields. Every value
+# is a bound parameter; those executed with prepared.execute() are prepared by PostgreSQL once per
+# connection. Fields are in the order of FIELDS, so their combinations are bounded, and the
+# statements of the least recently used ones are dropped.
+
+
+@functools.lru_cache(maxsize=256)
+def count_statement(fields=None):
+    '''Return the statement of count() for fields (all if None).'''
+    return text(query_sql(fields) + " WHERE b.recordnum = :record_num")
+
+
+@functools.lru_cache(maxsize=1024)
+def counts_statement(prcp, bikepedfac, after, limit, fields=None, dialect="postgresql"):
+    '''
+    Return the statement of counts() for a combination of the filters used and fields (all if
+    None), for a database of dialect. after is "setdate" to continue after a cursor, "null" to
+    continue after one whose setdate is null, or None. Pages also select the sort key of counts,
+    for the cursor of the next page.
+    '''
+    where_clauses = []
+    if prcp:
+        where_clauses.append("w.prcp >= :prcp")
+    if bikepedfac:
+        where_clauses.append("b.bikepedfac = :bikepedfac")
+    # keyset pagination: continue after the (setdate, recordnum) of the previous page's last
+    # row, so that every page is an index range scan no matter how deep into the table it is.
+    # Counts without a setdate sort by recordnum before all others in MySQL and SQLite and after
+    # them in PostgreSQL, as in the index on (setdate, recordnum) of each.
+    nulls_first = dialect != "postgresql"
+    if after == "setdate":
+        after_sql = "(b.setdate, b.recordnum) > (:after_setdate, :after_recordnum)"
+        where_clauses.append(after_sql if nulls_first else f"({after_sql} or b.setdate is null)")
+    elif after == "null":
+        after_sql = "b.setdate is null and b.recordnum > :after_recordnum"
+        where_clauses.append(f"(({after_sql}) or b.setdate is not null)" if nulls_first
+                             else after_sql)
+
+    sql = query_sql(fields, ("setdate", "recordnum") if limit else (), weather=prcp)
+    if where_clauses:
+        sql += " where " + " and ".join(where_clauses)
+    sql += " ORDER BY b.setdate ASC, b.recordnum ASC"
+    if limit:
+        sql += " LIMIT :limit"
+
+    statement = text(sql)
+    if after == "setdate":
+        statement = statement.bindparams(
+            bindparam("after_setdate", type_=BicycleCount.setdate.type))
+    return statement
+
+
+@functools.lru_cache(maxsize=1024)
+def closest_statement(k, radius, fields=None):
+    '''
+    Return the statement of closest() for k counts, within :radius metres if radius, with fields
+    (all, and distance, if None).
+    '''
+    point = "ST_SetSRID(ST_MakePoint(:lon, :lat), 4326)"
+    columns = select_columns(None if fields is None else
+                             tuple(name for name in fields if name != "distance"))
+    select = columns + [f"ST_Distance(b.geom::geography, {point}::geography) AS distance"]
+    sql = "SELECT " + ", ".join(select) + " " + from_counts(columns)
+    if radius:
+        sql += f" WHERE ST_DWithin(b.geom::geography, {point}::geography, :radius)"
+    # The index orders by distance in degrees, in which a degree of longitude is as long as one
+    # of latitude, so the candidates it returns are ranked again by their distance in metres.
+    # k is a literal rather than a parameter: the generic plan of a prepared statement can't
+    # tell how many rows LIMIT $n will return and costs it as a large share of the table, so
+    # PostgreSQL would otherwise plan every execution anew
+    sql += f" ORDER BY b.geom <-> {point} LIMIT {int(k) * CLOSEST_CANDIDATES}"
+    names = [column.split(".", 1)[1] for column in columns]
+    if fields is None or "distance" in fields:
+        names.append("distance")
+    return text(f"SELECT {', '.join(names)} FROM ({sql}) candidates "
+                f"ORDER BY distance LIMIT {int(k)}")
+
+
+@functools.lru_cache(maxsize=256)
+def closest_from_index_statement(columns=None):
+    '''
+    Return the statement of closest_from_index() for the columns of fields (all if None), with
+    recordnum.
+    '''
+    return text(query_sql(columns, ("recordnum",)) + " WHERE b.recordnum IN :recordnums")\
+        .bindparams(bindparam("recordnums", expanding=True))
+
+
+# largest number of counts that can be added or changed by one request to counts_bulk() or
+# counts_patch(), and the number written by each multi-row statement
+MAX_BULK_COUNTS = 50000
+BULK_BATCH_SIZE = 500
 
 
 @api_bp.route("counts/<record_num>", methods=['GET', 'PUT', 'DELETE'])
-def count(record_num, sql_query=sql_query):
+def count(record_num):
     '''Get, edit, or delete one bicycle count record.'''
     # ensure record_num is an int
     try:
@@ -149,12 +657,28 @@ def count(record_num, sql_query=sql_query):
         return jsonify({"error": f"{record_num} is not a valid recordnum"}), 400
 
     if request.method == 'GET':
-        sql_query += " WHERE recordnum = :record_num"
-        
-        result = db.session.execute(text(sql_query), {"record_num": record_num}).fetchall()
+        try:
+            fields = parse_fields(request.args.get("fields"))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        # answered from the table version alone if the client's copy is of the current one
+        last_modified = cache.last_modified()
+        etag = make_etag("count", record_num, cache.get_version(), fields)
+        response = not_modified(etag, last_modified)
+        if response is not None:
+            return response
+
+        result = prepared.execute(db.session, count_statement(fields),
+                                  with_station({"record_num": record_num}))
+        with phase("fetch"):
+            result = result.fetchall()
+        count_rows(len(result))
         if len(result):
-            serialized = json.dumps([dict(r) for r in result], default=alchemyencoder)
-            return Response(serialized, mimetype='application/json')
+            with phase("serialize"):
+                serialized = serializer_for(fields or result[0].keys()).rows(result)
+            return set_validators(Response(serialized, mimetype='application/json'), etag,
+                                  last_modified)
         else:
             return jsonify({"error": "No matching record found."}), 404
 
@@ -184,43 +708,32 @@ def count(record_num, sql_query=sql_query):
             return jsonify({"error": "Error(s) in submitted parameters: "
                             + "; ".join(bad_params)}), 400
 
-        # remove params that should not be updated by client
-        try:
-            del params["setyear"]
-        except KeyError:
-            pass
-        try:
-            del params["globalid"]
-        except KeyError:
-            pass
+        # remove params that should not be updated by client, and set Updated
+        params = changed_count_values(params)
 
-        count = BicycleCount.query.filter_by(recordnum=record_num)
-        
-        try:
-            count.one()
-        except NoResultFound:
+        # the count as it was, to move it between groups of the rollups
+        old = None
+        if rollups.affected_by(params):
+            old = recordnums_in([record_num], rollups.rows_sql(db.engine.dialect.name))
+
+        # update fields (and geom, if either lat or lon submitted)
+        matched, location = update_count(record_num, params)
+
+        if matched == 0:
+            db.session.rollback()
             return jsonify({"error": "No matching record found."}), 404
-        except MultipleResultsFound:
+        if matched > 1:
+            db.session.rollback()
             return jsonify({"error": "More than one record found. There are mutliple records with "
                             "the same PRIMARY KEY"}), 500
-        
-        # set Updated
-        params["updated"] = datetime.datetime.now(datetime.timezone.utc)
 
-        # update fields
-        count.update(params)
+        if old:
+            old = dict(old[0])
+            rollups.update(added=[dict(old, **params)], removed=[old])
+        cache.bump_version()
         db.session.commit()
-
-        # update geom, if either lat or lon submitted
-        if params.get("latitude") or params.get("longitude"):
-            count = BicycleCount.query.filter_by(recordnum=record_num).one()
-            sql_query = f'''
-                UPDATE bicycle_count
-                SET geom = ST_SetSRID(ST_MakePoint({count.longitude}, {count.latitude}), 4326)
-                WHERE recordnum = {count.recordnum}
-                '''
-            db.session.execute(text(sql_query))
-            db.session.commit()
+        if location is not None:
+            spatial_index.insert(record_num, *location)
 
         # get location of updated resource (url_root[:-1] removes duplicate "/")
         location = request.url_root[:-1] + url_for('api.count', record_num=record_num)
@@ -230,28 +743,41 @@ def count(record_num, sql_query=sql_query):
         return response
 
     if request.method == 'DELETE':
+        # locked until it is deleted, as in PUT, so that the group it is removed from in the
+        # rollups is the one it is in when it is deleted
         try:
-            result = BicycleCount.query.filter_by(recordnum=record_num).one()
+            result = BicycleCount.query.filter_by(recordnum=record_num).with_for_update().one()
         except NoResultFound:
             return jsonify({"error": "No matching record found."}), 404
         except MultipleResultsFound:
             return jsonify({"error": "More than one record found. There are mutliple records with "
                             "the same PRIMARY KEY"}), 500
 
-        BicycleCount.query.filter_by(recordnum=record_num).delete()
+        if BicycleCount.query.filter_by(recordnum=record_num).delete():
+            rollups.update(removed=[{column: getattr(result, column)
+                                     for column in rollups.COLUMNS}])
+        cache.bump_version()
         db.session.commit()
+        spatial_index.remove(record_num)
 
         return jsonify({"Success": "Count with recordnum " + str(record_num) + " deleted."})
 
 
 @api_bp.route("counts", methods=['GET', 'POST'])
-def counts(sql_query=sql_query):
+def counts():
     '''Return all bicycle counts according to various criteria or add new bicycle count record.'''
     if request.method == 'GET':
         bikepedfac = request.args.get("bikepedfac")
         prcp = request.args.get("prcp")
+        limit = request.args.get("limit")
+        after = request.args.get("after")
         
-        where_clauses = []
+        bind_params = {}
+
+        try:
+            fields = parse_fields(request.args.get("fields"))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
 
         if prcp:
             try:
@@ -259,32 +785,94 @@ def counts(sql_query=sql_query):
             except ValueError:
                 return jsonify({'error': 'Precipitation value must be an number, with optional '
                                 'decimal points.'}), 400
-            
-            where_clauses.append(f"w.prcp >= {prcp}")
+            bind_params["prcp"] = prcp
         
         if bikepedfac:
-            facility_types = ['Multiuse Trail',
-                              'Sidepath',
-                              'Striped Shoulder',
-                              'Bike Lane',
-                              'Mixed Traffic',
-                              'Buffered Bike Lane',
-                              'Sharrow']
-            if bikepedfac not in facility_types:
-                return jsonify({'error': 'Facility must be one of '
-                                          + ', '.join(facility_types)}), 400
-            where_clauses.append(f"b.bikepedfac = '{bikepedfac}'")
+            if bikepedfac not in FACILITY_SET:
+                return jsonify({'error': 'Facility must be one of ' + ', '.join(FACILITIES)}), 400
+            bind_params["bikepedfac"] = bikepedfac
 
-        if where_clauses:
-            sql_query += " where " + " and ".join(where_clauses)
+        stream = wants_stream()
 
-        sql_query += " ORDER BY b.setdate ASC"
+        if stream and (limit or after):
+            return jsonify({'error': 'Streamed responses cannot be paged; remove limit and '
+                            'after, or stream.'}), 400
 
-        result = db.session.execute(text(sql_query)).fetchall()
+        if limit:
+            try:
+                limit = int(limit)
+            except ValueError:
+                return jsonify({'error': 'Limit must be an integer.'}), 400
+            if not 0 < limit <= MAX_PAGE_SIZE:
+                return jsonify({'error': f'Limit must be between 1 and {MAX_PAGE_SIZE}.'}), 400
+
+        after_key = None
+        if after:
+            try:
+                after_setdate, bind_params["after_recordnum"] = decode_cursor(after)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            if after_setdate is None:
+                after_key = "null"
+            else:
+                after_key, bind_params["after_setdate"] = "setdate", after_setdate
+
+        normalized = {"bikepedfac": bikepedfac, "prcp": prcp, "limit": limit, "after": after,
+                      "fields": fields and ",".join(fields)}
+        query_key = urlencode(sorted((k, v) for k, v in normalized.items() if v not in (None, "")))
+
+        # The version is read before querying, so a write committed during the query leaves this
+        # result cached under a version that is already out of date.
+        version = cache.get_version()
+        last_updated = cache.last_modified()
+        etag = make_etag("counts", version, query_key, stream)
+
+        response = not_modified(etag, last_updated)
+        if response is not None:
+            return response
+
+        # serve from the response cache when possible, keyed on the normalized parameters
+        if not stream:
+            cache_key = "counts?" + query_key
+            cached = cache.get(cache_key, version)
+            if cached is not None:
+                serialized, next_cursor, rows = cached
+                count_rows(rows)
+                compression.cache_compressed(cache, cache_key, version)
+                return set_validators(counts_response(serialized, next_cursor), etag,
+                                      last_updated)
+
+        # fetch one extra row to find out whether there is a next page
+        if limit:
+            bind_params["limit"] = limit + 1
+
+        statement = counts_statement("prcp" in bind_params, "bikepedfac" in bind_params,
+                                     after_key, "limit" in bind_params, fields,
+                                     db.engine.dialect.name)
+        bind_params = with_station(bind_params)
+
+        if stream:
+            response = stream_response(statement, bind_params, fields)
+            if response is None:
+                return jsonify({"error": "No matching records found."}), 404
+            return set_validators(response, etag, last_updated)
+
+        result = db.session.execute(statement, bind_params)
+        with phase("fetch"):
+            result = result.fetchall()
+
+        next_cursor = None
+        if limit and len(result) > limit:
+            result = result[:limit]
+            next_cursor = encode_cursor(result[-1]["setdate"], result[-1]["recordnum"])
+        count_rows(len(result))
 
         if len(result):
-            serialized = json.dumps([dict(r) for r in result], default=alchemyencoder)
-            return Response(serialized, mimetype='application/json')
+            with phase("serialize"):
+                serialized = serializer_for(fields or result[0].keys()).rows(result).encode()
+            cache.set(cache_key, version, (serialized, next_cursor, len(result)))
+            compression.cache_compressed(cache, cache_key, version)
+            return set_validators(counts_response(serialized, next_cursor), etag, last_updated)
         else:
             return jsonify({"error": "No matching records found."}), 404
 
@@ -320,39 +908,193 @@ def counts(sql_query=sql_query):
 
         # insert into db
         # process a few special params
-        params["setdate"] = datetime.datetime.strptime(params["setdate"], "%Y-%m-%d")
-        params["setyear"] = params["setdate"].year
-        params["updated"] = datetime.datetime.now(datetime.timezone.utc)
-        params["globalid"] = str(uuid.uuid4())  # ideally, this would check against existing GlobalIDs
-        
-        count = BicycleCount(**params)
-
-        db.session.add(count)
-        db.session.commit()
-
-        # add the geom field
-        sql_query = f'''
-            UPDATE bicycle_count
-            SET geom = ST_SetSRID(ST_MakePoint({params["longitude"]}, {params["latitude"]}), 4326)
-            WHERE recordnum = {count.recordnum}
-            '''
-        db.session.execute(text(sql_query))
+        params = new_count_values(params)
+        recordnum = insert_count(params)
+        rollups.update(added=[params])
+        cache.bump_version()
         db.session.commit()
+        spatial_index.insert(recordnum, params["latitude"], params["longitude"])
         
         # get location of created resource (url_root[:-1] removes duplicate "/")
-        location = request.url_root[:-1] + url_for('api.count', record_num=count.recordnum)
+        location = request.url_root[:-1] + url_for('api.count', record_num=recordnum)
         
         response = make_response({"Success": "true"}, 201)
         response.headers['Location'] = location
         return response
         
 
+@api_bp.route("counts/bulk", methods=['POST'])
+def counts_bulk():
+    '''
+    Add many bicycle count records at once, from a JSON array or newline-delimited JSON. The
+    counts are added in one transaction: if any of them has errors, none are added.
+    '''
+    if not request.data:
+        return jsonify({"error": "No Request body submitted"}), 400
+
+    try:
+        records = read_bulk_body()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if not records:
+        return jsonify({"error": "No counts submitted."}), 400
+
+    if len(records) > MAX_BULK_COUNTS:
+        return jsonify({"error": f"No more than {MAX_BULK_COUNTS} counts can be submitted "
+                        "at once."}), 400
+
+    # check every count, so that all errors can be fixed before resubmitting
+    errors = [{"index": index, "errors": record_errors}
+              for index, record_errors in enumerate(check_new_counts(records)) if record_errors]
+
+    if errors:
+        return jsonify({"error": "Error(s) in submitted counts; no counts were added.",
+                        "errors": errors}), 400
+
+    rows = [new_count_values(params) for params in records]
+
+    try:
+        recordnums = insert_counts(rows)
+        rollups.update(added=rows)
+        cache.bump_version()
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({"error": "One or more counts conflict with existing records; no counts "
+                        "were added."}), 400
+
+    for recordnum, row in zip(recordnums, rows):
+        spatial_index.insert(recordnum, row["latitude"], row["longitude"])
+
+    return make_response({"Success": "true", "recordnums": recordnums}, 201)
+
+
+@api_bp.route("counts", methods=['PATCH'])
+def counts_patch():
+    '''
+    Change many bicycle count records at once, from a JSON array (or newline-delimited JSON) of
+    {"recordnum": ..., "fields": {...}} patches. The patches are applied in one transaction: if any
+    of them has errors, or is for a count that doesn't exist, none are applied.
+
+    A batch of patches changing c different sets of fields takes c + 4 round trips to PostgreSQL
+    (one more per BULK_BATCH_SIZE patches of a set), however many counts it changes: BEGIN, the
+    SELECT checking that the counts exist, an UPDATE per set of fields, one UPDATE recomputing
+    geom if coordinates changed, and COMMIT, plus one INSERT updating the rollups if fields they
+    depend on changed. A PUT to count() takes 3 for each count: BEGIN, an UPDATE setting geom and
+    returning the coordinates, and COMMIT, plus a SELECT of the count as it was and an INSERT
+    updating the rollups if fields they depend on changed.
+    '''
+    if not request.data:
+        return jsonify({"error": "No Request body submitted"}), 400
+
+    try:
+        patches = read_bulk_body()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if not patches:
+        return jsonify({"error": "No patches submitted."}), 400
+
+    if len(patches) > MAX_BULK_COUNTS:
+        return jsonify({"error": f"No more than {MAX_BULK_COUNTS} counts can be changed at "
+                        "once."}), 400
+
+    errors = []
+    seen = set()
+    for index, patch in enumerate(patches):
+        patch_errors = check_patch(patch)
+        if not patch_errors and patch["recordnum"] in seen:
+            patch_errors = [f"recordnum {patch['recordnum']} is patched more than once"]
+        if patch_errors:
+            errors.append({"index": index, "errors": patch_errors})
+        else:
+            seen.add(patch["recordnum"])
+
+    if errors:
+        return jsonify({"error": "Error(s) in submitted patches; no counts were changed.",
+                        "errors": errors}), 400
+
+    changes = {patch["recordnum"]: changed_count_values(patch["fields"]) for patch in patches}
+
+    # with the values the rollups depend on, if any patch changes them
+    moving = [recordnum for recordnum, values in changes.items() if rollups.affected_by(values)]
+    sql = ("SELECT recordnum FROM bicycle_count WHERE recordnum IN :recordnums" if not moving
+           else rollups.rows_sql(db.engine.dialect.name))
+    existing = {row[0]: dict(row) for row in recordnums_in(changes, sql)}
+    missing = [str(recordnum) for recordnum in changes if recordnum not in existing]
+    if missing:
+        return jsonify({"error": "No matching record found for recordnum(s): "
+                        + ", ".join(missing) + ". No counts were changed."}), 404
+
+    moved = update_counts(changes)
+    rollups.update(added=[dict(existing[recordnum], **changes[recordnum]) for recordnum in moving],
+                   removed=[existing[recordnum] for recordnum in moving])
+    cache.bump_version()
+    db.session.commit()
+
+    for recordnum, latitude, longitude in moved:
+        spatial_index.insert(recordnum, latitude, longitude)
+
+    return make_response({"Success": "true", "recordnums": list(changes)}, 200)
+
+
+@api_bp.route("counts/stats", methods=['GET'])
+def counts_stats():
+    '''
+    Return statistics of the AADB of counts (by default their number and mean AADB) for each
+    group of the dimensions in group_by, computed by the database, one object per group. Sums
+    by the dimensions of the rollups are read from them.
+    '''
+    group_by = parse_list(request.args.get("group_by"))
+    metrics = parse_list(request.args.get("metrics"), DEFAULT_METRICS)
+    error = check_group_by(group_by) or check_metrics(metrics)
+    if error:
+        return jsonify({"error": error}), 400
+
+    query_key = urlencode([("group_by", ",".join(group_by)), ("metrics", ",".join(metrics))])
+    version = cache.get_version()
+    last_updated = cache.last_modified()
+    etag = make_etag("stats", version, query_key)
+
+    response = not_modified(etag, last_updated)
+    if response is not None:
+        return response
+
+    cache_key = "stats?" + query_key
+    cached = cache.get(cache_key, version)
+    if cached is None:
+        if rollups.enabled() and rollups.covers(group_by, metrics):
+            # one row per group of the rollups, rather than every count
+            result = db.session.execute(rollups.stats_statement(group_by))
+            with phase("fetch"):
+                groups = [rollups.group_values(row, group_by, metrics) for row in result]
+        else:
+            statement, weather = stats_statement(group_by, metrics, db.engine.dialect.name)
+            result = db.session.execute(statement, with_station() if weather else {})
+            with phase("fetch"):
+                groups = [group_values(row) for row in result]
+        with phase("serialize"):
+            cached = (json.dumps(groups, separators=(",", ":")).encode(), len(groups))
+        cache.set(cache_key, version, cached)
+
+    serialized, rows = cached
+    count_rows(rows)
+    compression.cache_compressed(cache, cache_key, version)
+    return set_validators(Response(serialized, mimetype='application/json'), etag, last_updated)
+
+
 @api_bp.route("counts/closest", methods=['GET'])
-def closest(sql_query=sql_query):
-    '''Return 5 closest counts to given lat/lon location.'''
+def closest():
+    '''
+    Return the k (default 5) closest counts to given lat/lon location, optionally within a radius,
+    with their distance in metres.
+    '''
     if request.method == 'GET':
         lon = request.args.get("lon")
         lat = request.args.get("lat")
+        k = request.args.get("k")
+        radius = request.args.get("radius")
 
         if not lat or not lon:
             return jsonify({"error": "You must supply a longitude and a latitude."}), 400
@@ -368,28 +1110,122 @@ def closest(sql_query=sql_query):
         except ValueError:
             return jsonify({"error": f"{lat} is not a valid longitude"}), 400
 
-        sql_query += f'''
-            ORDER BY
-            b.geom <->'SRID=4326;POINT({lon} {lat})'::geometry
-            LIMIT 5;
-            '''
-        
-        result = db.session.execute(text(sql_query)).fetchall()
+        if not -90 <= lat <= 90:
+            return jsonify({"error": "lat must be between -90 and 90."}), 400
+        if not -180 <= lon <= 180:
+            return jsonify({"error": "lon must be between -180 and 180."}), 400
+
+        if k:
+            try:
+                k = int(k)
+            except ValueError:
+                return jsonify({"error": "k must be an integer."}), 400
+            if not 0 < k <= MAX_CLOSEST:
+                return jsonify({"error": f"k must be between 1 and {MAX_CLOSEST}."}), 400
+        else:
+            k = 5
+
+        if radius:
+            try:
+                radius = float(radius)
+            except ValueError:
+                return jsonify({"error": "radius must be a number of metres."}), 400
+            if radius <= 0:
+                return jsonify({"error": "radius must be greater than 0."}), 400
+        else:
+            radius = None
+
+        try:
+            fields = parse_fields(request.args.get("fields"), FIELDS + ("distance",))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        if spatial_index.enabled(db.engine.dialect.name):
+            return closest_from_index(lat, lon, k, radius, fields)
+
+        statement = closest_statement(k, bool(radius), fields)
+        bind_params = with_station({"lon": lon, "lat": lat})
+        if radius:
+            bind_params["radius"] = radius
+
+        if wants_stream():
+            response = stream_response(statement, bind_params, fields)
+            if response is None:
+                return jsonify({"error": "No matching records found."}), 404
+            return response
+
+        result = prepared.execute(db.session, statement, bind_params)
+        with phase("fetch"):
+            result = result.fetchall()
+        count_rows(len(result))
 
         if len(result):
-            serialized = json.dumps([dict(r) for r in result], default=alchemyencoder)
+            with phase("serialize"):
+                serialized = serializer_for(result[0].keys()).rows(result)
             return Response(serialized, mimetype='application/json')
         else:
             return jsonify({"error": "No matching records found."}), 404
 
 
+def closest_from_index(lat, lon, k, radius, fields=None):
+    '''
+    Respond to closest() from the in-process spatial index, for databases without PostGIS (or
+    when SPATIAL_INDEX is set), fetching only the k nearest counts from the database, with fields
+    (all if None).
+    '''
+    neighbours = spatial_index.get(db.session).nearest(lat, lon, k, radius)
+    if not neighbours:
+        return jsonify({"error": "No matching records found."}), 404
+
+    columns = None if fields is None else tuple(name for name in fields if name != "distance")
+    with_distance = fields is None or "distance" in fields
+    result = db.session.execute(closest_from_index_statement(columns),
+                                with_station({"recordnums": [rn for rn, _ in neighbours]}))
+    # without recordnum, which is only selected to match rows up with neighbours
+    keys = list(FIELDS if columns is None else columns)
+    with phase("fetch"):
+        rows = {row["recordnum"]: tuple(row)[:len(keys)] for row in result}
+    if with_distance:
+        keys.append("distance")
+
+    # rows are returned in order of distance, skipping any deleted since the index was built
+    results = [rows[rn] + (distance,) if with_distance else rows[rn]
+               for rn, distance in neighbours if rn in rows]
+    count_rows(len(results))
+    if not results:
+        return jsonify({"error": "No matching records found."}), 404
+
+    serializer = serializer_for(keys)
+    with phase("serialize"):
+        if wants_stream():
+            return Response("".join([serializer.row(r) + "\n" for r in results]),
+                            mimetype='application/x-ndjson')
+        return Response(serializer.rows(results), mimetype='application/json')
+
+
 @api_bp.route("facilities", methods=['GET'])
 def facilities():
-    '''Return list of all facilities.'''
-    try:
-        result = db.session.query(BicycleCount.bikepedfac).distinct().all()
-    except NoResultFound:
-        return jsonify({"error": "No facilities found."}), 404
+    '''
+    Return list of all facilities: FACILITIES, the ones counts are validated against, so no
+    query is made.
+    '''
+    etag = make_etag("facilities", FACILITIES)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    count_rows(len(FACILITIES))
+    return set_validators(jsonify(list(FACILITIES)), etag)
 
-    result = [row[0] for row in result if row[0]]
-    return jsonify(result)
+
+@api_bp.route("admin/pool", methods=['GET'])
+@token_required("ADMIN_TOKEN")
+def pool():
+    '''
+    Return the state of the database connection pool of the worker process that handles the
+    request, with counts of checkouts and histograms of the time spent waiting for and opening
+    connections. Only with the ADMIN_TOKEN, and not found unless it is set (see auth.py).
+    '''
+    response = jsonify(pool_metrics.snapshot(db.engine))
+    response.headers["Cache-Control"] = "no-store"
+    return response
@@ -0,0 +1,32 @@
+'''
+Access to endpoints that report the internals of a worker process, which aren't for the public.
+
+Each is enabled by a config value holding a token: while it is None (the default) the endpoint
+responds 404, as if it didn't exist, and once it is set requests must send the token in an
+"Authorization: Bearer <token>" header, or get a 401.
+'''
+import functools
+import hmac
+
+from flask import abort, current_app, jsonify, request
+
+
+def token_required(config_name):
+    '''Decorate a view so that it needs the token in the config value config_name.'''
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            token = current_app.config.get(config_name)
+            if not token:
+                abort(404)
+            # compared in constant time, so the token can't be guessed from response times
+            expected = f"Bearer {token}".encode()
+            if not hmac.compare_digest(request.headers.get("Authorization", "").encode(),
+                                       expected):
+                response = jsonify({"error": "Missing or invalid token."})
+                response.headers["WWW-Authenticate"] = "Bearer"
+                return response, 401
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,163 @@
+'''
+Cache of encoded responses for the read endpoints.
+
+Entries are stored under the current table version, a counter in the data_version table that the
+write handlers and commands bump in the transaction of every change to the counts or weather.
+Bumping the version makes every existing entry unreachable at once; the orphaned entries are then
+evicted by the backend's LRU/TTL policy. As the version is read from the database (once per
+request), a write committed by any worker process invalidates the entries of every worker, with
+either backend.
+
+The backend is chosen with the CACHE_TYPE config value:
+
+- "simple" (default): an in-process LRU cache with per-entry TTL. Each worker process has its own
+  entries.
+- "redis": a cache shared by all worker processes, in Redis at CACHE_REDIS_URL. Eviction is left
+  to the entry TTL and the server's maxmemory-policy (use allkeys-lru).
+- "null": caching disabled.
+'''
+import collections
+import pickle
+import threading
+import time
+from datetime import datetime, timezone
+
+from flask import current_app, g
+from sqlalchemy import text
+
+version_statement = text("SELECT version, updated FROM data_version WHERE id = 1")
+bump_version_statement = text(
+    "UPDATE data_version SET version = version + 1, updated = :updated WHERE id = 1")
+
+
+class SimpleCache:
+    '''In-process LRU cache with per-entry TTL, safe to use from the threads of one worker.'''
+
+    def __init__(self, max_entries=256, default_timeout=300):
+        self.max_entries = max_entries
+        self.default_timeout = default_timeout
+        self._entries = collections.OrderedDict()  # key -> (expires, value), oldest use first
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._entries[key]
+            except KeyError:
+                return None
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        if not self.max_entries:
+            return
+        expires = time.monotonic() + (timeout or self.default_timeout)
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCache:
+    '''
+    Cache shared between worker processes. client is a redis.Redis instance, or anything else
+    with the same get() and set(ex=) methods.
+    '''
+
+    def __init__(self, client, key_prefix="bicycles:", default_timeout=300):
+        self.client = client
+        self.key_prefix = key_prefix
+        self.default_timeout = default_timeout
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        import redis  # only needed for this backend
+
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def get(self, key):
+        value = self.client.get(self.key_prefix + key)
+        if value is None:
+            return None
+        return pickle.loads(value)
+
+    def set(self, key, value, timeout=None):
+        self.client.set(self.key_prefix + key, pickle.dumps(value),
+                        ex=timeout or self.default_timeout)
+
+
+class ResponseCache:
+    '''Flask extension giving access to the configured cache backend of the current app.'''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("CACHE_TYPE", "simple")
+        app.config.setdefault("CACHE_MAX_ENTRIES", 256)
+        app.config.setdefault("CACHE_DEFAULT_TIMEOUT", 300)
+        app.config.setdefault("CACHE_REDIS_URL", "redis://localhost:6379/0")
+
+        cache_type = app.config["CACHE_TYPE"]
+        timeout = app.config["CACHE_DEFAULT_TIMEOUT"]
+
+        if cache_type == "simple":
+            backend = SimpleCache(app.config["CACHE_MAX_ENTRIES"], timeout)
+        elif cache_type == "redis":
+            backend = RedisCache.from_url(app.config["CACHE_REDIS_URL"], default_timeout=timeout)
+        elif cache_type == "null":
+            backend = SimpleCache(max_entries=0)
+        else:
+            raise ValueError(f"Unknown CACHE_TYPE: {cache_type}")
+
+        app.extensions["response_cache"] = backend
+
+        @app.before_request
+        def forget_version():
+            g.pop("data_version", None)
+
+    @property
+    def backend(self):
+        return current_app.extensions["response_cache"]
+
+    @staticmethod
+    def _session():
+        return current_app.extensions["sqlalchemy"].db.session
+
+    def _version_row(self):
+        if "data_version" not in g:
+            row = self._session().execute(version_statement).fetchone()
+            g.data_version = tuple(row) if row else (0, None)
+        return g.data_version
+
+    def get_version(self):
+        '''Return the current table version, read from the database once per request.'''
+        return self._version_row()[0]
+
+    def last_modified(self):
+        '''Return when the table version was last bumped, or None if it never was.'''
+        return self._version_row()[1]
+
+    def bump_version(self):
+        '''
+        Invalidate all cached responses; called in the transaction of every write to the counts
+        or weather, before it is committed, so that the new version is seen with the new rows.
+        '''
+        self._session().execute(bump_version_statement, {"updated": datetime.now(timezone.utc)})
+        g.pop("data_version", None)
+
+    def get(self, key, version):
+        '''Return the value cached under key for the given table version, or None.'''
+        return self.backend.get(f"{version}:{key}")
+
+    def set(self, key, version, value, timeout=None):
+        self.backend.set(f"{version}:{key}", value, timeout)
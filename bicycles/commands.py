@@ -0,0 +1,662 @@
+'''Flask CLI commands for managing the database. Registered on the app in create_app().'''
+import csv
+import datetime
+import io
+import time
+import uuid
+
+import click
+from flask.cli import AppGroup, with_appcontext
+from sqlalchemy import bindparam, inspect, text, types
+
+from bicycles import db, cache
+from . import rollups
+from .api import check_params, check_required_fields, recordnums_in
+from .models import BicycleCount, CountRollup, Weather
+
+indexes_cli = AppGroup("indexes", help="Create and verify the indexes the API depends on.")
+rollups_cli = AppGroup("rollups", help="Rebuild and verify the rollups of counts/stats.")
+
+# Indexes needed by the queries in api.py, with the statement that creates each one per dialect.
+# An index without a statement for a dialect is not used (or not possible) there. Primary keys
+# are verified but never created.
+INDEXES = [
+    {
+        'name': 'ix_bicycle_count_setdate_recordnum',
+        'table': 'bicycle_count',
+        'columns': ['setdate', 'recordnum'],
+        'query': 'counts(): ORDER BY b.setdate, b.recordnum, and the keyset pagination cursor',
+        'postgresql': 'CREATE INDEX {name} ON bicycle_count (setdate, recordnum)',
+        'mysql': 'CREATE INDEX {name} ON bicycle_count (SETDate, RecordNum)',
+        'sqlite': 'CREATE INDEX {name} ON bicycle_count (setdate, recordnum)',
+    },
+    {
+        'name': 'ix_bicycle_count_set_date',
+        'table': 'bicycle_count',
+        'columns': ['set_date'],
+        'query': 'count(), counts(), closest(): LEFT JOIN weather w ON b.set_date = w.date ...',
+        'postgresql': 'CREATE INDEX {name} ON bicycle_count (set_date)',
+        'mysql': 'CREATE INDEX {name} ON bicycle_count (Set_Date)',
+        'sqlite': 'CREATE INDEX {name} ON bicycle_count (set_date)',
+    },
+    {
+        'name': 'ix_bicycle_count_bikepedfac',
+        'table': 'bicycle_count',
+        'columns': ['bikepedfac'],
+        'query': 'counts(): WHERE b.bikepedfac = ...',
+        'postgresql': 'CREATE INDEX {name} ON bicycle_count (bikepedfac)',
+        # TEXT columns can only be indexed on a prefix in MySQL
+        'mysql': 'CREATE INDEX {name} ON bicycle_count (BikePedFac(64))',
+        'sqlite': 'CREATE INDEX {name} ON bicycle_count (bikepedfac)',
+    },
+    {
+        'name': 'ix_bicycle_count_geom',
+        'table': 'bicycle_count',
+        'columns': ['geom'],
+        'query': 'closest(): ORDER BY b.geom <-> point (PostGIS only)',
+        'postgresql': 'CREATE INDEX {name} ON bicycle_count USING gist (geom)',
+    },
+    {
+        'name': 'primary key',
+        'table': 'weather',
+        'columns': ['station', 'date'],
+        'query': 'count(), counts(), closest(): ... AND w.station = :weather_station; '
+                 'load-weather: ON CONFLICT (station, date)',
+        'primary_key': True,
+    },
+]
+
+
+def applicable_indexes(dialect):
+    '''Return the indexes that are used with the given dialect.'''
+    return [index for index in INDEXES if index.get('primary_key') or index.get(dialect)]
+
+
+def existing_indexes():
+    '''Return the names of the (non primary key) indexes of each table, keyed by table.'''
+    inspector = inspect(db.engine)
+    return {table: {index['name'] for index in inspector.get_indexes(table)}
+            for table in ('bicycle_count', 'weather')}
+
+
+def index_scans():
+    '''
+    Return the number of times each index has been used since statistics were last reset, keyed
+    by index name, or an empty dict if the database does not provide this.
+    '''
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        sql = ("SELECT indexrelname, idx_scan FROM pg_stat_user_indexes "
+               "WHERE relname IN ('bicycle_count', 'weather')")
+    elif dialect == 'mysql':
+        sql = ("SELECT index_name, count_star FROM performance_schema."
+               "table_io_waits_summary_by_index_usage WHERE object_schema = DATABASE() "
+               "AND object_name IN ('bicycle_count', 'weather') AND index_name IS NOT NULL")
+    else:
+        return {}
+    return {name: scans for name, scans in db.session.execute(text(sql))}
+
+
+def missing_indexes():
+    '''Return the indexes used with the current dialect that are missing from the database.'''
+    existing = existing_indexes()
+    inspector = inspect(db.engine)
+    missing = []
+    for index in applicable_indexes(db.engine.dialect.name):
+        if index.get('primary_key'):
+            primary_key = inspector.get_pk_constraint(index['table'])['constrained_columns']
+            if [column.lower() for column in primary_key] != index['columns']:
+                missing.append(index)
+        elif index['name'] not in existing[index['table']]:
+            missing.append(index)
+    return missing
+
+
+@indexes_cli.command("check")
+def check_indexes():
+    '''
+    Report which indexes are missing, unused, or present but not managed here. Exits with status 1
+    if any are missing.
+    '''
+    dialect = db.engine.dialect.name
+    indexes = applicable_indexes(dialect)
+    missing = missing_indexes()
+    scans = index_scans()
+
+    for index in indexes:
+        if index in missing:
+            status = 'MISSING'
+        elif index.get('primary_key') or index['name'] not in scans:
+            status = 'ok'
+        elif scans[index['name']] == 0:
+            status = 'UNUSED'
+        else:
+            status = f"ok ({scans[index['name']]} scans)"
+        click.echo(f"{index['table']}.{index['name']}: {status}")
+        click.echo(f"    {index['query']}")
+
+    managed = {index['name'] for index in indexes}
+    for table, names in existing_indexes().items():
+        for name in sorted(names - managed):
+            click.echo(f"{table}.{name}: not managed by this command")
+
+    if missing:
+        raise SystemExit(1)
+
+
+@indexes_cli.command("create")
+def create_indexes():
+    '''Create any missing indexes.'''
+    dialect = db.engine.dialect.name
+    missing = missing_indexes()
+
+    for index in missing:
+        if index.get('primary_key'):
+            click.echo(f"{index['table']} has no primary key on {', '.join(index['columns'])}; "
+                       "fix the table definition", err=True)
+            continue
+        click.echo(f"creating {index['table']}.{index['name']}")
+        db.session.execute(text(index[dialect].format(name=index['name'])))
+        db.session.commit()
+
+    if not missing:
+        click.echo("All indexes present.")
+
+
+@rollups_cli.command("check")
+def check_rollups():
+    '''
+    Report the groups whose rollup differs from the counts in bicycle_count. Exits with status 1
+    if any do.
+    '''
+    differences = rollups.differences()
+    for group, expected, stored in differences:
+        click.echo(f"{dict(zip(rollups.DIMENSIONS, group))}: counts, aadb counts and aadb sum "
+                   f"are {stored}, should be {expected}")
+
+    if differences:
+        click.echo(f"{len(differences)} groups differ; run flask rollups rebuild", err=True)
+        raise SystemExit(1)
+    click.echo("Rollups match the counts.")
+
+
+@rollups_cli.command("rebuild")
+def rebuild_rollups():
+    '''Create the rollups table if it doesn't exist, and recompute the rollups of all counts.'''
+    CountRollup.__table__.create(db.engine, checkfirst=True)
+    groups = rollups.rebuild()
+    cache.bump_version()
+    db.session.commit()
+    click.echo(f"Rebuilt the rollups of {groups} groups.")
+
+
+def parse_timestamp(value):
+    '''Parse an ISO 8601 timestamp, such as 2018-03-29T00:00:00.000Z in ArcGIS exports.'''
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    return datetime.datetime.fromisoformat(value)
+
+
+# columns that can be loaded from a CSV, with the function converting each one's text and the
+# error if it can't. geom and set_date are always derived from the other columns.
+LOAD_COLUMNS = {}
+for column in BicycleCount.__table__.c:
+    if column.name in ("geom", "set_date"):
+        continue
+    if isinstance(column.type, types.Integer):
+        LOAD_COLUMNS[column.name] = (int, "must be an integer")
+    elif isinstance(column.type, types.Numeric):
+        LOAD_COLUMNS[column.name] = (float, "must be a float")
+    elif isinstance(column.type, types.DateTime):
+        LOAD_COLUMNS[column.name] = (parse_timestamp, "must be an ISO 8601 timestamp")
+    else:
+        LOAD_COLUMNS[column.name] = (str, None)
+
+# columns checked by check_params() rather than by conversion alone
+TIMESTAMP_COLUMNS = ("setdate", "updated")
+
+
+def normalize_header(header):
+    '''Return the column names of a CSV header, e.g. from ArcGIS (SETDATE, BIKEPEDFAC, ...).'''
+    return [name.strip().lstrip("\ufeff").lower() for name in header]
+
+
+def convert_count(header, converters, cells):
+    '''
+    Convert the cells of a CSV row, under header, to the column values of a count with converters
+    (from LOAD_COLUMNS, in the order of header) and check them by the same rules as the API.
+    Returns (values, errors). Empty cells are NULL.
+    '''
+    params = {}
+    errors = []
+    for name, (convert, error), value in zip(header, converters, cells):
+        if not value or value.isspace():
+            continue
+        if convert is str:
+            params[name] = value
+            continue
+        try:
+            params[name] = convert(value)
+        except ValueError:
+            errors.append(f"{name} {error}")
+
+    # check_params() wants setdate as YYYY-MM-DD, so timestamps are only checked by conversion
+    missing_params = check_required_fields(params)
+    unknown_params, bad_params = check_params(
+        {k: v for k, v in params.items() if k not in TIMESTAMP_COLUMNS})
+    if missing_params:
+        errors.append("Missing required parameters: " + ", ".join(missing_params))
+    errors.extend(bad_params)
+    if errors:
+        return None, errors
+
+    values = dict.fromkeys(header)
+    values.update(params)
+    values["setyear"] = values.get("setyear") or values["setdate"].year
+    values["set_date"] = values["setdate"].date()
+    values["globalid"] = values.get("globalid") or str(uuid.uuid4())
+    values["updated"] = (values.get("updated")
+                         or datetime.datetime.now(datetime.timezone.utc))
+    return values, []
+
+
+def copy_counts(columns, rows):
+    '''
+    Copy rows of values of columns, and the line of the file each is from, into the count_staging
+    table with COPY (PostgreSQL).
+    '''
+    columns = columns + ["load_line"]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row[column] for column in columns])
+    buffer.seek(0)
+
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(f"COPY count_staging ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+                       buffer)
+
+
+def upsert_statement(columns):
+    '''
+    Return the statement inserting a count with values of columns, replacing any count with the
+    same recordnum, for executemany() on MySQL or SQLite.
+    '''
+    names = ", ".join(columns)
+    placeholders = ", ".join(":" + column for column in columns)
+    sql = f"INSERT INTO bicycle_count ({names}) VALUES ({placeholders})"
+    if "recordnum" in columns:
+        updates = [column for column in columns if column != "recordnum"]
+        if db.engine.dialect.name == "mysql":
+            sql += (" ON DUPLICATE KEY UPDATE "
+                    + ", ".join(f"{column} = VALUES({column})" for column in updates))
+        else:
+            sql += (" ON CONFLICT (recordnum) DO UPDATE SET "
+                    + ", ".join(f"{column} = excluded.{column}" for column in updates))
+    table = BicycleCount.__table__
+    return text(sql).bindparams(*[bindparam(column, type_=table.c[column].type)
+                                  for column in columns])
+
+
+def merge_staged_counts(columns, deltas):
+    '''
+    Merge the counts in count_staging into bicycle_count, computing geom, replacing counts with the
+    same recordnum (PostgreSQL). Of counts with the same recordnum in the file, the last is kept;
+    counts without one are numbered by the sequence. The groups of the counts replaced and merged
+    are added to deltas, the changes to the rollups (those of counts without a recordnum already
+    are).
+    '''
+    def insert_sql(names):
+        names = ", ".join(names)
+        return (f"INSERT INTO bicycle_count ({names}, geom) "
+                f"SELECT {names}, ST_SetSRID(ST_MakePoint(longitude, latitude), 4326) "
+                "FROM count_staging")
+
+    if "recordnum" in columns:
+        merged = rollups.grouped_sql(
+            "postgresql", where="WHERE b.recordnum IN (SELECT recordnum FROM count_staging)")
+        if rollups.enabled():
+            deltas.add_rows(db.session.execute(text(merged)), -1)
+
+        # DISTINCT ON would keep one of the counts without a recordnum, so they are left out
+        db.session.execute(text(
+            insert_sql(columns).replace("SELECT", "SELECT DISTINCT ON (recordnum)", 1)
+            + " WHERE recordnum IS NOT NULL ORDER BY recordnum, load_line DESC"
+            " ON CONFLICT (recordnum) DO UPDATE SET "
+            + ", ".join(f"{column} = EXCLUDED.{column}"
+                        for column in columns + ["geom"] if column != "recordnum")))
+
+        # move the sequence past the loaded recordnums, so new counts don't collide with them
+        db.session.execute(text(
+            "SELECT setval(pg_get_serial_sequence('bicycle_count', 'recordnum'), "
+            "MAX(recordnum)) FROM bicycle_count"))
+
+        if rollups.enabled():
+            deltas.add_rows(db.session.execute(text(merged)))
+
+    # counts without a recordnum, inserted without the column so that the sequence numbers them
+    db.session.execute(text(
+        insert_sql([column for column in columns if column != "recordnum"])
+        + (" WHERE recordnum IS NULL" if "recordnum" in columns else "")
+        + " ORDER BY load_line"))
+
+
+@click.command("load-counts")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--batch-size", default=10000, show_default=True,
+              help="Number of counts sent to the database at a time.")
+@click.option("--rejects", type=click.Path(dir_okay=False, writable=True),
+              help="Write rejected lines to this CSV file, with their errors.")
+@with_appcontext
+def load_counts(path, batch_size, rejects):
+    '''
+    Load bicycle counts from a CSV file, such as data/bicycle_counts.csv, checking each one by the
+    same rules as the API. Counts with the recordnum of an existing count, or of an earlier line,
+    replace it. Lines with errors are reported and skipped; the other counts are loaded in one
+    transaction.
+
+    On PostgreSQL the counts are copied into a staging table with COPY and then merged into
+    bicycle_count with one statement, which computes geom. Elsewhere they are inserted with
+    executemany(), batch-size counts at a time. The rollups are updated in the same transaction.
+    '''
+    start = time.perf_counter()
+    postgresql = db.engine.dialect.name == "postgresql"
+
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.reader(f)
+        try:
+            header = normalize_header(next(reader))
+        except StopIteration:
+            raise click.ClickException(f"{path} is empty")
+
+        unknown = [name for name in header if name not in LOAD_COLUMNS]
+        if unknown:
+            raise click.ClickException("Unknown column(s): " + ", ".join(unknown))
+
+        converters = [LOAD_COLUMNS[name] for name in header]
+        columns = header + [column for column in ("setyear", "set_date", "globalid", "updated")
+                            if column not in header]
+
+        if postgresql:
+            db.session.execute(text(
+                f"CREATE TEMP TABLE count_staging ON COMMIT DROP AS "
+                f"SELECT {', '.join(columns)}, 0 AS load_line FROM bicycle_count WITH NO DATA"))
+            write = copy_counts
+        else:
+            statement = upsert_statement(columns)
+            replaced_sql = rollups.grouped_sql(db.engine.dialect.name,
+                                               where="WHERE b.recordnum IN :recordnums")
+
+            def write(columns, rows):
+                if rollups.enabled():
+                    # counts replaced by the batch leave their groups, and of counts with the
+                    # same recordnum in it only the last is written
+                    last = {row["recordnum"]: row for row in rows
+                            if row.get("recordnum") is not None}
+                    deltas.add_rows(recordnums_in(last, replaced_sql), -1)
+                    for row in last.values():
+                        deltas.add(row)
+                db.session.execute(statement, rows)
+
+        reject_writer = None
+        if rejects:
+            rejects_file = open(rejects, "w", newline="")
+            reject_writer = csv.writer(rejects_file)
+            reject_writer.writerow(["line", "errors"] + header)
+
+        loaded = rejected = replaced = 0
+        recordnums = set()
+        # changes to the rollups: counts without a recordnum are new, and the groups of counts
+        # with one are looked up in the database, as they may replace other counts
+        deltas = rollups.Deltas()
+        batch = []
+        try:
+            # line numbers count the header as line 1
+            for line_number, cells in enumerate(reader, 2):
+                if len(cells) != len(header):
+                    values, errors = None, [f"expected {len(header)} fields, got {len(cells)}"]
+                else:
+                    values, errors = convert_count(header, converters, cells)
+
+                if errors:
+                    rejected += 1
+                    if reject_writer:
+                        reject_writer.writerow([line_number, "; ".join(errors)] + cells)
+                    elif rejected <= 10:
+                        click.echo(f"line {line_number}: {'; '.join(errors)}", err=True)
+                    continue
+
+                if values.get("recordnum") is not None:
+                    if values["recordnum"] in recordnums:
+                        replaced += 1
+                    recordnums.add(values["recordnum"])
+
+                values["load_line"] = line_number
+                batch.append(values)
+                if values.get("recordnum") is None and rollups.enabled():
+                    deltas.add(values)
+                if len(batch) == batch_size:
+                    write(columns, batch)
+                    loaded += len(batch)
+                    batch = []
+
+            if batch:
+                write(columns, batch)
+                loaded += len(batch)
+
+            if postgresql:
+                merge_staged_counts(columns, deltas)
+            deltas.apply()
+            cache.bump_version()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            if reject_writer:
+                rejects_file.close()
+
+    elapsed = time.perf_counter() - start
+    click.echo(f"Loaded {loaded} counts in {elapsed:.2f}s ({loaded / elapsed:.0f} counts/s).")
+    if replaced:
+        click.echo(f"{replaced} of them replaced an earlier line with the same recordnum.")
+    if rejected:
+        more = "" if reject_writer or rejected <= 10 else " (first 10 shown above)"
+        click.echo(f"Rejected {rejected} lines{more}.", err=True)
+
+
+# columns of NOAA daily summary CSVs that are loaded, with the function converting each one's text
+# and the error if it can't. Other columns (e.g. SNOW, AWND, *_ATTRIBUTES) are ignored.
+WEATHER_COLUMNS = {
+    "station": (str, None),
+    "name": (str, None),
+    "date": (datetime.date.fromisoformat, "must be a date in the format YYYY-MM-DD"),
+    "prcp": (float, "must be a float"),
+    "tavg": (int, "must be an integer"),
+    "tmax": (int, "must be an integer"),
+    "tmin": (int, "must be an integer"),
+}
+
+# the natural key of weather
+WEATHER_KEY = ("station", "date")
+
+
+def convert_weather(header, cells):
+    '''
+    Convert the cells of a CSV row, under header, to the column values of weather. Returns
+    (values, errors). Empty cells, and columns missing from the file, are NULL.
+    '''
+    values = dict.fromkeys(WEATHER_COLUMNS)
+    errors = []
+    invalid = set()
+    for name, value in zip(header, cells):
+        if name not in WEATHER_COLUMNS or not value or value.isspace():
+            continue
+        convert, error = WEATHER_COLUMNS[name]
+        try:
+            values[name] = convert(value)
+        except ValueError:
+            errors.append(f"{name} {error}")
+            invalid.add(name)
+
+    errors.extend(f"{name} is required" for name in WEATHER_KEY
+                  if values[name] is None and name not in invalid)
+    return (None, errors) if errors else (values, [])
+
+
+def weather_upsert_sql(source):
+    '''
+    Return the INSERT ... ON CONFLICT DO UPDATE statement (PostgreSQL and SQLite) that upserts
+    weather from source, a VALUES or SELECT clause, leaving rows whose values haven't changed
+    untouched.
+    '''
+    columns = list(WEATHER_COLUMNS)
+    values = [column for column in columns if column not in WEATHER_KEY]
+    return (f"INSERT INTO weather ({', '.join(columns)}, updated) {source} "
+            "ON CONFLICT (station, date) DO UPDATE SET "
+            + ", ".join(f"{column} = excluded.{column}" for column in values)
+            + ", updated = excluded.updated WHERE "
+            + " OR ".join(f"weather.{column} IS DISTINCT FROM excluded.{column}"
+                          for column in values))
+
+
+def copy_weather(rows):
+    '''
+    Copy rows of weather, and the order they were read in, into the weather_staging table with
+    COPY (PostgreSQL).
+    '''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row[column] for column in WEATHER_COLUMNS] + [row["load_line"]])
+    buffer.seek(0)
+
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(f"COPY weather_staging ({', '.join(WEATHER_COLUMNS)}, load_line) "
+                       "FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def merge_staged_weather():
+    '''
+    Upsert the weather in weather_staging, keeping the last row read of each station and date,
+    and return the number of rows inserted or changed (PostgreSQL).
+    '''
+    names = ", ".join(WEATHER_COLUMNS)
+    source = (f"SELECT DISTINCT ON (station, date) {names}, CURRENT_TIMESTAMP "
+              "FROM weather_staging ORDER BY station, date, load_line DESC")
+    return db.session.execute(text(weather_upsert_sql(source))).rowcount
+
+
+def upsert_weather(rows):
+    '''
+    Upsert rows of weather with executemany() (MySQL and SQLite), leaving rows whose values
+    haven't changed untouched. Returns the number of rows inserted or changed, or None on MySQL,
+    which doesn't tell.
+    '''
+    columns = list(WEATHER_COLUMNS)
+    source = f"VALUES ({', '.join(':' + column for column in columns)}, CURRENT_TIMESTAMP)"
+
+    if db.engine.dialect.name == "mysql":
+        # MySQL leaves identical rows untouched itself. updated is assigned first, while the other
+        # columns still hold their old values.
+        values = [column for column in columns if column not in WEATHER_KEY]
+        unchanged = " AND ".join(f"{column} <=> VALUES({column})" for column in values)
+        sql = (f"INSERT INTO weather ({', '.join(columns)}, updated) {source} "
+               f"ON DUPLICATE KEY UPDATE updated = IF({unchanged}, updated, CURRENT_TIMESTAMP), "
+               + ", ".join(f"{column} = VALUES({column})" for column in values))
+    else:
+        # SQLite has no IS DISTINCT FROM, but its IS NOT is the same
+        sql = weather_upsert_sql(source).replace("IS DISTINCT FROM", "IS NOT")
+
+    table = Weather.__table__
+    statement = text(sql).bindparams(*[bindparam(column, type_=table.c[column].type)
+                                       for column in columns])
+    result = db.session.execute(statement, rows)
+    return None if db.engine.dialect.name == "mysql" else result.rowcount
+
+
+@click.command("load-weather")
+@click.argument("paths", nargs=-1, required=True,
+                type=click.Path(exists=True, dir_okay=False))
+@click.option("--batch-size", default=10000, show_default=True,
+              help="Number of rows sent to the database at a time.")
+@with_appcontext
+def load_weather(paths, batch_size):
+    '''
+    Load NOAA daily summaries (GHCN-Daily CSV files, from
+    https://www.ncei.noaa.gov/cdo-web/) of any number of stations and years into weather. Rows
+    are inserted, or update the row of the same station and date if their values have changed,
+    so files can be loaded again to refresh the data. Lines with errors are reported and
+    skipped; the other rows are loaded in one transaction.
+
+    On PostgreSQL rows are copied into a staging table with COPY and then upserted by one
+    INSERT ... ON CONFLICT DO UPDATE ... WHERE ... IS DISTINCT FROM. Elsewhere they are upserted
+    with executemany(), batch-size rows at a time.
+    '''
+    start = time.perf_counter()
+    postgresql = db.engine.dialect.name == "postgresql"
+    read = rejected = 0
+    changed = []
+
+    if postgresql:
+        db.session.execute(text(
+            f"CREATE TEMP TABLE weather_staging ON COMMIT DROP AS "
+            f"SELECT {', '.join(WEATHER_COLUMNS)}, 0 AS load_line FROM weather WITH NO DATA"))
+        write = copy_weather
+    else:
+        def write(batch):
+            # a statement can't insert and then update the same row, so only the last row of a
+            # station and date in a batch is kept
+            batch = list({(row["station"], row["date"]): row for row in batch}.values())
+            changed.append(upsert_weather(batch))
+
+    try:
+        for path in paths:
+            with open(path, newline="", encoding="utf-8-sig") as f:
+                reader = csv.reader(f)
+                try:
+                    header = normalize_header(next(reader))
+                except StopIteration:
+                    continue
+
+                missing = [name for name in WEATHER_KEY if name not in header]
+                if missing:
+                    raise click.ClickException(f"{path} has no {', '.join(missing)} column")
+
+                batch = []
+                # line numbers count the header as line 1
+                for line_number, cells in enumerate(reader, 2):
+                    values, errors = convert_weather(header, cells)
+                    if errors:
+                        rejected += 1
+                        if rejected <= 10:
+                            click.echo(f"{path}, line {line_number}: {'; '.join(errors)}",
+                                       err=True)
+                        continue
+
+                    read += 1
+                    values["load_line"] = read
+                    batch.append(values)
+                    if len(batch) == batch_size:
+                        write(batch)
+                        batch = []
+
+                if batch:
+                    write(batch)
+
+        if postgresql:
+            changed.append(merge_staged_weather())
+        cache.bump_version()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    elapsed = time.perf_counter() - start
+    click.echo(f"Loaded {read} rows from {len(paths)} file(s) in {elapsed:.2f}s "
+               f"({read / elapsed:.0f} rows/s).")
+    if None not in changed:
+        click.echo(f"{sum(changed)} inserted or changed, {read - sum(changed)} unchanged.")
+    if rejected:
+        more = " (first 10 shown above)" if rejected > 10 else ""
+        click.echo(f"Rejected {rejected} lines{more}.", err=True)
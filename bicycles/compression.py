@@ -0,0 +1,186 @@
+'''
+Compression of the JSON responses of the API with gzip, or brotli if it is installed, as the
+client accepts in its Accept-Encoding header. The counts are very repetitive (the same keys,
+counties and facilities on every row), so bodies shrink to a tenth or less of their size.
+
+Bodies of at least COMPRESSION_MIN_SIZE bytes are compressed whole. Streamed responses, whose
+size isn't known in advance, are always compressed, one chunk of rows at a time and flushed after
+each so that the client can decode rows as they arrive.
+
+Every response that could be compressed, and every 304 Not Modified standing for one, carries
+Vary: Accept-Encoding, so that shared caches keep a copy per encoding.
+
+A handler serving a body from the response cache can have its compressed bodies cached next to
+it with cache_compressed(), so that a cache hit doesn't compress it again.
+
+Config values:
+
+- COMPRESSION: compress responses (default True)
+- COMPRESSION_MIN_SIZE: smallest body compressed, in bytes (default 1024); below a packet or so
+  the time spent compressing saves nothing
+- COMPRESSION_LEVEL: gzip level, from 1 (fastest) to 9 (smallest) (default 6)
+- BROTLI_LEVEL: brotli quality, from 0 (fastest) to 11 (smallest) (default 4)
+
+benchmarks/bench_compression.py measures the time and size of each level on counts.
+'''
+import zlib
+
+from flask import current_app, g, request
+
+from .timing import phase
+
+try:
+    import brotli
+except ImportError:  # optional, gzip only without it
+    brotli = None
+
+# media types of the responses that are compressed
+COMPRESSIBLE = frozenset(("application/json", "application/x-ndjson"))
+
+
+def available_encodings():
+    '''Return the encodings that can be used, the preferred one first.'''
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def negotiate(accept_encodings):
+    '''
+    Return the encoding to use for a client accepting accept_encodings (a werkzeug Accept), the
+    preferred one of those with the highest quality, or None to send the body as is.
+    '''
+    encoding, best = None, 0
+    for name in available_encodings():
+        quality = accept_encodings[name]
+        if quality > best:
+            encoding, best = name, quality
+    return encoding
+
+
+class Compressor:
+    '''Incremental compressor of one body in encoding ("br" or "gzip").'''
+
+    def __init__(self, encoding, level):
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=level)
+        else:
+            # wbits of 31 for the gzip header and trailer
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data, flush=False):
+        '''
+        Return the compressed data available after adding data, with flush all of it so far, at
+        the cost of a slightly larger body.
+        '''
+        if self.encoding == "br":
+            compressed = self._compressor.process(data)
+            return compressed + self._compressor.flush() if flush else compressed
+        compressed = self._compressor.compress(data)
+        return compressed + self._compressor.flush(zlib.Z_SYNC_FLUSH) if flush else compressed
+
+    def finish(self):
+        '''Return the rest of the compressed body.'''
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+def compression_level(encoding, config):
+    return config["BROTLI_LEVEL"] if encoding == "br" else config["COMPRESSION_LEVEL"]
+
+
+def compress(data, encoding, level):
+    '''Return data compressed in encoding at level.'''
+    compressor = Compressor(encoding, level)
+    return compressor.compress(data) + compressor.finish()
+
+
+def compress_chunks(chunks, encoding, level, timer):
+    '''
+    Compress the chunks of a streamed body, flushing after each, timed by timer (a phase created
+    in the request, as the chunks may be consumed without its context).
+    '''
+    compressor = Compressor(encoding, level)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            with timer:
+                compressed = compressor.compress(chunk, flush=True)
+            if compressed:
+                yield compressed
+        yield compressor.finish()
+    finally:
+        # close the wrapped body, so that its own cleanup (and metrics) still runs
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def cache_compressed(cache, key, version):
+    '''
+    Have the compressed bodies of the current response cached in cache (a ResponseCache), under
+    key and the encoding, for the table version; key must identify the uncompressed body.
+    '''
+    g.compression_cache = (cache, key, version)
+
+
+def compressed_body(response, encoding, level):
+    '''Return the body of response compressed, from the cache if cache_compressed() was called.'''
+    cached = g.get("compression_cache")
+    if cached is None:
+        return compress(response.get_data(), encoding, level)
+    cache, key, version = cached
+    key = f"{key}#{encoding}"
+    body = cache.get(key, version)
+    if body is None:
+        body = compress(response.get_data(), encoding, level)
+        cache.set(key, version, body)
+    return body
+
+
+class ResponseCompression:
+    '''
+    Flask extension compressing responses, registered with compress_response() as an
+    after_request function of the blueprints whose responses are compressed.
+    '''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("COMPRESSION", True)
+        app.config.setdefault("COMPRESSION_MIN_SIZE", 1024)
+        app.config.setdefault("COMPRESSION_LEVEL", 6)
+        app.config.setdefault("BROTLI_LEVEL", 4)
+
+    def compress_response(self, response):
+        '''Compress response in the encoding negotiated with the client, if it is worth it.'''
+        config = current_app.config
+        if config["COMPRESSION"] and response.status_code == 304:
+            # the 304 of a response stands for it in caches, so it varies on the same headers
+            response.vary.add("Accept-Encoding")
+            return response
+        if (not config["COMPRESSION"] or response.status_code != 200
+                or response.mimetype not in COMPRESSIBLE or "Content-Encoding" in response.headers):
+            return response
+
+        # the body depends on Accept-Encoding even when it isn't compressed, e.g. if too small
+        response.vary.add("Accept-Encoding")
+        if not response.is_streamed and len(response.get_data()) < config["COMPRESSION_MIN_SIZE"]:
+            return response
+        encoding = negotiate(request.accept_encodings)
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            level = compression_level(encoding, config)
+            response.response = compress_chunks(response.response, encoding, level,
+                                                phase("compress"))
+            response.headers.pop("Content-Length", None)
+        else:
+            with phase("compress"):
+                response.set_data(compressed_body(response, encoding,
+                                                  compression_level(encoding, config)))
+        response.headers["Content-Encoding"] = encoding
+        return response
@@ -1,5 +1,7 @@
 from flask import Blueprint, render_template
 
+from .validation import FACILITIES
+
 doc_bp = Blueprint('doc_bp', __name__)  # url prefix of api/documentation set in init
 
 
@@ -17,12 +19,19 @@ def documentation():
     intro['responses'] = {
         '200': 'OK',
         '201': 'Created',
+        '304': 'Not Modified',
         '400': 'Bad Request',
         '404': 'Not Found',
         '500': 'Internal Server Error',
     }
 
-    intro['bottom'] = "Additional details for Requests and Responses are provided for each Endpoint below."
+    intro['bottom'] = """
+        GET Responses for counts and facilities include an ETag header. Send it back in an
+        If-None-Match header to receive a 304 Not Modified Response, with no body, if the data has
+        not changed since. JSON Responses are compressed with gzip, or br (brotli), if the Request
+        accepts it in an Accept-Encoding header. Additional details for Requests and Responses are
+        provided for each Endpoint below.
+        """
 
     base_url = 'https://secret-coast-67195.herokuapp.com/api'
 
@@ -39,16 +48,29 @@ def documentation():
                             'type': 'path',
                             'required': True,
                             'content': 'Integer',
-                        }
+                        },
+                        {
+                            'name': 'fields',
+                            'type': 'query string',
+                            'required': False,
+                            'content': "Comma-separated fields to return of each count, e.g. "
+                                       "recordnum,latitude,longitude,aadb (default: all). Any "
+                                       "of the fields of counts and prcp, tavg, tmax, tmin",
+                        },
                     ],
                     'responses': [
                         {
                             'status_code': '200 OK',
                             'description': 'Success',
                         },
+                        {
+                            'status_code': '304 Not Modified',
+                            'description': 'Data unchanged since the ETag given in If-None-Match',
+                        },
                         {
                             'status_code': '400 Bad Request',
-                            'description': 'Provided recordnum is not an Integer',
+                            'description': 'Provided recordnum is not an Integer, or unknown '
+                                           'fields',
                         },
                         {
                             'status_code': '404 Not Found',
@@ -244,7 +266,8 @@ def documentation():
                             'name': 'bikepedfac',
                             'type': 'body',
                             'required': False,
-                            'content': 'String',
+                            'content': 'String, empty if not known',
+                            'possible_values': list(FACILITIES),
                         },
                     ],
                     'responses': [
@@ -306,26 +329,64 @@ def documentation():
                     'name': 'GET',
                     'description': 'Retrieve all counts in chronological order, optionally '
                                    'filtered by facility type (bikepedfac) and precipitation '
-                                   '(prcp) amount',
+                                   '(prcp) amount. When limit is provided, results are paged and '
+                                   'the URL of the next page is given in the Link header of the '
+                                   'Response (rel="next"); no Link header means the last page '
+                                   'has been reached',
                     'parameters': [
                         {
                             'name': 'bikepedfac',
                             'type': 'query string',
                             'required': False,
                             'content': "String",
+                            'possible_values': list(FACILITIES),
                         },
                         {
                             'name': 'prcp',
                             'type': 'query string',
                             'required': False,
                             'content': "Integer or Float"
-                        }
+                        },
+                        {
+                            'name': 'limit',
+                            'type': 'query string',
+                            'required': False,
+                            'content': "Integer, maximum number of counts per page (1 to 10000)",
+                        },
+                        {
+                            'name': 'after',
+                            'type': 'query string',
+                            'required': False,
+                            'content': "String, cursor taken from the Link header of the "
+                                       "previous page",
+                        },
+                        {
+                            'name': 'fields',
+                            'type': 'query string',
+                            'required': False,
+                            'content': "Comma-separated fields to return of each count, e.g. "
+                                       "recordnum,latitude,longitude,aadb (default: all). Any "
+                                       "of the fields of counts and prcp, tavg, tmax, tmin",
+                        },
+                        {
+                            'name': 'stream',
+                            'type': 'query string',
+                            'required': False,
+                            'content': "1, to stream counts as newline-delimited JSON (one count "
+                                       "per line) rather than a JSON list. Also selected with an "
+                                       "Accept header of application/x-ndjson. Cannot be "
+                                       "combined with limit or after",
+                        },
                     ],
                     'responses': [
                         {
                             'status_code': '200 OK',
                             'description': 'Success',
                         },
+                        {
+                            'status_code': '304 Not Modified',
+                            'description': 'Data unchanged since the ETag given in If-None-Match',
+                        },
                         {
                             'status_code': '400 Bad Request',
                             'description': 'Error in submitted parameters. A message detailing '
@@ -518,7 +579,8 @@ def documentation():
                             'name': 'bikepedfac',
                             'type': 'body',
                             'required': False,
-                            'content': 'String',
+                            'content': 'String, empty if not known',
+                            'possible_values': list(FACILITIES),
                         },
                     ],
                     'responses': [
@@ -533,6 +595,74 @@ def documentation():
                         },
                     ],
                 },
+                {
+                    'name': 'PATCH',
+                    'description': 'Edit many counts at once, in one transaction: if any patch '
+                                   'has errors, or is for a count that does not exist, no counts '
+                                   'are changed',
+                    'parameters': [
+                        {
+                            'name': 'patches',
+                            'type': 'body',
+                            'required': True,
+                            'content': 'JSON array (Content-Type application/json), or one per '
+                                       'line (Content-Type application/x-ndjson), of objects '
+                                       'with the recordnum of a count and the fields to change, '
+                                       'as in a PUT to /counts/<recordnum>. At most 50000 '
+                                       'patches',
+                        },
+                    ],
+                    'responses': [
+                        {
+                            'status_code': '200 OK',
+                            'description': 'Success',
+                        },
+                        {
+                            'status_code': '400 Bad Request',
+                            'description': 'Body could not be read, or error in submitted '
+                                           'patches. The errors of each patch will be provided, '
+                                           'with its index in the submitted patches',
+                        },
+                        {
+                            'status_code': '404 Not Found',
+                            'description': 'No count with one or more of the recordnums found',
+                        },
+                    ],
+                },
+            ],
+        },
+        {
+            'url': '/counts/bulk',
+            'methods': [
+                {
+                    'name': 'POST',
+                    'description': 'Add many counts at once, in one transaction: if any count '
+                                   'has errors, none are added. Responds with the recordnums of '
+                                   'the new counts, in the order submitted',
+                    'parameters': [
+                        {
+                            'name': 'counts',
+                            'type': 'body',
+                            'required': True,
+                            'content': 'JSON array of counts (Content-Type application/json), or '
+                                       'one count per line (Content-Type '
+                                       'application/x-ndjson), with the parameters of a POST to '
+                                       '/counts. At most 50000 counts',
+                        },
+                    ],
+                    'responses': [
+                        {
+                            'status_code': '201 Created',
+                            'description': 'Success',
+                        },
+                        {
+                            'status_code': '400 Bad Request',
+                            'description': 'Body could not be read, or error in submitted '
+                                           'counts. The errors of each count will be provided, '
+                                           'with its index in the submitted counts',
+                        },
+                    ],
+                },
             ],
         },
         {
@@ -540,20 +670,51 @@ def documentation():
             'methods': [
                 {
                     'name': 'GET',
-                    'description': 'Retrieve 5 counts closest to given latitude/longitude',
+                    'description': 'Retrieve the counts closest to given latitude/longitude '
+                                   '(5, unless k is provided), nearest first, each with its '
+                                   'distance in metres',
                     'parameters': [
                         {
                             'name': "latitude",
                             'type': "query string",
                             'required': True,
-                            'content': "Float",
+                            'content': "Float, from -90 to 90",
                         },
                         {
                             'name': "longitude",
                             'type': "query string",
                             'required': True,
-                            'content': "Float",
-                        }
+                            'content': "Float, from -180 to 180",
+                        },
+                        {
+                            'name': 'k',
+                            'type': 'query string',
+                            'required': False,
+                            'content': "Integer, number of counts to return (1 to 100)",
+                        },
+                        {
+                            'name': 'radius',
+                            'type': 'query string',
+                            'required': False,
+                            'content': "Float, only return counts within this many metres",
+                        },
+                        {
+                            'name': 'fields',
+                            'type': 'query string',
+                            'required': False,
+                            'content': "Comma-separated fields to return of each count, e.g. "
+                                       "recordnum,latitude,longitude,aadb (default: all). Any "
+                                       "of the fields of counts and prcp, tavg, tmax, tmin, "
+                                       "or distance",
+                        },
+                        {
+                            'name': 'stream',
+                            'type': 'query string',
+                            'required': False,
+                            'content': "1, to stream counts as newline-delimited JSON (one count "
+                                       "per line) rather than a JSON list. Also selected with an "
+                                       "Accept header of application/x-ndjson",
+                        },
                     ],
                     'responses': [
                         {
@@ -563,7 +724,8 @@ def documentation():
                         {
                             'status_code': '400 Bad Request',
                             'description': 'Values for latitude and/or longitude not provided or '
-                                           'values provided are not Floats',
+                                           'values provided are not Floats, or invalid k or '
+                                           'radius',
                         },
                         {
                             'status_code': '404 Not Found',
@@ -573,20 +735,62 @@ def documentation():
                 },
             ],
         },
+        {
+            'url': '/counts/stats',
+            'methods': [
+                {
+                    'name': 'GET',
+                    'description': 'Retrieve statistics of the AADB of counts for each group of '
+                                   'the given dimensions (or of all counts, if none are given), '
+                                   'as a list with one object per group, holding the values of '
+                                   'its dimensions and metrics',
+                    'parameters': [
+                        {
+                            'name': 'group_by',
+                            'type': 'query string',
+                            'required': False,
+                            'content': "Comma-separated dimensions: co_name, mun_name, "
+                                       "bikepedfac, setyear, month (1-12, of setdate), or "
+                                       "prcp_bin (the precipitation of the day of the count, "
+                                       "binned by its lower bound: 0, 0.01, 0.1, 0.5 or 1 inches)",
+                        },
+                        {
+                            'name': 'metrics',
+                            'type': 'query string',
+                            'required': False,
+                            'content': "Comma-separated metrics: count, sum_aadb, avg_aadb, "
+                                       "min_aadb, max_aadb, or pNN_aadb for the NNth "
+                                       "(nearest-rank) percentile of AADB, e.g. p50_aadb. "
+                                       "Default: count,avg_aadb",
+                        },
+                    ],
+                    'responses': [
+                        {
+                            'status_code': '200 OK',
+                            'description': 'Success',
+                        },
+                        {
+                            'status_code': '400 Bad Request',
+                            'description': 'Unknown dimension or metric',
+                        },
+                    ],
+                },
+            ],
+        },
         {
             'url': '/counts/facilities',
             'methods': [
                 {
                     'name': 'GET',
-                    'description': 'Retrieve all facility types',
+                    'description': 'Retrieve all facility types, the values bikepedfac can take',
                     'responses': [
                         {
                             'status_code': '200 OK',
                             'description': 'Success',
                         },
                         {
-                            'status_code': '404 Not Found',
-                            'description': 'No facilities found',
+                            'status_code': '304 Not Modified',
+                            'description': 'Data unchanged since the ETag given in If-None-Match',
                         },
                     ],
                 },
@@ -1,4 +1,7 @@
-from flask import Blueprint, redirect, url_for
+from flask import Blueprint, Response, redirect, url_for
+
+from bicycles import request_metrics
+from .auth import token_required
 
 main_bp = Blueprint('main_bp', __name__)  # url prefix of / set in init
 
@@ -6,3 +9,12 @@ main_bp = Blueprint('main_bp', __name__)  # url prefix of / set in init
 @main_bp.route('/')
 def main():
     return redirect(url_for('doc_bp.documentation'))
+
+
+@main_bp.route('/metrics')
+@token_required("METRICS_TOKEN")
+def metrics():
+    '''Return request metrics in the Prometheus text format, only with the METRICS_TOKEN.'''
+    response = Response(request_metrics.render(), mimetype="text/plain; version=0.0.4")
+    response.headers["Cache-Control"] = "no-store"
+    return response
@@ -0,0 +1,310 @@
+'''
+Request metrics, exposed in the Prometheus text format at /metrics to scrapers sending the
+METRICS_TOKEN.
+
+For each endpoint (the name of its view, e.g. api.counts) these are recorded:
+
+- bicycles_http_requests_total: requests, by method and status code
+- bicycles_http_request_duration_seconds: time from the start of the request until the response
+  has been written, so streamed responses are timed through their last row
+- bicycles_http_response_size_bytes: size of the response body
+- bicycles_http_response_rows: rows returned, by the endpoints that query them (reported by
+  the handlers with count_rows())
+
+Config values:
+
+- METRICS: record metrics (default True)
+- METRICS_DIR: directory in which every worker process keeps its values, in a memory-mapped file
+  of its own, so that /metrics reports the sum over all workers whichever one answers it. The
+  directory must be shared by the workers of one server and emptied before it starts; the files
+  of workers that have exited are kept, so that counters never go down. When None (the default)
+  values are kept in memory and only describe the worker answering the request.
+- METRICS_TOKEN: token that requests to /metrics must send in an "Authorization: Bearer" header
+  (in Prometheus, the credentials of the scrape config's authorization); while None (the default)
+  /metrics is not found (see auth.py)
+'''
+import bisect
+import collections
+import functools
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+from flask import current_app, g, request
+
+# upper bounds of the histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000, 100000000)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+# name -> (type, help, bucket bounds of histograms)
+METRICS = {
+    "bicycles_http_requests_total": (
+        "counter", "Requests handled, by endpoint, method and status code.", None),
+    "bicycles_http_request_duration_seconds": (
+        "histogram", "Time to handle a request and write its response.", DURATION_BUCKETS),
+    "bicycles_http_response_size_bytes": (
+        "histogram", "Size of response bodies.", SIZE_BUCKETS),
+    "bicycles_http_response_rows": (
+        "histogram", "Rows returned by the endpoints that query them.", ROW_BUCKETS),
+}
+
+# other methods are recorded as "other", so that clients can't add labels at will
+METHODS = frozenset(("GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"))
+
+
+@functools.lru_cache(maxsize=None)
+def sample_key(name, labels):
+    '''Key under which the value of a sample, with labels as a tuple of pairs, is stored.'''
+    return json.dumps([name, dict(labels)])
+
+
+class MemoryStore:
+    '''Values of the current process only.'''
+
+    def __init__(self):
+        self._values = collections.defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, key, amount=1):
+        with self._lock:
+            self._values[key] += amount
+
+    def items(self):
+        with self._lock:
+            return list(self._values.items())
+
+
+class MmapFile:
+    '''
+    Values of one process in a memory-mapped file, which other processes can read at any time.
+
+    The file starts with the number of bytes in use, followed by entries of a key's length, the
+    key (UTF-8, padded to 8 bytes) and its value as a double. Entries are only ever appended, and
+    the number of bytes in use is updated after each is written, so a reader sees whole entries.
+    '''
+    INITIAL_SIZE = 64 * 1024
+    HEADER = struct.Struct("=Q")
+
+    def __init__(self, path):
+        self._file = open(path, "a+b")
+        size = os.fstat(self._file.fileno()).st_size
+        if size == 0:
+            size = self.INITIAL_SIZE
+            self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self._used = self.HEADER.unpack_from(self._map)[0] or self.HEADER.size
+        # offsets of the values, to continue a file left by an earlier process with this pid
+        self._offsets = {key: offset for key, _, offset in read_entries(self._map, self._used)}
+
+    def inc(self, key, amount):
+        offset = self._offsets.get(key)
+        if offset is None:
+            offset = self._append(key)
+        value = struct.unpack_from("=d", self._map, offset)[0]
+        struct.pack_into("=d", self._map, offset, value + amount)
+
+    def _append(self, key):
+        encoded = key.encode()
+        padded = len(encoded) + (-(4 + len(encoded)) % 8)
+        size = 4 + padded + 8
+        if self._used + size > len(self._map):
+            new_size = len(self._map)
+            while self._used + size > new_size:
+                new_size *= 2
+            self._map.close()
+            self._file.truncate(new_size)
+            self._map = mmap.mmap(self._file.fileno(), new_size)
+
+        struct.pack_into(f"=i{padded}sd", self._map, self._used, len(encoded), encoded, 0.0)
+        offset = self._used + 4 + padded
+        self._used += size
+        self.HEADER.pack_into(self._map, 0, self._used)
+        self._offsets[key] = offset
+        return offset
+
+
+def read_entries(data, used=None):
+    '''Yield the key, value and offset of the value of each entry in the contents of an MmapFile.'''
+    if used is None:
+        used = MmapFile.HEADER.unpack_from(data)[0]
+    position = MmapFile.HEADER.size
+    while position < used:
+        length = struct.unpack_from("=i", data, position)[0]
+        padded = length + (-(4 + length) % 8)
+        key = bytes(data[position + 4:position + 4 + length]).decode()
+        offset = position + 4 + padded
+        yield key, struct.unpack_from("=d", data, offset)[0], offset
+        position = offset + 8
+
+
+class FileStore:
+    '''Values of every process using directory, each written to a file of its own.'''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._file = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def inc(self, key, amount=1):
+        with self._lock:
+            # the file is opened by the process that writes to it, after any fork
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._file = MmapFile(os.path.join(self.directory, f"metrics_{self._pid}.db"))
+            self._file.inc(key, amount)
+
+    def items(self):
+        values = collections.defaultdict(float)
+        for name in os.listdir(self.directory):
+            if not (name.startswith("metrics_") and name.endswith(".db")):
+                continue
+            with open(os.path.join(self.directory, name), "rb") as f:
+                data = f.read()
+            if len(data) < MmapFile.HEADER.size:
+                continue
+            for key, value, _ in read_entries(data):
+                values[key] += value
+        return list(values.items())
+
+
+class RequestMetrics:
+    '''Flask extension recording metrics of every request.'''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("METRICS", True)
+        app.config.setdefault("METRICS_DIR", None)
+        app.config.setdefault("METRICS_TOKEN", None)
+        if not app.config["METRICS"]:
+            return
+
+        directory = app.config["METRICS_DIR"]
+        store = FileStore(directory) if directory else MemoryStore()
+        app.extensions["request_metrics"] = store
+
+        @app.before_request
+        def start_request():
+            g.request_metrics = Observation()
+
+        @app.after_request
+        def finish_request(response):
+            observation = g.get("request_metrics")
+            if observation is None:
+                return response
+            method = request.method if request.method in METHODS else "other"
+            labels = (("endpoint", request.endpoint or "none"), ("method", method))
+            status = response.status_code
+
+            if response.is_streamed:
+                response.response = counted(response.response, observation)
+            else:
+                observation.size = response.calculate_content_length() or 0
+            response.call_on_close(lambda: record(store, labels, status, observation))
+            return response
+
+    def render(self):
+        '''Return the metrics of the current app in the Prometheus text format.'''
+        store = current_app.extensions.get("request_metrics")
+        return render(store.items() if store is not None else [])
+
+
+class Observation:
+    '''What is measured of one request.'''
+    __slots__ = ("start", "size", "rows")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.size = 0
+        self.rows = None
+
+
+def count_rows(rows):
+    '''Add rows to the rows returned by the current request.'''
+    observation = g.get("request_metrics")
+    if observation is not None:
+        observation.rows = (observation.rows or 0) + rows
+
+
+def counted(chunks, observation):
+    '''Yield chunks, the body of a streamed response, adding their size to observation.'''
+    try:
+        for chunk in chunks:
+            observation.size += len(chunk.encode() if isinstance(chunk, str) else chunk)
+            yield chunk
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def observe(store, name, labels, value):
+    '''Add value to histogram name, in the bucket of the least bound that isn't below it.'''
+    bounds = METRICS[name][2]
+    index = bisect.bisect_left(bounds, value)
+    bound = str(bounds[index]) if index < len(bounds) else "+Inf"
+    store.inc(sample_key(name + "_bucket", labels + (("le", bound),)))
+    store.inc(sample_key(name + "_sum", labels), value)
+    store.inc(sample_key(name + "_count", labels))
+
+
+def record(store, labels, status, observation):
+    duration = time.perf_counter() - observation.start
+    store.inc(sample_key("bicycles_http_requests_total", labels + (("status", str(status)),)))
+    observe(store, "bicycles_http_request_duration_seconds", labels, duration)
+    observe(store, "bicycles_http_response_size_bytes", labels, observation.size)
+    if observation.rows is not None:
+        observe(store, "bicycles_http_response_rows", labels, observation.rows)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"')
+               for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+def format_value(value):
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def render(items):
+    '''Return samples, as (key, value) pairs from a store, in the Prometheus text format.'''
+    samples = collections.defaultdict(dict)  # sample name -> label values -> (labels, value)
+    for key, value in items:
+        name, labels = json.loads(key)
+        samples[name][tuple(sorted(labels.items()))] = (labels, value)
+
+    lines = []
+    for name, (metric_type, description, bounds) in METRICS.items():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        if metric_type == "counter":
+            for _, (labels, value) in sorted(samples[name].items()):
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+            continue
+
+        # buckets are stored on their own; the exposition format has them cumulative
+        buckets = collections.defaultdict(dict)
+        for labels, value in samples[name + "_bucket"].values():
+            labels = dict(labels)
+            bound = labels.pop("le")
+            buckets[tuple(sorted(labels.items()))][bound] = value
+        for series in sorted(buckets):
+            cumulative = 0
+            for bound in [str(b) for b in bounds] + ["+Inf"]:
+                cumulative += buckets[series].get(bound, 0)
+                labels = dict(series, le=bound)
+                lines.append(f"{name}_bucket{format_labels(labels)} {format_value(cumulative)}")
+            for suffix in ("_sum", "_count"):
+                labels, value = samples[name + suffix].get(series, (dict(series), 0.0))
+                lines.append(f"{name}{suffix}{format_labels(labels)} {format_value(value)}")
+    return "\n".join(lines) + "\n"
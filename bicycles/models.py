@@ -1,3 +1,5 @@
+from sqlalchemy import DDL, event
+
 from bicycles import db
 
 class BicycleCount(db.Model):
@@ -30,13 +32,45 @@ class BicycleCount(db.Model):
     bikepedgro = db.Column(db.Text)
     bikepedfac = db.Column(db.Text)
     geom = db.Column(db.Text)
+    # date part of setdate, kept in sync by the API so the weather join can use an index
+    set_date = db.Column(db.Date, index=True)
 
 
 class Weather(db.Model):
-    station = db.Column(db.Text)
+    # NOAA GHCN-Daily station ID, e.g. USW00013739
+    station = db.Column(db.String(20), primary_key=True)
     name = db.Column(db.Text)
     date = db.Column(db.Date, primary_key=True)
     prcp = db.Column(db.Float)
     tavg = db.Column(db.Integer)
     tmax = db.Column(db.Integer)
     tmin = db.Column(db.Integer)
+    # when the row was last inserted or changed by flask load-weather
+    updated = db.Column(db.DateTime)
+
+
+# number of counts, and of those with an AADB and its sum, per county, facility, year and month of
+# set_date, kept up to date by every write to bicycle_count (see rollups.py)
+class CountRollup(db.Model):
+    # hash of the values of the dimensions, as any of them may be null
+    group_key = db.Column(db.String(40), primary_key=True)
+    co_name = db.Column(db.Text)
+    bikepedfac = db.Column(db.Text)
+    setyear = db.Column(db.Integer)
+    month = db.Column(db.Integer)
+    counts = db.Column(db.BigInteger, nullable=False, default=0)
+    aadb_counts = db.Column(db.BigInteger, nullable=False, default=0)
+    aadb_sum = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+# version of the counts and weather, bumped in the transaction of every write to them, under which
+# responses are cached and from which their ETags are made (see caching.py); it has one row
+class DataVersion(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+    # when version was last bumped
+    updated = db.Column(db.DateTime)
+
+
+event.listen(DataVersion.__table__, "after_create",
+             DDL("INSERT INTO data_version (id, version) VALUES (1, 0)"))
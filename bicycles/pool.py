@@ -0,0 +1,155 @@
+'''
+Connection pool settings and metrics.
+
+The pool is configured with these config values, each left to SQLAlchemy's (or Flask-SQLAlchemy's)
+default when None:
+
+- DB_POOL_SIZE: connections kept open by each worker process (default 5; 10 on MySQL)
+- DB_POOL_MAX_OVERFLOW: connections opened beyond DB_POOL_SIZE under load (default 10)
+- DB_POOL_TIMEOUT: seconds to wait for a connection before giving up (default 30)
+- DB_POOL_RECYCLE: seconds after which a connection is replaced (default never; 7200 on MySQL)
+- DB_POOL_PRE_PING: test connections when they are checked out (default False)
+
+SQLALCHEMY_ENGINE_OPTIONS, when set, takes precedence. SQLite databases keep the pools
+Flask-SQLAlchemy chooses for them, so only DB_POOL_PRE_PING applies to them.
+
+On other databases the pool is a QueuePool that times how long each checkout waits for a
+connection and how long new connections take to open, and counts checkouts, checkins,
+invalidated connections and timeouts from the pool's events. PoolMetrics.snapshot() reports these
+for the current worker process, along with the state of its pool.
+'''
+import bisect
+import os
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import event, exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+# upper bounds of the histogram buckets, in seconds
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+CONNECT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    '''Count of observations in cumulative buckets by upper bound, as Prometheus histograms do.'''
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self._counts = [0] * (len(self.bounds) + 1)  # the last is for values above every bound
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self._counts[bisect.bisect_left(self.bounds, value)] += 1
+            self._sum += value
+
+    def snapshot(self):
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        buckets = {}
+        cumulative = 0
+        for bound, count in zip(self.bounds + ("+Inf",), counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {"buckets": buckets, "count": cumulative, "sum": total}
+
+
+class Metrics:
+    '''Counters and histograms of one app's pool.'''
+
+    def __init__(self):
+        self.waits = Histogram(WAIT_BUCKETS)
+        self.connects = Histogram(CONNECT_BUCKETS)
+        self.counters = dict.fromkeys(("checkouts", "checkins", "invalidated", "timeouts"), 0)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+
+class TimedQueuePool(QueuePool):
+    '''
+    QueuePool timing checkouts and new connections. Subclasses made by PoolMetrics set metrics;
+    the pool keeps its class when the engine recreates it.
+    '''
+    metrics = None
+
+    def _do_get(self):
+        local = self.metrics._local
+        local.connecting = 0.0
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.metrics.count("timeouts")
+            raise
+        finally:
+            # opening a new connection is timed separately, rather than as waiting
+            self.metrics.waits.observe(time.perf_counter() - start - local.connecting)
+
+    def _create_connection(self):
+        start = time.perf_counter()
+        try:
+            return super()._create_connection()
+        finally:
+            elapsed = time.perf_counter() - start
+            self.metrics.connects.observe(elapsed)
+            local = self.metrics._local
+            local.connecting = getattr(local, "connecting", 0.0) + elapsed
+
+
+class PoolMetrics:
+    '''Flask extension applying the DB_POOL_* settings and collecting pool metrics.'''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        for name in ("DB_POOL_SIZE", "DB_POOL_MAX_OVERFLOW", "DB_POOL_TIMEOUT", "DB_POOL_RECYCLE",
+                     "DB_POOL_PRE_PING"):
+            app.config.setdefault(name, None)
+
+        metrics = Metrics()
+        app.extensions["pool_metrics"] = metrics
+
+        options = {"pool_pre_ping": app.config["DB_POOL_PRE_PING"]}
+        url = app.config.get("SQLALCHEMY_DATABASE_URI")
+        if url and make_url(url).get_backend_name() != "sqlite":
+            pool_class = type("TimedQueuePool", (TimedQueuePool,), {"metrics": metrics})
+            for name, listener in (("checkout", lambda *args: metrics.count("checkouts")),
+                                   ("checkin", lambda *args: metrics.count("checkins")),
+                                   ("invalidate", lambda *args: metrics.count("invalidated"))):
+                event.listen(pool_class, name, listener)
+            options.update(poolclass=pool_class,
+                           pool_size=app.config["DB_POOL_SIZE"],
+                           max_overflow=app.config["DB_POOL_MAX_OVERFLOW"],
+                           pool_timeout=app.config["DB_POOL_TIMEOUT"],
+                           pool_recycle=app.config["DB_POOL_RECYCLE"])
+
+        options = {name: value for name, value in options.items() if value is not None}
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+            **options, **app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {})}
+
+    def snapshot(self, engine):
+        '''Return the state of engine's pool and the metrics of the current app's pool.'''
+        metrics = current_app.extensions["pool_metrics"]
+        pool = engine.pool
+        with metrics._lock:
+            counters = dict(metrics.counters)
+
+        state = {"pid": os.getpid(), "class": type(pool).__name__}
+        if isinstance(pool, QueuePool):
+            # overflow() is negative while fewer than size() connections have been opened
+            state.update(size=pool.size(), checked_in=pool.checkedin(),
+                         checked_out=pool.checkedout(), overflow=pool.overflow(),
+                         max_overflow=pool._max_overflow, timeout=pool.timeout())
+        return {"pool": state, **counters,
+                "wait_seconds": metrics.waits.snapshot(),
+                "connect_seconds": metrics.connects.snapshot()}
@@ -0,0 +1,242 @@
+'''
+Rollups of counts: the number of counts and the sum of their AADB per county, facility, year and
+month, kept in count_rollup so that counts/stats can be answered by reading one row per group,
+however many counts there are.
+
+Every write to bicycle_count changes the rollups by the difference it makes to each group, in
+the same transaction: the API from the values of the counts it adds, changes and deletes, and
+load-counts from the groups of the counts it replaces and loads. Counts written by other means
+leave the rollups out of date: flask rollups check reports the groups that differ, and flask
+rollups rebuild recomputes them all from bicycle_count.
+
+Only sums can be kept up to date this way, so only the count, sum_aadb and avg_aadb metrics are
+answered from the rollups; the minimum, maximum and percentiles of a group would change with a
+deleted count in a way only the other counts of the group tell.
+
+The count_rollup table is made by data/create_tables.sql (or psql_create_tables.sql), and added to
+an existing database, with the rollups of its counts, by data/add_count_rollup.sql (or
+psql_add_count_rollup.sql); flask rollups rebuild also creates it if it doesn't exist.
+
+Config values:
+
+- ROLLUPS: keep the rollups up to date and answer counts/stats from them (default False). Turn it
+  on once count_rollup has been created and filled; after running with ROLLUPS off, rebuild the
+  rollups before turning it back on.
+'''
+import functools
+import hashlib
+import json
+
+from flask import current_app
+from sqlalchemy import text
+
+from bicycles import db
+from .aggregation import DIMENSIONS as STATS_DIMENSIONS
+
+# dimensions of the rollups, which are also dimensions of counts/stats
+DIMENSIONS = ('co_name', 'bikepedfac', 'setyear', 'month')
+
+# metrics of counts/stats that can be computed from the rollups
+METRICS = ('count', 'sum_aadb', 'avg_aadb')
+
+# columns of counts that the group of a count, and what it adds to it, depend on
+COLUMNS = ('co_name', 'bikepedfac', 'setyear', 'set_date', 'aadb')
+
+ROLLUP_COLUMNS = DIMENSIONS + ('group_key', 'counts', 'aadb_counts', 'aadb_sum')
+
+
+def enabled():
+    return current_app.config["ROLLUPS"]
+
+
+def month_expression(dialect):
+    '''Return the expression of the month of the set_date of count b, as in counts/stats.'''
+    return STATS_DIMENSIONS['month'][0][dialect]
+
+
+def rows_sql(dialect):
+    '''
+    Return the SELECT of the values of counts that the rollups depend on, for the recordnums
+    bound to :recordnums (see api.recordnums_in()), locking the counts until the end of the
+    transaction where the database can.
+    '''
+    sql = (f"SELECT b.recordnum, b.co_name, b.bikepedfac, b.setyear, "
+           f"{month_expression(dialect)} AS month, b.aadb "
+           "FROM bicycle_count b WHERE b.recordnum IN :recordnums")
+    return sql if dialect == "sqlite" else sql + " FOR UPDATE"
+
+
+def grouped_sql(dialect, source="bicycle_count", where=""):
+    '''
+    Return the SELECT of the rollups of the counts in source (a table with the columns of
+    bicycle_count, as b) matching where, one row per group.
+    '''
+    return (f"SELECT b.co_name, b.bikepedfac, b.setyear, {month_expression(dialect)} AS month, "
+            f"COUNT(*), COUNT(b.aadb), SUM(b.aadb) FROM {source} b {where} GROUP BY 1, 2, 3, 4")
+
+
+def group_key(group):
+    '''
+    Return the primary key of the rollup of group, a tuple of values of DIMENSIONS: the MD5 of
+    the values, with \\N for nulls, separated by the unit separator character, which the
+    data/*add_count_rollup.sql migrations compute in SQL as
+    MD5(CONCAT_WS(CHR(31), COALESCE(co_name, '\\N'), ...)).
+    '''
+    values = "\x1f".join("\\N" if value is None else str(value) for value in group)
+    return hashlib.md5(values.encode()).hexdigest()
+
+
+def count_group(values):
+    '''
+    Return the group of a count from its column values, with either its set_date or the month
+    of it (as selected by rows_sql()).
+    '''
+    if values.get("set_date") is not None:
+        month = values["set_date"].month
+    else:
+        month = values.get("month")
+    return (values.get("co_name"), values.get("bikepedfac"), values.get("setyear"), month)
+
+
+class Deltas:
+    '''Changes to the rollups, by group, to be applied in one statement.'''
+
+    def __init__(self):
+        self.groups = {}  # group -> [counts, aadb_counts, aadb_sum]
+
+    def add_group(self, group, counts, aadb_counts, aadb_sum):
+        # months and years are returned as decimals or floats by some databases
+        co_name, bikepedfac, setyear, month = group
+        group = (co_name, bikepedfac,
+                 None if setyear is None else int(setyear), None if month is None else int(month))
+        totals = self.groups.setdefault(group, [0, 0, 0])
+        totals[0] += counts
+        totals[1] += aadb_counts
+        totals[2] += int(aadb_sum or 0)
+
+    def add(self, values, sign=1):
+        '''Add a count with column values to its group, or with sign -1 remove it.'''
+        aadb = values.get("aadb")
+        self.add_group(count_group(values), sign, 0 if aadb is None else sign,
+                       sign * (aadb or 0))
+
+    def add_rows(self, rows, sign=1):
+        '''Add the rows of grouped_sql() to their groups, or with sign -1 remove them.'''
+        for *group, counts, aadb_counts, aadb_sum in rows:
+            self.add_group(group, sign * counts, sign * aadb_counts, sign * (aadb_sum or 0))
+
+    def apply(self):
+        '''Apply the changes to count_rollup, in the current transaction.'''
+        rows = [dict(zip(DIMENSIONS, group), group_key=group_key(group), counts=totals[0],
+                     aadb_counts=totals[1], aadb_sum=totals[2])
+                for group, totals in self.groups.items() if any(totals)]
+        self.groups = {}
+        if not rows:
+            return
+
+        names = ", ".join(ROLLUP_COLUMNS)
+        sums = ("counts", "aadb_counts", "aadb_sum")
+        dialect = db.engine.dialect.name
+        if dialect == "mysql":
+            upsert = "ON DUPLICATE KEY UPDATE " + ", ".join(f"{c} = {c} + VALUES({c})"
+                                                            for c in sums)
+        else:
+            upsert = ("ON CONFLICT (group_key) DO UPDATE SET "
+                      + ", ".join(f"{c} = count_rollup.{c} + excluded.{c}" for c in sums))
+
+        if dialect == "postgresql":
+            # one multi-row INSERT rather than a round trip per group, as in api.insert_counts()
+            from psycopg2.extras import execute_values
+            cursor = db.session.connection().connection.cursor()
+            template = "(" + ", ".join(f"%({c})s" for c in ROLLUP_COLUMNS) + ")"
+            execute_values(cursor, f"INSERT INTO count_rollup ({names}) VALUES %s {upsert}",
+                           rows, template, page_size=1000)
+        else:
+            placeholders = ", ".join(":" + c for c in ROLLUP_COLUMNS)
+            db.session.execute(
+                text(f"INSERT INTO count_rollup ({names}) VALUES ({placeholders}) {upsert}"),
+                rows)
+
+
+def update(added=(), removed=()):
+    '''
+    Change the rollups, in the current transaction, by adding counts with the column values in
+    added and removing those in removed, if ROLLUPS is set.
+    '''
+    if not enabled():
+        return
+    deltas = Deltas()
+    for values in added:
+        deltas.add(values)
+    for values in removed:
+        deltas.add(values, -1)
+    deltas.apply()
+
+
+def affected_by(values):
+    '''Check whether changing a count to column values can change the rollups.'''
+    return enabled() and any(column in values for column in COLUMNS)
+
+
+def rebuild():
+    '''
+    Recompute the rollups from bicycle_count, in the current transaction. Returns the number of
+    groups.
+    '''
+    db.session.execute(text("DELETE FROM count_rollup"))
+    deltas = Deltas()
+    deltas.add_rows(db.session.execute(text(grouped_sql(db.engine.dialect.name))))
+    groups = len(deltas.groups)
+    deltas.apply()
+    return groups
+
+
+def differences():
+    '''
+    Return the groups whose rollup differs from their counts in bicycle_count, as (group, expected
+    totals, stored totals), where totals are [counts, aadb_counts, aadb_sum].
+    '''
+    expected = Deltas()
+    expected.add_rows(db.session.execute(text(grouped_sql(db.engine.dialect.name))))
+    stored = Deltas()
+    stored.add_rows(db.session.execute(text(
+        f"SELECT {', '.join(DIMENSIONS)}, counts, aadb_counts, aadb_sum FROM count_rollup")))
+
+    differences = []
+    for group in sorted(set(expected.groups) | set(stored.groups), key=json.dumps):
+        totals = expected.groups.get(group, [0, 0, 0]), stored.groups.get(group, [0, 0, 0])
+        if totals[0] != totals[1]:
+            differences.append((group,) + totals)
+    return differences
+
+
+def covers(group_by, metrics):
+    '''Check whether counts/stats of metrics grouped by group_by can be read from the rollups.'''
+    return set(group_by) <= set(DIMENSIONS) and set(metrics) <= set(METRICS)
+
+
+@functools.lru_cache(maxsize=64)
+def stats_statement(group_by):
+    '''Return the statement summing the rollups of each group of group_by, ordered by group.'''
+    sums = ("COALESCE(SUM(counts), 0) AS count, COALESCE(SUM(aadb_counts), 0) AS aadb_count, "
+            "SUM(aadb_sum) AS sum_aadb")
+    sql = f"SELECT {', '.join(group_by + (sums,))} FROM count_rollup"
+    if group_by:
+        positions = ", ".join(str(position) for position in range(1, len(group_by) + 1))
+        sql += f" GROUP BY {positions} HAVING SUM(counts) > 0 ORDER BY {positions}"
+    return text(sql)
+
+
+def group_values(row, group_by, metrics):
+    '''Return the values of a row of stats_statement(), as aggregation.group_values() does.'''
+    values = {name: row[name] for name in group_by}
+    aadb_count = int(row["aadb_count"])
+    sum_aadb = int(row["sum_aadb"]) if aadb_count else None
+    for name in metrics:
+        if name == "count":
+            values[name] = int(row["count"])
+        elif name == "sum_aadb":
+            values[name] = sum_aadb
+        else:
+            values[name] = sum_aadb / aadb_count if aadb_count else None
+    return values
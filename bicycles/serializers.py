@@ -0,0 +1,118 @@
+'''
+Serialize query results to JSON.
+
+Rather than converting each row to a dict and letting json.dumps() call a fallback encoder for
+every Decimal and datetime, the column types of a result are looked up once and compiled into a
+RowSerializer, which holds the pre-encoded key of each column and an encoder function for its
+type. Rows are then written straight to JSON text.
+'''
+import datetime
+import decimal
+import functools
+import json
+import math
+from json.encoder import encode_basestring_ascii
+
+from sqlalchemy import types
+
+from .models import BicycleCount, Weather
+
+# types of the columns that can appear in results, by column name
+COLUMN_TYPES = {column.name: column.type
+                for table in (BicycleCount.__table__, Weather.__table__)
+                for column in table.c}
+
+
+def _default(obj):
+    '''Fallback for json.dumps(), for values of columns whose type is unknown.'''
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def encode_any(value):
+    return json.dumps(value, default=_default)
+
+
+# The encoders below have a fast path for the Python type the column type maps to, and fall back
+# to encode_any() for anything else, since the live schema does not always match the models (e.g.
+# route is TEXT in PostgreSQL) and untyped statements get whatever the driver returns.
+
+def encode_float(value):
+    if type(value) is float or type(value) is decimal.Decimal:
+        value = float(value)
+        if math.isfinite(value):
+            return float.__repr__(value)
+    return encode_any(value)
+
+
+def encode_int(value):
+    if type(value) is int:
+        return int.__repr__(value)
+    return encode_any(value)
+
+
+def encode_string(value):
+    try:
+        return encode_basestring_ascii(value)
+    except TypeError:
+        return encode_any(value)
+
+
+def encode_temporal(value):
+    try:
+        return '"' + value.isoformat() + '"'
+    except AttributeError:
+        return encode_any(value)
+
+
+def encoder_for(column_type):
+    '''Return the function that encodes values of column_type as JSON text.'''
+    # Float is a subclass of Numeric, so both are covered here
+    if isinstance(column_type, types.Numeric):
+        return encode_float
+    if isinstance(column_type, types.Integer):
+        return encode_int
+    if isinstance(column_type, types.String):
+        return encode_string
+    if isinstance(column_type, (types.DateTime, types.Date, types.Time)):
+        return encode_temporal
+    return encode_any
+
+
+class RowSerializer:
+    '''Write rows with the given column keys as JSON objects, with a compiled encoder per column.'''
+
+    def __init__(self, keys, column_types=None):
+        column_types = {**COLUMN_TYPES, **(column_types or {})}
+
+        self.keys = tuple(keys)
+        self._prefixes = [("{" if i == 0 else ",") + encode_string(key) + ":"
+                          for i, key in enumerate(self.keys)]
+        self._encoders = [encoder_for(column_types[key]) if key in column_types else encode_any
+                          for key in self.keys]
+
+    def row(self, row):
+        '''Return one row as a JSON object.'''
+        if not self.keys:
+            return "{}"
+        return "".join([
+            prefix + ("null" if value is None else encode(value))
+            for prefix, encode, value in zip(self._prefixes, self._encoders, row)
+        ]) + "}"
+
+    def rows(self, rows):
+        '''Return rows as a JSON array of objects.'''
+        return "[" + ",".join([self.row(row) for row in rows]) + "]"
+
+
+@functools.lru_cache(maxsize=128)
+def _serializer_for(keys):
+    return RowSerializer(keys)
+
+
+def serializer_for(keys):
+    '''Return the (cached) RowSerializer for results with the given column keys.'''
+    return _serializer_for(tuple(keys))
@@ -0,0 +1,338 @@
+'''
+In-process spatial index of count locations, answering nearest-count queries without a round trip
+to the database or PostGIS.
+
+Points are projected to metres on a local equirectangular projection centred on the data, which
+is accurate to well under 1% across a region the size of DVRPC's, and bucketed into a uniform
+grid. A k-nearest query scans rings of cells outwards from the query point, only the cells of each
+ring within the extent of the grid, until no unscanned cell can hold a closer point than the k-th
+best found so far. Points far outside the extent are answered by a linear scan of every point,
+as every ring would reach most of the grid.
+
+Buckets of points are never changed once in the grid: writes replace them, under a lock, so that
+queries read a snapshot of the grid without holding the lock while they scan it.
+'''
+import gc
+import heapq
+import math
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import text
+from sqlalchemy.engine.url import make_url
+
+# mean radius of the earth, in metres
+EARTH_RADIUS = 6371008.8
+METRES_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+
+class GridIndex:
+    '''Uniform grid of points keyed by recordnum, for k-nearest and radius queries.'''
+
+    def __init__(self, cell_size, ref_lat):
+        self.cell_size = cell_size
+        self.ref_lat = ref_lat
+        self._kx = METRES_PER_DEGREE * math.cos(math.radians(ref_lat))
+        self._cells = {}  # (column, row) -> {recordnum: (x, y)}
+        self._points = {}  # recordnum -> (column, row)
+        self._extent = None  # (min column, min row, max column, max row)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_points(cls, points, cell_size=None):
+        '''
+        Build an index of (recordnum, latitude, longitude) points. If cell_size (in metres) is not
+        given, it is chosen so that cells hold a few points each on average.
+        '''
+        # the cyclic garbage collector would otherwise run over and over while the millions of
+        # small, acyclic containers of a large index are created
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return cls._from_points(points, cell_size)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    @classmethod
+    def _from_points(cls, points, cell_size):
+        points = [(recordnum, float(lat), float(lon)) for recordnum, lat, lon in points]
+        lats = [lat for _, lat, _ in points]
+        ref_lat = (min(lats) + max(lats)) / 2 if lats else 0.0
+
+        if cell_size is None:
+            cell_size = 100.0
+            if len(points) > 1:
+                lons = [lon for _, _, lon in points]
+                kx = METRES_PER_DEGREE * math.cos(math.radians(ref_lat))
+                width = (max(lons) - min(lons)) * kx
+                height = (max(lats) - min(lats)) * METRES_PER_DEGREE
+                cell_size = max(math.sqrt(width * height * 4 / len(points)), 10.0)
+
+        index = cls(cell_size, ref_lat)
+        kx, floor = index._kx, math.floor
+        cells, cell_points = index._cells, index._points
+        for recordnum, lat, lon in points:
+            x, y = lon * kx, lat * METRES_PER_DEGREE
+            cell = (floor(x / cell_size), floor(y / cell_size))
+            # buckets are changed in place only while the index is built, before any query
+            if recordnum in cell_points:
+                index._remove(recordnum)
+            cells.setdefault(cell, {})[recordnum] = (x, y)
+            cell_points[recordnum] = cell
+
+        if cells:
+            index._extent = (min(col for col, _ in cells), min(row for _, row in cells),
+                             max(col for col, _ in cells), max(row for _, row in cells))
+        return index
+
+    def __len__(self):
+        return len(self._points)
+
+    def _project(self, lat, lon):
+        return lon * self._kx, lat * METRES_PER_DEGREE
+
+    def _cell(self, x, y):
+        return math.floor(x / self.cell_size), math.floor(y / self.cell_size)
+
+    def insert(self, recordnum, lat, lon):
+        '''Add a point, or move it if recordnum is already in the index.'''
+        x, y = self._project(float(lat), float(lon))
+        cell = self._cell(x, y)
+
+        with self._lock:
+            self._remove(recordnum)
+            # a new bucket rather than a change to the one queries may be scanning
+            bucket = dict(self._cells.get(cell, ()))
+            bucket[recordnum] = (x, y)
+            self._cells[cell] = bucket
+            self._points[recordnum] = cell
+            if self._extent is None:
+                self._extent = cell + cell
+            else:
+                min_col, min_row, max_col, max_row = self._extent
+                self._extent = (min(min_col, cell[0]), min(min_row, cell[1]),
+                                max(max_col, cell[0]), max(max_row, cell[1]))
+
+    def remove(self, recordnum):
+        '''Remove a point, if it is in the index.'''
+        with self._lock:
+            self._remove(recordnum)
+
+    def _remove(self, recordnum):
+        cell = self._points.pop(recordnum, None)
+        if cell is not None:
+            bucket = {rn: point for rn, point in self._cells[cell].items() if rn != recordnum}
+            if bucket:
+                self._cells[cell] = bucket
+            else:
+                del self._cells[cell]
+
+    @staticmethod
+    def _ring(col, row, r, extent):
+        '''Generate the cells at Chebyshev distance r from (col, row) within extent.'''
+        min_col, min_row, max_col, max_row = extent
+        if r == 0:
+            yield col, row
+            return
+        first_col, last_col = max(col - r, min_col), min(col + r, max_col)
+        for rw in (row - r, row + r):
+            if min_row <= rw <= max_row:
+                for c in range(first_col, last_col + 1):
+                    yield c, rw
+        first_row, last_row = max(row - r + 1, min_row), min(row + r - 1, max_row)
+        for c in (col - r, col + r):
+            if min_col <= c <= max_col:
+                for rw in range(first_row, last_row + 1):
+                    yield c, rw
+
+    def nearest(self, lat, lon, k=5, radius=None):
+        '''
+        Return up to k (recordnum, distance in metres) pairs, nearest first, optionally limited to
+        points within radius metres.
+        '''
+        x, y = self._project(lat, lon)
+        col, row = self._cell(x, y)
+        cell_size = self.cell_size
+        max_d2 = radius * radius if radius is not None else math.inf
+        best = []  # max-heap of the k nearest so far, as (-squared distance, recordnum)
+
+        def consider(bucket):
+            for recordnum, (px, py) in bucket.items():
+                d2 = (px - x) ** 2 + (py - y) ** 2
+                if d2 > max_d2:
+                    continue
+                if len(best) < k:
+                    heapq.heappush(best, (-d2, recordnum))
+                elif d2 < -best[0][0]:
+                    heapq.heapreplace(best, (-d2, recordnum))
+
+        with self._lock:
+            extent = self._extent
+            cells = self._cells
+            if extent is None or k < 1:
+                return []
+            # rings nearer than the edge of the grid are empty, and the search is over once a
+            # ring lies wholly outside it, or beyond the radius
+            min_col, min_row, max_col, max_row = extent
+            first = max(0, min_col - col, col - max_col, min_row - row, row - max_row)
+            last = max(col - min_col, max_col - col, row - min_row, max_row - row)
+            if radius is not None:
+                last = min(last, math.ceil(radius / cell_size) + 1)
+            # far outside the grid every point is about as far, so the rings would be scanned
+            # through most of it: a linear scan is cheaper. The buckets themselves are never
+            # changed, but the grid is, so it iterates over a copy of it.
+            far = first > max(max_col - min_col, max_row - min_row)
+            buckets = list(cells.values()) if far and first <= last else None
+
+        if buckets is not None:
+            for bucket in buckets:
+                consider(bucket)
+        elif not far:
+            for r in range(first, last + 1):
+                for cell in self._ring(col, row, r, extent):
+                    bucket = cells.get(cell)
+                    if bucket:
+                        consider(bucket)
+
+                # every point in rings beyond r is at least r cells away
+                if len(best) == k and -best[0][0] <= (r * cell_size) ** 2:
+                    break
+
+        return [(recordnum, math.sqrt(-d2)) for d2, recordnum in sorted(best, reverse=True)]
+
+
+class SpatialIndex:
+    '''
+    Flask extension holding the GridIndex of the current app.
+
+    The index is built from the database in a background thread when the app is created, unless
+    SPATIAL_INDEX_PRELOAD is False or the database is in-memory SQLite (whose tables are created
+    after the app); until that build is done, closest() waits for it, and if it failed (e.g. as
+    the tables didn't exist yet) the first closest() builds the index itself. Once the index is
+    older than SPATIAL_INDEX_MAX_AGE seconds it is rebuilt in a background thread, to pick up
+    writes made by other worker processes, while queries are still answered from the old one;
+    the new index replaces it at once when it is ready. Writes in this process are applied to
+    the index directly by the API, and those made during a build to the new index too.
+    '''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # "auto" uses the in-process index unless the database is PostgreSQL (with PostGIS)
+        app.config.setdefault("SPATIAL_INDEX", "auto")
+        app.config.setdefault("SPATIAL_INDEX_CELL_SIZE", None)
+        app.config.setdefault("SPATIAL_INDEX_MAX_AGE", 300)
+        app.config.setdefault("SPATIAL_INDEX_PRELOAD", True)
+        state = app.extensions["spatial_index"] = {
+            "index": None,
+            "built": 0.0,
+            # writes made during a build, applied to the new index before it replaces the old
+            "pending": None,
+            "thread": None,
+            "lock": threading.Lock(),  # held briefly, to change the state
+            "build_lock": threading.Lock(),  # held through a build
+        }
+
+        url = app.config.get("SQLALCHEMY_DATABASE_URI")
+        if app.config["SPATIAL_INDEX_PRELOAD"] and url:
+            url = make_url(url)
+            in_memory = (url.get_backend_name() == "sqlite"
+                         and url.database in (None, "", ":memory:"))
+            if not in_memory and self._enabled(app.config, url.get_backend_name()):
+                self._start_build(app, state)
+
+    @staticmethod
+    def _enabled(config, dialect):
+        setting = config["SPATIAL_INDEX"]
+        if setting == "auto":
+            return dialect != "postgresql"
+        return bool(setting)
+
+    def enabled(self, dialect):
+        '''Check whether closest() should use the in-process index rather than PostGIS.'''
+        return self._enabled(current_app.config, dialect)
+
+    def get(self, session):
+        '''
+        Return the index, building it with session if it hasn't been built, and starting a
+        rebuild in the background if it is out of date.
+        '''
+        state = current_app.extensions["spatial_index"]
+        if state["index"] is None:
+            with state["build_lock"]:
+                if state["index"] is None:
+                    self._build(state, session)
+
+        max_age = current_app.config["SPATIAL_INDEX_MAX_AGE"]
+        if max_age and time.monotonic() - state["built"] > max_age:
+            self._start_build(current_app._get_current_object(), state)
+        return state["index"]
+
+    def _start_build(self, app, state):
+        with state["lock"]:
+            if state["thread"] is not None and state["thread"].is_alive():
+                return
+            state["thread"] = threading.Thread(target=self._build_in_background,
+                                               args=(app, state), name="spatial-index",
+                                               daemon=True)
+            state["thread"].start()
+
+    def _build_in_background(self, app, state):
+        with app.app_context():
+            db = app.extensions["sqlalchemy"].db
+            try:
+                with state["build_lock"]:
+                    self._build(state, db.session)
+            except Exception:
+                app.logger.exception("Could not build the spatial index")
+            finally:
+                db.session.remove()
+
+    def _build(self, state, session):
+        '''Build the index and replace the current one with it, holding the build lock.'''
+        with state["lock"]:
+            state["pending"] = []
+        try:
+            result = session.execute(text(
+                "SELECT recordnum, latitude, longitude FROM bicycle_count "
+                "WHERE latitude IS NOT NULL AND longitude IS NOT NULL"))
+            index = GridIndex.from_points(result, current_app.config["SPATIAL_INDEX_CELL_SIZE"])
+        except Exception:
+            with state["lock"]:
+                state["pending"] = None
+            raise
+
+        with state["lock"]:
+            # writes whose counts the query may have missed; applying one again changes nothing
+            for write in state["pending"]:
+                if len(write) == 3:
+                    index.insert(*write)
+                else:
+                    index.remove(*write)
+            state["index"], state["built"], state["pending"] = index, time.monotonic(), None
+
+    def insert(self, recordnum, lat, lon):
+        '''Add or move a count in the index, if it has been built or is being built.'''
+        if lat is None or lon is None:
+            return
+        state = current_app.extensions["spatial_index"]
+        with state["lock"]:
+            if state["pending"] is not None:
+                state["pending"].append((recordnum, lat, lon))
+            index = state["index"]
+        if index is not None:
+            index.insert(recordnum, lat, lon)
+
+    def remove(self, recordnum):
+        '''Remove a count from the index, if it has been built or is being built.'''
+        state = current_app.extensions["spatial_index"]
+        with state["lock"]:
+            if state["pending"] is not None:
+                state["pending"].append((recordnum,))
+            index = state["index"]
+        if index is not None:
+            index.remove(recordnum)
@@ -0,0 +1,95 @@
+'''
+Server-side prepared statements for the read queries of the API, on PostgreSQL.
+
+psycopg2 (like PyMySQL) binds parameters by interpolating them into the SQL text on the client,
+so the server parses and plans every statement it is sent, even when only the parameters differ.
+Here a statement is instead sent once per connection as PREPARE, with its parameters numbered,
+and then run with EXECUTE. The server parses it once, and for the point lookups this is used for
+(one count by recordnum, the k nearest counts to a point) settles on a generic plan after a few
+executions instead of planning every request.
+
+The PREPARED_STATEMENTS config value (default True) turns this off, e.g. behind PgBouncer in
+transaction pooling mode, where consecutive transactions may run on different server
+connections. Other databases always execute statements directly.
+
+Statements are built per combination of the fields a client selects, so a connection keeps at
+most MAX_PREPARED of them, deallocating them all when it would exceed that.
+'''
+import hashlib
+import re
+import weakref
+
+from flask import current_app
+from sqlalchemy import bindparam, text
+
+# bound parameters in SQL compiled for psycopg2's pyformat paramstyle
+PYFORMAT_PARAM = re.compile(r"%\((\w+)\)s")
+
+# most statements prepared on one connection
+MAX_PREPARED = 256
+
+
+class PreparedStatement:
+    '''
+    The PREPARE and EXECUTE statements of statement, a text() construct or other SQLAlchemy
+    statement with named (not expanding) bound parameters, compiled for dialect.
+    '''
+
+    def __init__(self, statement, dialect):
+        compiled = statement.compile(dialect=dialect)
+        names = []
+
+        def number(match):
+            if match.group(1) not in names:
+                names.append(match.group(1))
+            return f"${names.index(match.group(1)) + 1}"
+
+        # PREPARE is sent without parameters, so psycopg2 doesn't unescape %% itself
+        body = PYFORMAT_PARAM.sub(number, str(compiled)).replace("%%", "%")
+        self.name = "bicycles_" + hashlib.sha1(body.encode()).hexdigest()[:16]
+        self.prepare = f"PREPARE {self.name} AS {body}"
+
+        arguments = f"({', '.join(':' + name for name in names)})" if names else ""
+        self.execute = text(f"EXECUTE {self.name}{arguments}").bindparams(
+            *[bindparam(name, type_=compiled.binds[name].type) for name in names])
+
+
+class PreparedStatements:
+    '''Flask extension executing statements as prepared statements where the database allows.'''
+
+    def __init__(self, app=None):
+        # statement -> dialect name -> PreparedStatement, dropped with statements that are no
+        # longer used
+        self._statements = weakref.WeakKeyDictionary()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("PREPARED_STATEMENTS", True)
+
+    def execute(self, session, statement, params=None):
+        '''
+        Execute statement with params in session, as a prepared statement on PostgreSQL, and
+        return the result.
+        '''
+        connection = session.connection()
+        dialect = connection.dialect
+        if dialect.name != "postgresql" or not current_app.config["PREPARED_STATEMENTS"]:
+            return connection.execute(statement, params or {})
+
+        by_dialect = self._statements.setdefault(statement, {})
+        prepared = by_dialect.get(dialect.name)
+        if prepared is None:
+            prepared = by_dialect.setdefault(dialect.name, PreparedStatement(statement, dialect))
+
+        # prepared statements belong to the database connection, and outlive transactions (even
+        # rolled back ones); connection.info is cleared if the connection is replaced
+        names = connection.info.setdefault("prepared_statements", set())
+        if prepared.name not in names:
+            if len(names) >= MAX_PREPARED:
+                connection.connection.cursor().execute("DEALLOCATE ALL")
+                names.clear()
+            connection.connection.cursor().execute(prepared.prepare)
+            names.add(prepared.name)
+
+        return connection.execute(prepared.execute, params or {})
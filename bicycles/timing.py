@@ -0,0 +1,149 @@
+'''
+Per-request timing of the phases of a response, reported in a Server-Timing header and, for slow
+requests, in a structured log entry.
+
+Phases:
+
+- db: executing SQL statements (timed by cursor events on the engine, which with psycopg2's
+  default client-side cursors includes receiving the rows)
+- fetch: turning the rows into result rows (marked in the handlers with phase())
+- serialize: encoding results as JSON (marked with phase())
+- compress: compressing the response body (see compression.py), when it is
+- total: from the start of the request until the response is returned to the WSGI server
+- write: sending the response body, which for streamed responses includes fetching and serializing
+  the rows. The Server-Timing header has been sent by then, so this only appears in the log.
+
+Config values:
+
+- SERVER_TIMING: add the Server-Timing header to every response (default False)
+- SLOW_QUERY_SECONDS: log requests taking longer than this, through writing the response, as
+  JSON to the bicycles.slow_queries logger at WARNING, with the SQL, parameters, row count and
+  time of each statement (default None, not logged)
+
+When neither is set nothing is registered, and phase() only looks up an attribute of flask.g.
+'''
+import json
+import logging
+import time
+
+from flask import g, request
+from sqlalchemy import event
+
+slow_query_logger = logging.getLogger("bicycles.slow_queries")
+
+# longest repr of the parameters of a statement written to the log
+MAX_PARAMS_LENGTH = 1000
+
+
+class Timings:
+    '''Durations of the phases of one request, and the statements it executed.'''
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {"db": 0.0, "fetch": 0.0, "serialize": 0.0}
+        self.statements = []  # (sql, parameters, row count, seconds)
+        self.total = None
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def header(self):
+        '''Return the value of the Server-Timing header, with durations in milliseconds.'''
+        phases = dict(self.phases, total=self.total)
+        return ", ".join(f"{name};dur={seconds * 1000:.2f}" for name, seconds in phases.items())
+
+
+class phase:
+    '''Context manager adding the time spent in its block to phase name of the current request.'''
+    __slots__ = ("name", "timings", "start")
+
+    def __init__(self, name):
+        self.name = name
+        self.timings = g.get("timings")
+
+    def __enter__(self):
+        if self.timings is not None:
+            self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        if self.timings is not None:
+            self.timings.add(self.name, time.perf_counter() - self.start)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("timing_starts", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["timing_starts"].pop()
+    timings = g.get("timings")
+    if timings is not None:
+        timings.add("db", elapsed)
+        timings.statements.append((statement, parameters, cursor.rowcount, elapsed))
+
+
+def handle_error(exception_context):
+    # after_cursor_execute isn't called for a statement that fails
+    starts = exception_context.connection.info.get("timing_starts")
+    if starts:
+        starts.pop()
+
+
+class RequestTiming:
+    '''Flask extension timing requests, if SERVER_TIMING or SLOW_QUERY_SECONDS is set.'''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("SERVER_TIMING", False)
+        app.config.setdefault("SLOW_QUERY_SECONDS", None)
+        if not app.config["SERVER_TIMING"] and app.config["SLOW_QUERY_SECONDS"] is None:
+            return
+
+        server_timing = app.config["SERVER_TIMING"]
+        slow_seconds = app.config["SLOW_QUERY_SECONDS"]
+
+        @app.before_request
+        def start_timing():
+            # the engine is created on first use, so its events are registered here
+            from bicycles import db
+            engine = db.engine
+            if not event.contains(engine, "before_cursor_execute", before_cursor_execute):
+                event.listen(engine, "before_cursor_execute", before_cursor_execute)
+                event.listen(engine, "after_cursor_execute", after_cursor_execute)
+                event.listen(engine, "handle_error", handle_error)
+            g.timings = Timings()
+
+        @app.after_request
+        def finish_timing(response):
+            timings = g.get("timings")
+            if timings is None:
+                return response
+            timings.total = time.perf_counter() - timings.start
+            if server_timing:
+                response.headers["Server-Timing"] = timings.header()
+            if slow_seconds is not None:
+                entry = {"method": request.method, "path": request.full_path.rstrip("?"),
+                         "status": response.status_code}
+                response.call_on_close(lambda: log_if_slow(timings, entry, slow_seconds))
+            return response
+
+
+def log_if_slow(timings, entry, slow_seconds):
+    '''Log the request timed by timings, if it took longer than slow_seconds.'''
+    elapsed = time.perf_counter() - timings.start
+    if elapsed <= slow_seconds:
+        return
+
+    phases = dict(timings.phases, total=timings.total, write=elapsed - timings.total)
+    entry.update(
+        ms=round(elapsed * 1000, 2),
+        phases_ms={name: round(seconds * 1000, 2) for name, seconds in phases.items()},
+        statements=[{"sql": " ".join(sql.split()),
+                     "params": repr(parameters)[:MAX_PARAMS_LENGTH],
+                     "rowcount": rowcount,
+                     "ms": round(seconds * 1000, 2)}
+                    for sql, parameters, rowcount, seconds in timings.statements])
+    slow_query_logger.warning(json.dumps(entry, default=str))
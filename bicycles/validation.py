@@ -0,0 +1,194 @@
+'''
+Validate the parameters of counts submitted to the API.
+
+The rules are compiled once, from the columns of the model, into a CountValidator: a table from
+each field to its type and to the checks that apply to it, such as set membership tests, which
+return an error message. Checking a record is then a dict lookup per parameter.
+'''
+import datetime
+import re
+
+# fields required to create a new count
+REQUIRED_FIELDS = (
+    'x',
+    'y',
+    'objectid',
+    'setdate',
+    'mcd',
+    'road',
+    'cntdir',
+    'fromlmt',
+    'tolmt',
+    'type',
+    'latitude',
+    'longitude',
+    'factor',
+    'axle',
+    'outdir',
+    'indir',
+    'aadb',
+    'co_name',
+    'mun_name',
+    'bikepedgro',
+)
+
+TYPE_INT = ('objectid', 'mcd', 'route', 'factor', 'aadb')
+TYPE_FLOAT = ('x', 'y', 'latitude', 'longitude')
+TYPE_STRING = (
+    'road',
+    'fromlmt',
+    'tolmt',
+    'type',
+    'mun_name',
+    'program',
+    'bikepedgro',
+    'bikepedfac',
+)
+
+# allowed values of fields, in the order they are listed in error messages
+CNT_DIR = ('both', 'east', 'west', 'north', 'south')
+AXLE = (0, 1, 1.02)
+IN_OUT_DIR = ('E', 'W', 'N', 'S')
+COUNTIES = (
+    'Bucks',
+    'Chester',
+    'Delaware',
+    'Montgomery',
+    'Philadelphia',
+    'Burlington',
+    'Camden',
+    'Gloucester',
+    'Mercer',
+)
+# facility types, the values of the bikepedfac dimension; counts can be filtered by them too
+FACILITIES = (
+    'Multiuse Trail',
+    'Sidepath',
+    'Striped Shoulder',
+    'Bike Lane',
+    'Mixed Traffic',
+    'Buffered Bike Lane',
+    'Sharrow',
+)
+ALLOWED_VALUES = {
+    'cntdir': CNT_DIR,
+    'axle': AXLE,
+    'indir': IN_OUT_DIR,
+    'outdir': IN_OUT_DIR,
+    'co_name': COUNTIES,
+    'bikepedfac': FACILITIES,
+}
+# fields that may also be left blank (None or ''), as the facility of many counts is
+BLANK_ALLOWED = ('bikepedfac',)
+
+ISO_DATE = re.compile(r"[0-9]{4}-[0-9]{2}-[0-9]{2}")
+
+
+def parse_setdate(value):
+    '''
+    Parse setdate, which must be a date in the format YYYY-MM-DD, to a datetime. Raises ValueError
+    if it isn't.
+    '''
+    if not isinstance(value, str):
+        raise ValueError(f"{value!r} is not a date")
+    # strptime() is slow, so well-formed dates are parsed with fromisoformat(); anything else is
+    # left to strptime(), which also accepts e.g. 2018-3-5, to accept or reject
+    if ISO_DATE.fullmatch(value):
+        try:
+            return datetime.datetime.fromisoformat(value)
+        except ValueError:
+            pass
+    return datetime.datetime.strptime(value, "%Y-%m-%d")
+
+
+def value_check(field, allowed, blank=False):
+    allowed_set = frozenset(allowed + (None, "") if blank else allowed)
+    error = f"{field} must be one of " + ", ".join(str(v) for v in allowed)
+
+    def check(value):
+        try:
+            if value not in allowed_set:
+                return error
+        except TypeError:
+            # unhashable values (lists, objects) can't be equal to any allowed value
+            return error
+    return check
+
+
+def setdate_check(field):
+    error = f"{field} must be in the format 'YYYY-MM-DD"
+
+    def check(value):
+        try:
+            parse_setdate(value)
+        except ValueError:
+            return error
+    return check
+
+
+class CountValidator:
+    '''
+    Check the parameters of counts against the fields of table (the columns of the model) and the
+    type and allowed values of each field.
+    '''
+
+    def __init__(self, table):
+        self.field_names = frozenset(column.name for column in table.c)
+        self.required_fields = REQUIRED_FIELDS
+        self.blank_allowed = frozenset(BLANK_ALLOWED)
+
+        # type checks, the most common, are made inline: field -> (type, error)
+        self.types = {}
+        for fields, python_type, message in ((TYPE_INT, int, "must be an integer"),
+                                             (TYPE_FLOAT, float, "must be a float"),
+                                             (TYPE_STRING, str, "must be text")):
+            for field in fields:
+                self.types[field] = (python_type, f"{field} {message}")
+
+        # other checks: field -> functions returning an error, or None
+        checks = {}
+        for field, allowed in ALLOWED_VALUES.items():
+            checks.setdefault(field, []).append(value_check(field, allowed,
+                                                            field in BLANK_ALLOWED))
+        checks.setdefault('setdate', []).append(setdate_check('setdate'))
+        self.checks = {field: tuple(field_checks) for field, field_checks in checks.items()}
+
+    def missing(self, params):
+        '''Return the required fields missing from params.'''
+        return [field for field in self.required_fields if field not in params]
+
+    def check(self, params):
+        '''Return the unknown parameters in params and the errors in the known ones.'''
+        field_names, types, checks = self.field_names, self.types, self.checks
+        blank_allowed = self.blank_allowed
+
+        unknown_params = []
+        bad_params = []
+        for k, v in params.items():
+            if k not in field_names:
+                unknown_params.append(k)
+            rule = types.get(k)
+            if rule is not None and type(v) is not rule[0]:
+                if v is not None or k not in blank_allowed:
+                    # a value of the wrong type is only reported as such
+                    bad_params.append(rule[1])
+                    continue
+            field_checks = checks.get(k)
+            if field_checks is not None:
+                for check in field_checks:
+                    error = check(v)
+                    if error is not None:
+                        bad_params.append(error)
+        return unknown_params, bad_params
+
+    def check_many(self, records, required=True):
+        '''
+        Check a list of records in one pass. Returns a list with (missing fields, unknown
+        parameters, errors) for each record; missing fields are only looked for if required.
+        '''
+        missing, check = self.missing, self.check
+        results = []
+        for params in records:
+            unknown_params, bad_params = check(params)
+            results.append((missing(params) if required else [], unknown_params, bad_params))
+        return results
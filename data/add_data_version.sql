@@ -0,0 +1,13 @@
+/* mysql -u <username> -p dvrpc < data/add_data_version.sql
+# adds data_version, the version of the counts and weather that the API bumps in the transaction
+# of every write to them. Responses are cached under it and their ETags made from it, so that a
+# write through any worker is seen by every worker. */
+
+
+CREATE TABLE IF NOT EXISTS data_version (
+    Id INT NOT NULL PRIMARY KEY,
+    Version BIGINT NOT NULL DEFAULT 0,
+    Updated DATETIME
+);
+
+INSERT IGNORE INTO data_version (Id, Version) VALUES (1, 0);
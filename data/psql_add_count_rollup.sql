@@ -0,0 +1,35 @@
+/* psql -U <username> <database> < data/psql_add_count_rollup.sql
+# adds count_rollup, the number of counts and the sum of their AADB per county, facility, year
+# and month, from which the API answers counts/stats when ROLLUPS is set, and fills it from the
+# counts. Set ROLLUPS once it has run: writes made before then aren't in the rollups, so if
+# flask rollups check reports any difference, run flask rollups rebuild.
+# Group_Key is computed as the API's rollups.group_key() computes it. */
+
+
+CREATE TABLE IF NOT EXISTS count_rollup (
+    Group_Key VARCHAR(40) NOT NULL PRIMARY KEY,
+    Co_name TEXT,
+    BikePedFac TEXT,
+    SETYear INT,
+    Month INT,
+    Counts BIGINT NOT NULL DEFAULT 0,
+    AADB_Counts BIGINT NOT NULL DEFAULT 0,
+    AADB_Sum BIGINT NOT NULL DEFAULT 0
+);
+
+BEGIN;
+
+LOCK TABLE bicycle_count IN SHARE MODE;
+
+DELETE FROM count_rollup;
+
+INSERT INTO count_rollup (Group_Key, Co_name, BikePedFac, SETYear, Month, Counts, AADB_Counts,
+                          AADB_Sum)
+SELECT MD5(CONCAT_WS(CHR(31), COALESCE(Co_name, '\N'), COALESCE(BikePedFac, '\N'),
+                     COALESCE(SETYear::TEXT, '\N'), COALESCE(Month::TEXT, '\N'))),
+       Co_name, BikePedFac, SETYear, Month, Counts, AADB_Counts, AADB_Sum
+FROM (SELECT Co_name, BikePedFac, SETYear, EXTRACT(MONTH FROM Set_Date)::INT AS Month,
+             COUNT(*) AS Counts, COUNT(AADB) AS AADB_Counts, COALESCE(SUM(AADB), 0) AS AADB_Sum
+      FROM bicycle_count GROUP BY 1, 2, 3, 4) totals;
+
+COMMIT;
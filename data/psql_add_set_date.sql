@@ -0,0 +1,12 @@
+/* psql -U <username> <database> < data/psql_add_set_date.sql
+# adds Set_Date, the date part of SETDate, which the API joins to weather on instead of
+# DATE(SETDate) so the join can use an index. The API keeps it in sync on POST and PUT. */
+
+
+ALTER TABLE bicycle_count ADD COLUMN IF NOT EXISTS Set_Date DATE;
+
+UPDATE bicycle_count SET Set_Date = DATE(SETDate) WHERE Set_Date IS NULL;
+
+CREATE INDEX IF NOT EXISTS ix_bicycle_count_set_date ON bicycle_count (Set_Date);
+
+ANALYZE bicycle_count;
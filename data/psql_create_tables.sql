@@ -31,15 +31,43 @@ CREATE TABLE bicycle_count (
     GlobalID TEXT,
     Program TEXT,
     BikePedGro TEXT,
-    BikePedFac TEXT
+    BikePedFac TEXT,
+    Set_Date DATE
 );
 
+CREATE INDEX ix_bicycle_count_set_date ON bicycle_count (Set_Date);
+CREATE INDEX ix_bicycle_count_setdate_recordnum ON bicycle_count (SETDate, RecordNum);
+CREATE INDEX ix_bicycle_count_bikepedfac ON bicycle_count (BikePedFac);
+/* once the PostGIS geom column has been added:
+CREATE INDEX ix_bicycle_count_geom ON bicycle_count USING gist (geom); */
+
 CREATE TABLE IF NOT EXISTS weather (
-    Station TEXT,
+    Station VARCHAR(20) NOT NULL,
     Name TEXT,
-    Date DATE PRIMARY KEY,
+    Date DATE NOT NULL,
     Prcp FLOAT,
     Tavg INT,
     Tmax INT,
-    Tmin INT
-);
\ No newline at end of file
+    Tmin INT,
+    Updated TIMESTAMP,
+    PRIMARY KEY (Station, Date)
+);
+
+CREATE TABLE IF NOT EXISTS count_rollup (
+    Group_Key VARCHAR(40) NOT NULL PRIMARY KEY,
+    Co_name TEXT,
+    BikePedFac TEXT,
+    SETYear INT,
+    Month INT,
+    Counts BIGINT NOT NULL DEFAULT 0,
+    AADB_Counts BIGINT NOT NULL DEFAULT 0,
+    AADB_Sum BIGINT NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS data_version (
+    Id INT NOT NULL PRIMARY KEY,
+    Version BIGINT NOT NULL DEFAULT 0,
+    Updated TIMESTAMP
+);
+
+INSERT INTO data_version (Id, Version) VALUES (1, 0) ON CONFLICT DO NOTHING;
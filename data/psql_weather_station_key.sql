@@ -0,0 +1,15 @@
+/* psql -U <username> <database> < data/psql_weather_station_key.sql
+# keys weather on (Station, Date) rather than Date, so that flask load-weather can hold daily
+# summaries of more than one station, and adds Updated, the time a row was last inserted or
+# changed, which the API's ETags take into account. */
+
+
+ALTER TABLE weather ALTER COLUMN Station TYPE VARCHAR(20), ALTER COLUMN Station SET NOT NULL;
+
+ALTER TABLE weather DROP CONSTRAINT IF EXISTS weather_pkey;
+
+ALTER TABLE weather ADD PRIMARY KEY (Station, Date);
+
+ALTER TABLE weather ADD COLUMN IF NOT EXISTS Updated TIMESTAMP;
+
+UPDATE weather SET Updated = CURRENT_TIMESTAMP WHERE Updated IS NULL;
@@ -0,0 +1,13 @@
+/* mysql -u <username> -p dvrpc < data/weather_station_key.sql
+# keys weather on (Station, Date) rather than Date, so that flask load-weather can hold daily
+# summaries of more than one station, and adds Updated, the time a row was last inserted or
+# changed, which the API's ETags take into account. */
+
+
+ALTER TABLE weather MODIFY Station VARCHAR(20) NOT NULL;
+
+ALTER TABLE weather DROP PRIMARY KEY, ADD PRIMARY KEY (Station, Date);
+
+ALTER TABLE weather ADD COLUMN Updated DATETIME;
+
+UPDATE weather SET Updated = CURRENT_TIMESTAMP WHERE Updated IS NULL;
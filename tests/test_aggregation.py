@@ -0,0 +1,85 @@
+import datetime
+import math
+
+import pytest
+
+from bicycles import db, models
+
+
+@pytest.fixture
+def stats_client(flask_client):
+    '''The flask client, with set_date filled in and the weather of some days of the counts.'''
+    for count in models.BicycleCount.query:
+        count.set_date = count.setdate.date()
+    for day, prcp in [(12, 0), (13, 0.05), (3, 0.6)]:
+        month = 3 if day > 10 else 4
+        db.session.add(models.Weather(station="USW00013739", date=datetime.date(2018, month, day),
+                                      prcp=prcp))
+    db.session.commit()
+    return flask_client
+
+
+def all_counts(flask_client):
+    return flask_client.get("/api/counts").get_json()
+
+
+def nearest_rank(values, percent):
+    values = sorted(values)
+    return values[math.ceil(percent * len(values) / 100) - 1]
+
+
+def test_counts_stats_without_group_by_covers_all_counts(stats_client):
+    response = stats_client.get("/api/counts/stats")
+    aadbs = [count["aadb"] for count in all_counts(stats_client)]
+    assert response.get_json() == [{"count": len(aadbs), "avg_aadb": sum(aadbs) / len(aadbs)}]
+
+
+def test_counts_stats_groups_by_county(stats_client):
+    response = stats_client.get("/api/counts/stats?group_by=co_name&metrics=count,max_aadb")
+    expected = {}
+    for count in all_counts(stats_client):
+        group = expected.setdefault(count["co_name"], {"count": 0, "max_aadb": 0})
+        group["count"] += 1
+        group["max_aadb"] = max(group["max_aadb"], count["aadb"])
+    assert response.get_json() == [dict(values, co_name=name)
+                                   for name, values in sorted(expected.items())]
+
+
+@pytest.mark.parametrize("percent", [1, 25, 50, 90, 99])
+def test_counts_stats_percentiles_are_nearest_rank(stats_client, percent):
+    metric = f"p{percent}_aadb"
+    response = stats_client.get(f"/api/counts/stats?group_by=co_name&metrics={metric}")
+    counts = all_counts(stats_client)
+    for group in response.get_json():
+        aadbs = [count["aadb"] for count in counts if count["co_name"] == group["co_name"]]
+        assert group[metric] == nearest_rank(aadbs, percent)
+
+
+def test_counts_stats_groups_by_month_and_year(stats_client):
+    response = stats_client.get("/api/counts/stats?group_by=setyear,month&metrics=count")
+    assert response.get_json() == [
+        {"setyear": 2018, "month": 3, "count": 2},
+        {"setyear": 2018, "month": 4, "count": 5},
+        {"setyear": 2018, "month": 5, "count": 2},
+        {"setyear": 2018, "month": 11, "count": 1},
+    ]
+
+
+def test_counts_stats_groups_by_precipitation_bin(stats_client):
+    response = stats_client.get("/api/counts/stats?group_by=prcp_bin&metrics=count")
+    counts = {group["prcp_bin"]: group["count"] for group in response.get_json()}
+    assert counts == {None: 7, 0: 1, 0.01: 1, 0.5: 1}
+
+
+@pytest.mark.parametrize("query", ["group_by=notvalid", "metrics=notvalid", "metrics=p0_aadb",
+                                   "metrics=p100_aadb", "metrics=,"])
+def test_counts_stats_bad_params(stats_client, query):
+    response = stats_client.get("/api/counts/stats?" + query)
+    assert response.status_code == 400
+
+
+def test_counts_stats_returns_304_if_etag_matches(stats_client):
+    etag = stats_client.get("/api/counts/stats?group_by=co_name").headers["ETag"]
+    response = stats_client.get("/api/counts/stats?group_by=co_name",
+                                headers={"If-None-Match": etag})
+    assert response.status_code == 304
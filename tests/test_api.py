@@ -1,6 +1,35 @@
+import datetime
+import json
+
 import pytest
+from sqlalchemy import text
+
+from bicycles import api, caching, db, models
+
+# a count that the API accepts, for the tests that add counts
+new_count = {
+    'x': -75.17147,
+    'y': 39.95372,
+    'objectid': 60001,
+    'setdate': '2019-09-30',
+    'mcd': 4210160103,
+    'road': 'arch st eastbound lanes',
+    'cntdir': 'east',
+    'fromlmt': '18th st',
+    'tolmt': '17th st',
+    'type': 'Bicycle 2',
+    'latitude': 39.95372,
+    'longitude': -75.17147,
+    'factor': 0,
+    'axle': 1.02,
+    'outdir': 'W',
+    'indir': 'E',
+    'aadb': 210,
+    'co_name': 'Philadelphia',
+    'mun_name': 'Central',
+    'bikepedgro': 'Mixed',
+}
 
-from bicycles import api
 
 ####################
 # helper functions #
@@ -117,6 +146,8 @@ def test_check_params_string_types_bad(params):
                           {'indir': 1},
                           {'outdir': 1},
                           {'co_name': 1},
+                          {'bikepedfac': 'Bike Path'},
+                          {'bikepedfac': ' '},
                          ])
 def test_check_params_values_bad(params):
     unknown_params, bad_params = api.check_params(params)
@@ -127,6 +158,8 @@ def test_check_params_values_bad(params):
                          [{'setdate': '2019-09-31'},
                           {'setdate': '19-01-31'},
                           {'setdate': '2019-02-29'},
+                          {'setdate': 20200101},
+                          {'setdate': ['2019-09-30']},
                          ])
 def test_check_params_setdate_bad(params):
     unknown_params, bad_params = api.check_params(params)
@@ -150,6 +183,8 @@ def test_check_params_setdate_bad(params):
                           {'program': 'a program'},
                           {'bikepedgro': 'something'},
                           {'bikepedfac': 'Mixed Traffic'},
+                          {'bikepedfac': ''},
+                          {'bikepedfac': None},
                           {'cntdir': "both"},
                           {'cntdir': "north"},
                           {'cntdir': "east"},
@@ -183,6 +218,38 @@ def test_check_params_all_good(params):
     assert len(bad_params) == 0
 
 
+# encode_cursor() / decode_cursor()
+
+
+def test_cursor_round_trip():
+    setdate = datetime.datetime(2018, 3, 12, 20, tzinfo=datetime.timezone.utc)
+    cursor = api.encode_cursor(setdate, 140313)
+    assert api.decode_cursor(cursor) == (setdate, 140313)
+
+
+def test_cursor_round_trip_without_setdate():
+    assert api.decode_cursor(api.encode_cursor(None, 140313)) == (None, 140313)
+
+
+@pytest.mark.parametrize("cursor", ["notvalid", "", "WzEsMl0="])
+def test_decode_cursor_bad(cursor):
+    with pytest.raises(ValueError):
+        api.decode_cursor(cursor)
+
+
+# parse_fields()
+
+
+def test_parse_fields_returns_fields_in_order_of_columns():
+    assert api.parse_fields("aadb, recordnum,prcp,aadb") == ("recordnum", "aadb", "prcp")
+
+
+@pytest.mark.parametrize("value", ["notafield", "recordnum,set_date", "distance", ","])
+def test_parse_fields_bad(value):
+    with pytest.raises(ValueError):
+        api.parse_fields(value)
+
+
 def test_check_optional_params():
     assert False
 
@@ -230,9 +297,63 @@ def test_count_get_returns_404_if_no_matching_recordnum(flask_client):
     assert response.status_code == 404 and json_data["error"] == "No matching record found."
 
 
+def test_count_get_does_not_return_set_date(flask_client):
+    response = flask_client.get("/api/counts/140313")
+    json_data = response.get_json()
+    assert "set_date" not in json_data[0] and "setdate" in json_data[0]
+
+
+def test_count_get_returns_304_if_etag_matches(flask_client):
+    etag = flask_client.get("/api/counts/140313").headers["ETag"]
+    response = flask_client.get("/api/counts/140313", headers={"If-None-Match": etag})
+    assert response.status_code == 304 and not response.data
+
+
+def test_count_get_returns_only_fields(flask_client):
+    response = flask_client.get("/api/counts/140313?fields=aadb,recordnum,tavg")
+    assert response.get_json() == [{"recordnum": 140313, "aadb": 123, "tavg": None}]
+
+
+def test_count_get_etag_depends_on_fields(flask_client):
+    etag = flask_client.get("/api/counts/140313").headers["ETag"]
+    response = flask_client.get("/api/counts/140313?fields=aadb",
+                                headers={"If-None-Match": etag})
+    assert response.status_code == 200 and response.get_json() == [{"aadb": 123}]
+
+
+def test_count_get_returns_error_if_unknown_fields(flask_client):
+    response = flask_client.get("/api/counts/140313?fields=aadb,notafield")
+    assert response.status_code == 400 and "notafield" in response.get_json()["error"]
+
+
+def test_count_get_returns_200_if_etag_does_not_match(flask_client):
+    etag = flask_client.get("/api/counts/140313").headers["ETag"]
+    response = flask_client.get("/api/counts/140302", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+
+
 # put
 
 
+def test_count_put_changes_fields(flask_client):
+    response = flask_client.put("/api/counts/140313", json={"aadb": 7, "setdate": "2019-05-01"})
+    count = flask_client.get("/api/counts/140313").get_json()[0]
+    assert (response.status_code == 200 and response.headers["Location"].endswith("/140313")
+            and count["aadb"] == 7 and count["setyear"] == 2019)
+
+
+def test_count_put_accepts_blank_facility(flask_client):
+    facility = flask_client.get("/api/counts/137287").get_json()[0]["bikepedfac"]
+    response = flask_client.put("/api/counts/137287", json={"aadb": 7, "bikepedfac": facility})
+    assert facility == "" and response.status_code == 200
+
+
+def test_count_put_returns_404_if_no_matching_recordnum(flask_client):
+    response = flask_client.put("/api/counts/1", json={"aadb": 7})
+    json_data = response.get_json()
+    assert response.status_code == 404 and json_data["error"] == "No matching record found."
+
+
 # delete
 
 
@@ -254,11 +375,296 @@ def test_count_delete_returns_404_if_no_matching_recordnum(flask_client):
 # counts() #
 ############
 
+# get
+
+
+def test_counts_get_limit_returns_page_and_next_link(flask_client):
+    response = flask_client.get("/api/counts?limit=4")
+    json_data = response.get_json()
+    assert (response.status_code == 200 and len(json_data) == 4
+            and 'rel="next"' in response.headers["Link"])
+
+
+def test_counts_get_pages_cover_all_counts(flask_client):
+    recordnums = []
+    url = "/api/counts?limit=3"
+    while url:
+        response = flask_client.get(url)
+        recordnums.extend(count["recordnum"] for count in response.get_json())
+        link = response.headers.get("Link")
+        url = link[1:link.index(">")] if link else None
+    all_recordnums = [count["recordnum"] for count in flask_client.get("/api/counts").get_json()]
+    assert recordnums == all_recordnums
+
+
+@pytest.mark.parametrize("limit", [1, 2, 3])
+def test_counts_get_pages_cover_counts_without_setdate(flask_client, limit):
+    db.session.execute("UPDATE bicycle_count SET setdate = NULL "
+                       "WHERE recordnum IN (137287, 140313, 141908)")
+    recordnums = []
+    url = f"/api/counts?limit={limit}"
+    while url:
+        response = flask_client.get(url)
+        assert response.status_code == 200
+        recordnums.extend(count["recordnum"] for count in response.get_json())
+        link = response.headers.get("Link")
+        url = link[1:link.index(">")] if link else None
+    all_recordnums = [count["recordnum"] for count in flask_client.get("/api/counts").get_json()]
+    assert recordnums == all_recordnums and len(recordnums) == 10
+
+
+def test_counts_get_pages_of_fields_cover_all_counts(flask_client):
+    aadbs = []
+    url = "/api/counts?limit=3&fields=aadb"
+    while url:
+        response = flask_client.get(url)
+        assert all(list(count) == ["aadb"] for count in response.get_json())
+        aadbs.extend(count["aadb"] for count in response.get_json())
+        link = response.headers.get("Link")
+        url = link[1:link.index(">")] if link else None
+    assert aadbs == [count["aadb"] for count in flask_client.get("/api/counts").get_json()]
+
+
+def add_weather():
+    '''Add the weather of a wet day, 2019-09-30, and of a dry one, 2019-10-01.'''
+    for date, prcp in [(datetime.date(2019, 9, 30), 0.5), (datetime.date(2019, 10, 1), 0)]:
+        db.session.add(models.Weather(station="USW00013739", date=date, prcp=prcp))
+    db.session.commit()
+
+
+def test_counts_get_fields_with_prcp_filter(flask_client):
+    add_weather()
+    flask_client.post("/api/counts", json=dict(new_count, aadb=1))
+    flask_client.post("/api/counts", json=dict(new_count, aadb=2, setdate="2019-10-01"))
+    response = flask_client.get("/api/counts?prcp=0.25&fields=aadb,prcp")
+    assert response.status_code == 200 and response.get_json() == [{"aadb": 1, "prcp": 0.5}]
+
+
+def test_counts_get_prcp_filter_matches_counts_written_through_api(flask_client):
+    add_weather()
+    # set_date, which the weather is joined on, is filled in by POST and PUT
+    wet = flask_client.post("/api/counts", json=new_count).headers["Location"]
+    dry = flask_client.post("/api/counts", json=dict(new_count, setdate="2019-10-01"))
+    before = flask_client.get("/api/counts?prcp=0.25").get_json()
+    flask_client.put(dry.headers["Location"], json={"setdate": "2019-09-30"})
+    after = flask_client.get("/api/counts?prcp=0.25&fields=recordnum,prcp").get_json()
+    assert ([count["recordnum"] for count in before] == [int(wet.rsplit("/", 1)[1])]
+            and before[0]["prcp"] == 0.5
+            and after == [{"recordnum": int(location.rsplit("/", 1)[1]), "prcp": 0.5}
+                          for location in (wet, dry.headers["Location"])])
+
+
+def test_counts_get_stream_returns_only_fields(flask_client):
+    response = flask_client.get("/api/counts?stream=1&fields=recordnum,latitude,longitude,aadb")
+    counts = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert (len(counts) == 10
+            and all(list(count) == ["recordnum", "latitude", "longitude", "aadb"]
+                    for count in counts))
+
+
+def test_counts_get_no_next_link_on_last_page(flask_client):
+    response = flask_client.get("/api/counts?limit=10")
+    assert response.status_code == 200 and "Link" not in response.headers
+
+
+def test_counts_get_returns_304_if_etag_matches(flask_client):
+    etag = flask_client.get("/api/counts?bikepedfac=Bike%20Lane").headers["ETag"]
+    response = flask_client.get("/api/counts?bikepedfac=Bike%20Lane",
+                                headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+
+def test_counts_get_etag_depends_on_params(flask_client):
+    etag = flask_client.get("/api/counts").headers["ETag"]
+    response = flask_client.get("/api/counts?bikepedfac=Bike%20Lane",
+                                headers={"If-None-Match": etag})
+    assert response.status_code == 200
+
+
+def test_counts_get_etag_changes_after_delete(flask_client):
+    etag = flask_client.get("/api/counts").headers["ETag"]
+    flask_client.delete("/api/counts/140313")
+    response = flask_client.get("/api/counts", headers={"If-None-Match": etag})
+    assert response.status_code == 200 and len(response.get_json()) == 9
+
+
+def test_counts_get_etag_changes_after_write_in_another_worker(flask_client):
+    etag = flask_client.get("/api/counts").headers["ETag"]
+    # an update that keeps the number of counts and their last updated time
+    with flask_client.application.app_context():
+        db.session.execute(text("UPDATE bicycle_count SET aadb = 1 WHERE recordnum = 140313"))
+        db.session.execute(caching.bump_version_statement, {"updated": None})
+        db.session.commit()
+    response = flask_client.get("/api/counts", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+
+
+def test_counts_get_stream_returns_ndjson(flask_client):
+    response = flask_client.get("/api/counts?stream=1")
+    lines = response.get_data(as_text=True).splitlines()
+    assert (response.status_code == 200 and response.mimetype == "application/x-ndjson"
+            and len(lines) == 10 and json.loads(lines[0])["recordnum"] == 140313)
+
+
+def test_counts_get_stream_selected_by_accept_header(flask_client):
+    response = flask_client.get("/api/counts", headers={"Accept": "application/x-ndjson"})
+    assert response.status_code == 200 and response.mimetype == "application/x-ndjson"
+
+
+def test_counts_get_stream_returns_404_if_no_matching_counts(flask_client):
+    response = flask_client.get("/api/counts?stream=1&bikepedfac=Sidepath")
+    assert response.status_code == 404
+
+
+def test_counts_get_stream_cannot_be_paged(flask_client):
+    response = flask_client.get("/api/counts?stream=1&limit=5")
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("query", ["limit=notvalid", "limit=0", "limit=10001", "after=notvalid"])
+def test_counts_get_bad_pagination_params(flask_client, query):
+    response = flask_client.get("/api/counts?" + query)
+    assert response.status_code == 400
+
+
+# post
+
+
+def test_counts_post_creates_count(flask_client):
+    response = flask_client.post("/api/counts", json=new_count)
+    count = flask_client.get(response.headers["Location"]).get_json()[0]
+    assert (response.status_code == 201 and count["aadb"] == 210 and count["setyear"] == 2019
+            and len(flask_client.get("/api/counts").get_json()) == 11)
+
+
+def test_counts_post_accepts_count_without_facility(flask_client):
+    response = flask_client.post("/api/counts", json=dict(new_count, bikepedfac=None))
+    count = flask_client.get(response.headers["Location"]).get_json()[0]
+    assert response.status_code == 201 and count["bikepedfac"] is None
+
+
+# patch
+
+
+def test_counts_patch_applies_each_patch(flask_client):
+    response = flask_client.patch("/api/counts",
+                                  json=[{"recordnum": 140313, "fields": {"aadb": 7}},
+                                        {"recordnum": 140302, "fields": {"aadb": 8,
+                                                                         "setdate": "2019-05-01"}}])
+    first = flask_client.get("/api/counts/140313").get_json()[0]
+    second = flask_client.get("/api/counts/140302").get_json()[0]
+    unchanged = flask_client.get("/api/counts/139020").get_json()[0]
+    assert (response.status_code == 200 and first["aadb"] == 7 and second["aadb"] == 8
+            and second["setyear"] == 2019 and unchanged["aadb"] == 125)
+
+
+def test_counts_patch_adds_ndjson(flask_client):
+    body = json.dumps({"recordnum": 140313, "fields": {"bikepedfac": "Sharrow"}}) + "\n"
+    response = flask_client.patch("/api/counts", data=body, content_type="application/x-ndjson")
+    count = flask_client.get("/api/counts/140313").get_json()[0]
+    assert response.status_code == 200 and count["bikepedfac"] == "Sharrow"
+
+
+@pytest.mark.parametrize("patch",
+                         [{"recordnum": 140302, "fields": {"aadb": "many"}},
+                          {"recordnum": 140302, "fields": {"setdate": 20200101}},
+                          {"recordnum": 140302, "fields": {"notafield": 1}},
+                          {"recordnum": 140302, "fields": {"recordnum": 1}},
+                          {"recordnum": 140302, "fields": {}},
+                          {"recordnum": "140302", "fields": {"aadb": 1}},
+                          {"recordnum": 140302},
+                          {"recordnum": 140313, "fields": {"aadb": 1}},
+                         ])
+def test_counts_patch_changes_nothing_if_any_patch_has_errors(flask_client, patch):
+    response = flask_client.patch("/api/counts",
+                                  json=[{"recordnum": 140313, "fields": {"aadb": 7}}, patch])
+    errors = response.get_json()["errors"]
+    count = flask_client.get("/api/counts/140313").get_json()[0]
+    assert (response.status_code == 400 and [e["index"] for e in errors] == [1]
+            and count["aadb"] == 123)
+
+
+def test_counts_patch_returns_404_if_any_count_does_not_exist(flask_client):
+    response = flask_client.patch("/api/counts",
+                                  json=[{"recordnum": 140313, "fields": {"aadb": 7}},
+                                        {"recordnum": 1, "fields": {"aadb": 8}}])
+    count = flask_client.get("/api/counts/140313").get_json()[0]
+    assert (response.status_code == 404 and response.get_json()["error"].startswith(
+        "No matching record found for recordnum(s): 1.") and count["aadb"] == 123)
+
+
+#################
+# counts_bulk() #
+#################
+
+
+def test_counts_bulk_adds_json_array(flask_client):
+    response = flask_client.post("/api/counts/bulk",
+                                 json=[new_count, dict(new_count, aadb=55, program='Project')])
+    recordnums = response.get_json()["recordnums"]
+    second = flask_client.get(f"/api/counts/{recordnums[1]}").get_json()[0]
+    assert (response.status_code == 201 and len(recordnums) == 2
+            and second["aadb"] == 55 and second["setyear"] == 2019)
+
+
+def test_counts_bulk_adds_ndjson(flask_client):
+    body = "\n".join(json.dumps(dict(new_count, aadb=n)) for n in range(3)) + "\n"
+    response = flask_client.post("/api/counts/bulk", data=body,
+                                 content_type="application/x-ndjson")
+    get_response = flask_client.get("/api/counts")
+    assert response.status_code == 201 and len(get_response.get_json()) == 13
+
+
+def test_counts_bulk_adds_nothing_if_any_count_has_errors(flask_client):
+    missing_road = {k: v for k, v in new_count.items() if k != 'road'}
+    response = flask_client.post("/api/counts/bulk",
+                                 json=[new_count, missing_road, dict(new_count, aadb="many")])
+    errors = response.get_json()["errors"]
+    get_response = flask_client.get("/api/counts")
+    assert (response.status_code == 400 and [e["index"] for e in errors] == [1, 2]
+            and errors[0]["errors"] == ["Missing required parameters: road"]
+            and len(get_response.get_json()) == 10)
+
+
+def test_counts_bulk_reports_setdate_that_is_not_text(flask_client):
+    response = flask_client.post("/api/counts/bulk",
+                                 json=[new_count, dict(new_count, setdate=20200101)])
+    errors = response.get_json()["errors"]
+    assert (response.status_code == 400 and [e["index"] for e in errors] == [1]
+            and errors[0]["errors"] == ["Error(s) in submitted parameters: setdate must be in "
+                                        "the format 'YYYY-MM-DD"]
+            and len(flask_client.get("/api/counts").get_json()) == 10)
+
+
+@pytest.mark.parametrize("data, content_type",
+                         [(json.dumps(new_count), "application/json"),
+                          ("[", "application/json"),
+                          ("{}\nnot json", "application/x-ndjson"),
+                          ("[]", "application/json"),
+                          (json.dumps([new_count]), "text/plain"),
+                         ])
+def test_counts_bulk_bad_body(flask_client, data, content_type):
+    response = flask_client.post("/api/counts/bulk", data=data, content_type=content_type)
+    assert response.status_code == 400
+
 
 #############
 # closest() #
 #############
 
+def test_closest_returns_only_fields(flask_client):
+    response = flask_client.get("/api/counts/closest?lat=39.95&lon=-75.17&k=3"
+                                "&fields=distance,aadb")
+    counts = response.get_json()
+    assert (response.status_code == 200 and len(counts) == 3
+            and all(list(count) == ["aadb", "distance"] for count in counts)
+            and counts == sorted(counts, key=lambda count: count["distance"]))
+
+
+def test_closest_returns_error_if_unknown_fields(flask_client):
+    response = flask_client.get("/api/counts/closest?lat=39.95&lon=-75.17&fields=notafield")
+    assert response.status_code == 400
+
 
 ################
 # facilities() #
@@ -268,5 +674,22 @@ def test_facilities1(flask_client):
 
     response = flask_client.get("/api/facilities")
     json_data = response.get_json()
-    assert len(json_data) == 4
+    assert len(json_data) == 7
+
+
+def test_facilities_are_the_ones_validated_against(flask_client):
+    # the facilities of the counts don't change the list
+    db.session.execute("UPDATE bicycle_count SET bikepedfac = 'Sidepath'")
+    facilities = flask_client.get("/api/facilities").get_json()
+    assert all(not api.check_params({"bikepedfac": facility})[1] for facility in facilities)
+
+
+def test_counts_get_rejects_unknown_facility(flask_client):
+    response = flask_client.get("/api/counts?bikepedfac=Bike%20Path")
+    assert response.status_code == 400 and "Sharrow" in response.get_json()["error"]
+
 
+def test_facilities_returns_304_if_etag_matches(flask_client):
+    etag = flask_client.get("/api/facilities").headers["ETag"]
+    response = flask_client.get("/api/facilities", headers={"If-None-Match": etag})
+    assert response.status_code == 304
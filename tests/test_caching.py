@@ -0,0 +1,106 @@
+import time
+
+from sqlalchemy import text
+
+from bicycles import cache, caching, db
+
+
+class FakeRedis:
+    '''Local stand-in for a redis.Redis client, holding keys in a dict shared by its users.'''
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        value, expires = self.data.get(key, (None, None))
+        if expires is not None and expires < time.monotonic():
+            return None
+        return value
+
+    def set(self, key, value, ex=None):
+        self.data[key] = (value, time.monotonic() + ex if ex else None)
+
+
+# SimpleCache
+
+
+def test_simple_cache_get_returns_set_value():
+    backend = caching.SimpleCache()
+    backend.set("key", (b"[]", None))
+    assert backend.get("key") == (b"[]", None)
+
+
+def test_simple_cache_evicts_least_recently_used():
+    backend = caching.SimpleCache(max_entries=2)
+    backend.set("a", 1)
+    backend.set("b", 2)
+    backend.get("a")
+    backend.set("c", 3)
+    assert backend.get("a") == 1 and backend.get("b") is None and backend.get("c") == 3
+
+
+def test_simple_cache_expires_entries():
+    backend = caching.SimpleCache(default_timeout=0.01)
+    backend.set("a", 1)
+    time.sleep(0.02)
+    assert backend.get("a") is None
+
+
+def test_simple_cache_disabled_with_no_entries():
+    backend = caching.SimpleCache(max_entries=0)
+    backend.set("a", 1)
+    assert backend.get("a") is None
+
+
+# RedisCache
+
+
+def test_redis_cache_get_returns_set_value():
+    backend = caching.RedisCache(FakeRedis())
+    backend.set("key", (b"[]", "cursor"))
+    assert backend.get("key") == (b"[]", "cursor")
+
+
+# version
+
+
+def test_version_bumped_with_the_write(flask_client):
+    with flask_client.application.test_request_context():
+        cache.bump_version()
+        assert cache.get_version() == 1
+        db.session.rollback()
+        assert db.session.execute(caching.version_statement).fetchone()[0] == 0
+
+
+def test_cache_invalidated_by_writes_of_other_workers(flask_client):
+    flask_client.get("/api/counts")
+    # a delete by another worker process, whose cache this one doesn't share
+    with flask_client.application.app_context():
+        db.session.execute(text("DELETE FROM bicycle_count WHERE recordnum = 140313"))
+        db.session.execute(caching.bump_version_statement, {"updated": None})
+        db.session.commit()
+    assert len(flask_client.get("/api/counts").get_json()) == 9
+
+
+############
+# counts() #
+############
+
+
+def test_counts_get_served_from_cache(flask_client):
+    flask_client.get("/api/counts")
+    backend = flask_client.application.extensions["response_cache"]
+    assert backend.get("0:counts?") is not None
+
+
+def test_counts_get_cache_invalidated_by_delete(flask_client):
+    before = flask_client.get("/api/counts").get_json()
+    flask_client.delete("/api/counts/140313")
+    after = flask_client.get("/api/counts").get_json()
+    assert len(before) == 10 and len(after) == 9
+
+
+def test_counts_get_cache_keyed_on_params(flask_client):
+    all_counts = flask_client.get("/api/counts").get_json()
+    bike_lanes = flask_client.get("/api/counts?bikepedfac=Bike%20Lane").get_json()
+    assert len(all_counts) == 10 and len(bike_lanes) == 2
@@ -0,0 +1,170 @@
+from datetime import date
+
+from sqlalchemy import text
+
+from bicycles import commands, db
+
+###################
+# indexes command #
+###################
+
+
+def test_indexes_check_reports_missing_indexes(flask_client):
+    runner = flask_client.application.test_cli_runner()
+    result = runner.invoke(args=["indexes", "check"])
+    assert (result.exit_code == 1
+            and "ix_bicycle_count_bikepedfac: MISSING" in result.output
+            and "ix_bicycle_count_set_date: MISSING" not in result.output)
+
+
+def test_indexes_only_postgresql_uses_gist_index():
+    assert ("ix_bicycle_count_geom" in
+            [index["name"] for index in commands.applicable_indexes("postgresql")])
+    assert ("ix_bicycle_count_geom" not in
+            [index["name"] for index in commands.applicable_indexes("mysql")])
+
+
+#######################
+# load-counts command #
+#######################
+
+arcgis_header = ("\ufeffX,Y,OBJECTID,RECORDNUM,SETDATE,SETYEAR,COMMENTS,MCD,ROUTE,ROAD,CNTDIR,"
+                 "FROMLMT,TOLMT,TYPE,LATITUDE,LONGITUDE,FACTOR,AXLE,OUTDIR,INDIR,AADB,UPDATED,"
+                 "CO_NAME,MUN_NAME,GLOBALID,PROGRAM,BIKEPEDGRO,BIKEPEDFAC\n")
+
+arcgis_line = ("-75.19341217069173,39.952980414266634,47519,{recordnum},2018-03-29T00:00:00.000Z,"
+               "2018, ,4210160103,3,walnut st westbound lanes,west,36th st,34th st,Bicycle 2,"
+               "39.95297235,-75.19341039,0,0,E,W,{aadb},2018-04-10T02:36:13.000Z,{co_name},"
+               "Central,bc0fefb6-cae7-4541-b748-52197ec8d113,Project,Mixed,Buffered Bike Lane\n")
+
+
+def write_counts_csv(path, *lines):
+    path.write_text(arcgis_header + "".join(arcgis_line.format(**line) for line in lines),
+                    encoding="utf-8")
+    return str(path)
+
+
+def test_load_counts_loads_arcgis_export(flask_client, tmp_path):
+    path = write_counts_csv(tmp_path / "counts.csv",
+                            {"recordnum": 150001, "aadb": 455, "co_name": "Philadelphia"},
+                            {"recordnum": 150002, "aadb": 94, "co_name": "Philadelphia"})
+    runner = flask_client.application.test_cli_runner()
+    result = runner.invoke(args=["load-counts", path])
+    count = flask_client.get("/api/counts/150002").get_json()[0]
+    assert (result.exit_code == 0 and "Loaded 2 counts" in result.output
+            and len(flask_client.get("/api/counts").get_json()) == 12
+            and count["aadb"] == 94 and count["setyear"] == 2018 and count["route"] == 3)
+
+
+def test_load_counts_replaces_counts_with_same_recordnum(flask_client, tmp_path):
+    path = write_counts_csv(tmp_path / "counts.csv",
+                            {"recordnum": 140313, "aadb": 1, "co_name": "Philadelphia"},
+                            {"recordnum": 150001, "aadb": 2, "co_name": "Philadelphia"},
+                            {"recordnum": 150001, "aadb": 3, "co_name": "Philadelphia"})
+    runner = flask_client.application.test_cli_runner()
+    result = runner.invoke(args=["load-counts", path])
+    assert (result.exit_code == 0
+            and flask_client.get("/api/counts/140313").get_json()[0]["aadb"] == 1
+            and flask_client.get("/api/counts/150001").get_json()[0]["aadb"] == 3
+            and len(flask_client.get("/api/counts").get_json()) == 11)
+
+
+def test_load_counts_numbers_counts_with_empty_recordnum(flask_client, tmp_path):
+    path = write_counts_csv(tmp_path / "counts.csv",
+                            {"recordnum": "", "aadb": 1, "co_name": "Philadelphia"},
+                            {"recordnum": 150001, "aadb": 2, "co_name": "Philadelphia"},
+                            {"recordnum": "", "aadb": 3, "co_name": "Philadelphia"})
+    runner = flask_client.application.test_cli_runner()
+    result = runner.invoke(args=["load-counts", path])
+    counts = flask_client.get("/api/counts").get_json()
+    new = {count["aadb"]: count["recordnum"] for count in counts if count["aadb"] in (1, 3)}
+    assert (result.exit_code == 0 and "Loaded 3 counts" in result.output and len(counts) == 13
+            and flask_client.get("/api/counts/150001").get_json()[0]["aadb"] == 2
+            and len(new) == 2 and None not in new.values() and 150001 not in new.values())
+
+
+def test_load_counts_rejects_lines_with_errors(flask_client, tmp_path):
+    path = write_counts_csv(tmp_path / "counts.csv",
+                            {"recordnum": 150001, "aadb": 455, "co_name": "Philadelphia"},
+                            {"recordnum": 150002, "aadb": "many", "co_name": "Nowhere"})
+    rejects = tmp_path / "rejects.csv"
+    runner = flask_client.application.test_cli_runner()
+    result = runner.invoke(args=["load-counts", path, "--rejects", str(rejects)])
+    rejected = rejects.read_text().splitlines()
+    assert (result.exit_code == 0 and "Loaded 1 counts" in result.output
+            and "Rejected 1 lines" in result.output
+            and len(rejected) == 2 and rejected[1].startswith("3,")
+            and "aadb must be an integer" in rejected[1]
+            and "co_name must be one of" in rejected[1])
+
+
+def test_load_counts_unknown_column(flask_client, tmp_path):
+    path = tmp_path / "counts.csv"
+    path.write_text("RECORDNUM,SHAPE\n1,2\n")
+    runner = flask_client.application.test_cli_runner()
+    result = runner.invoke(args=["load-counts", str(path)])
+    assert result.exit_code == 1 and "Unknown column(s): shape" in result.output
+
+
+########################
+# load-weather command #
+########################
+
+weather_header = "STATION,NAME,DATE,PRCP,TAVG,TMAX,TMIN\n"
+
+weather_line = '{station},"PHILADELPHIA INTERNATIONAL AIRPORT, PA US",{date},{prcp},40,48,33\n'
+
+
+def write_weather_csv(path, *lines):
+    path.write_text(weather_header + "".join(weather_line.format(**line) for line in lines))
+    return str(path)
+
+
+def test_load_weather_inserts_then_skips_unchanged_rows(flask_client, tmp_path):
+    path = write_weather_csv(tmp_path / "weather.csv",
+                             {"station": "USW00013739", "date": "2018-03-12", "prcp": 0.25},
+                             {"station": "USW00013739", "date": "2018-03-13", "prcp": 0})
+    runner = flask_client.application.test_cli_runner()
+    first = runner.invoke(args=["load-weather", path])
+    second = runner.invoke(args=["load-weather", path])
+    assert (first.exit_code == 0 and "2 inserted or changed, 0 unchanged" in first.output
+            and second.exit_code == 0 and "0 inserted or changed, 2 unchanged" in second.output)
+
+
+def test_load_weather_updates_changed_rows(flask_client, tmp_path):
+    runner = flask_client.application.test_cli_runner()
+    runner.invoke(args=["load-weather", write_weather_csv(
+        tmp_path / "weather.csv",
+        {"station": "USW00013739", "date": "2018-03-12", "prcp": 0.25},
+        {"station": "USW00013739", "date": "2018-03-13", "prcp": 0})])
+    result = runner.invoke(args=["load-weather", write_weather_csv(
+        tmp_path / "weather.csv",
+        {"station": "USW00013739", "date": "2018-03-12", "prcp": 0.5},
+        {"station": "USW00013739", "date": "2018-03-13", "prcp": 0})])
+    prcp = db.session.execute(
+        text("SELECT prcp FROM weather WHERE date = :date"), {"date": date(2018, 3, 12)}).scalar()
+    assert (result.exit_code == 0 and "1 inserted or changed, 1 unchanged" in result.output
+            and prcp == 0.5)
+
+
+def test_load_weather_joins_counts_to_configured_station(flask_client, tmp_path):
+    db.session.execute(text("UPDATE bicycle_count SET set_date = :date WHERE recordnum = 140313"),
+                       {"date": date(2018, 3, 12)})
+    runner = flask_client.application.test_cli_runner()
+    runner.invoke(args=["load-weather", write_weather_csv(
+        tmp_path / "weather.csv",
+        {"station": "USW00013739", "date": "2018-03-12", "prcp": 0.25},
+        {"station": "USC00280907", "date": "2018-03-12", "prcp": 1.5})])
+    counts = flask_client.get("/api/counts").get_json()
+    assert (len(counts) == 10
+            and [c["prcp"] for c in counts if c["recordnum"] == 140313] == [0.25])
+
+
+def test_load_weather_rejects_lines_with_errors(flask_client, tmp_path):
+    path = write_weather_csv(tmp_path / "weather.csv",
+                             {"station": "USW00013739", "date": "2018-03-12", "prcp": 0.25},
+                             {"station": "USW00013739", "date": "2018-13-12", "prcp": "T"})
+    runner = flask_client.application.test_cli_runner()
+    result = runner.invoke(args=["load-weather", path])
+    assert (result.exit_code == 0 and "Loaded 1 rows" in result.output
+            and "line 3:" in result.output and "Rejected 1 lines" in result.output)
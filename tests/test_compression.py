@@ -0,0 +1,131 @@
+import gzip
+import json
+import zlib
+
+import pytest
+from flask import request
+
+from bicycles import compression
+
+
+def get(flask_client, url, encoding="gzip"):
+    return flask_client.get(url, headers={"Accept-Encoding": encoding})
+
+
+# negotiation #
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("gzip", "gzip"),
+    ("gzip;q=0.5, identity", "gzip"),
+    ("deflate", None),
+    ("gzip;q=0", None),
+    ("*", "gzip"),
+])
+def test_negotiate_gzip(flask_client, monkeypatch, header, expected):
+    monkeypatch.setattr(compression, "brotli", None)
+    with flask_client.application.test_request_context(headers={"Accept-Encoding": header}):
+        assert compression.negotiate(request.accept_encodings) == expected
+
+
+def test_negotiate_prefers_brotli_on_ties(flask_client):
+    pytest.importorskip("brotli")
+    with flask_client.application.test_request_context(headers={"Accept-Encoding": "gzip, br"}):
+        assert compression.negotiate(request.accept_encodings) == "br"
+
+
+# responses #
+
+
+def test_counts_compressed_with_gzip(flask_client):
+    response = get(flask_client, "/api/counts")
+    plain = flask_client.get("/api/counts")
+    assert (response.headers["Content-Encoding"] == "gzip"
+            and "Accept-Encoding" in response.headers["Vary"]
+            and gzip.decompress(response.data) == plain.data
+            and len(response.data) < len(plain.data))
+
+
+def test_counts_compressed_with_brotli(flask_client):
+    brotli = pytest.importorskip("brotli")
+    response = get(flask_client, "/api/counts", "br")
+    assert (response.headers["Content-Encoding"] == "br"
+            and brotli.decompress(response.data) == flask_client.get("/api/counts").data)
+
+
+def test_not_compressed_without_accept_encoding(flask_client):
+    response = flask_client.get("/api/counts")
+    assert "Content-Encoding" not in response.headers and response.get_json()
+
+
+def test_not_compressed_below_min_size(flask_client):
+    response = get(flask_client, "/api/counts/140313")
+    assert ("Content-Encoding" not in response.headers
+            and len(response.data) < flask_client.application.config["COMPRESSION_MIN_SIZE"])
+
+
+def test_not_compressed_if_disabled(flask_client):
+    flask_client.application.config["COMPRESSION"] = False
+    response = get(flask_client, "/api/counts")
+    assert "Content-Encoding" not in response.headers
+
+
+def test_errors_not_compressed(flask_client):
+    flask_client.application.config["COMPRESSION_MIN_SIZE"] = 0
+    response = get(flask_client, "/api/counts?bikepedfac=notvalid")
+    assert response.status_code == 400 and "Content-Encoding" not in response.headers
+
+
+def test_streamed_counts_compressed(flask_client):
+    flask_client.application.config["COMPRESSION_MIN_SIZE"] = 10 ** 9
+    response = get(flask_client, "/api/counts?stream=1")
+    lines = gzip.decompress(response.data).decode().splitlines()
+    assert (response.headers["Content-Encoding"] == "gzip"
+            and "Content-Length" not in response.headers
+            and [json.loads(line) for line in lines] == flask_client.get("/api/counts").get_json())
+
+
+@pytest.mark.parametrize("url", ["/api/counts", "/api/counts/140313", "/api/facilities",
+                                 "/api/counts/stats?group_by=co_name"])
+def test_not_modified_varies_on_accept_encoding(flask_client, url):
+    etag = get(flask_client, url).headers["ETag"]
+    response = flask_client.get(url, headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert response.status_code == 304 and "Accept-Encoding" in response.headers["Vary"]
+
+
+def test_compressor_flushes_every_chunk():
+    compressor = compression.Compressor("gzip", 6)
+    first = compressor.compress(b'{"recordnum":1}\n', flush=True)
+    decompressor = zlib.decompressobj(31)
+    # what is sent after the first chunk can be decoded without the rest of the body
+    assert decompressor.decompress(first) == b'{"recordnum":1}\n'
+
+
+# cached responses #
+
+
+def test_cached_counts_not_compressed_again(flask_client, monkeypatch):
+    calls = []
+    compress = compression.compress
+    monkeypatch.setattr(compression, "compress",
+                        lambda *args: calls.append(args) or compress(*args))
+    first = get(flask_client, "/api/counts")
+    second = get(flask_client, "/api/counts")
+    assert len(calls) == 1 and first.data == second.data
+
+
+def test_cached_compressed_counts_invalidated_by_writes(flask_client):
+    before = gzip.decompress(get(flask_client, "/api/counts").data)
+    flask_client.delete("/api/counts/140313")
+    after = gzip.decompress(get(flask_client, "/api/counts").data)
+    assert after != before and after == flask_client.get("/api/counts").data
+
+
+def test_cached_stats_compressed_per_encoding(flask_client):
+    pytest.importorskip("brotli")
+    flask_client.application.config["COMPRESSION_MIN_SIZE"] = 0
+    url = "/api/counts/stats?group_by=co_name,bikepedfac"
+    responses = [get(flask_client, url, encoding) for encoding in ("gzip", "br", "gzip", "br")]
+    assert ([response.headers["Content-Encoding"] for response in responses]
+            == ["gzip", "br", "gzip", "br"]
+            and responses[0].data == responses[2].data and responses[1].data == responses[3].data)
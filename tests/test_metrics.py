@@ -0,0 +1,97 @@
+import multiprocessing
+
+from bicycles import metrics
+
+
+def get_metrics(flask_client):
+    flask_client.application.config["METRICS_TOKEN"] = "secret"
+    return flask_client.get("/metrics", headers={"Authorization": "Bearer secret"})
+
+
+def write_sample(directory, amount):
+    metrics.FileStore(directory).inc(metrics.sample_key("requests", (("endpoint", "x"),)), amount)
+
+
+#########
+# store #
+#########
+
+
+def test_file_store_sums_worker_processes(tmp_path):
+    context = multiprocessing.get_context("fork")
+    for amount in (1, 2):
+        process = context.Process(target=write_sample, args=(str(tmp_path), amount))
+        process.start()
+        process.join()
+    assert metrics.FileStore(str(tmp_path)).items() == [('["requests", {"endpoint": "x"}]', 3.0)]
+
+
+def test_mmap_file_grows_and_reopens(tmp_path):
+    path = str(tmp_path / "metrics_1.db")
+    mmap_file = metrics.MmapFile(path)
+    for i in range(5000):
+        mmap_file.inc(f"key {i}", i)
+    mmap_file.inc("key 1", 1)
+    reopened = metrics.MmapFile(path)
+    reopened.inc("key 4999", 1)
+    with open(path, "rb") as f:
+        values = {key: value for key, value, _ in metrics.read_entries(f.read())}
+    assert len(values) == 5000 and values["key 1"] == 2 and values["key 4999"] == 5000
+
+
+##########
+# render #
+##########
+
+
+def test_render_histogram_buckets_are_cumulative():
+    store = metrics.MemoryStore()
+    labels = (("endpoint", "api.counts"), ("method", "GET"))
+    for rows in (0, 5, 10, 2000000):
+        metrics.observe(store, "bicycles_http_response_rows", labels, rows)
+    text = metrics.render(store.items())
+    series = '{endpoint="api.counts",method="GET"'
+    assert (f'bicycles_http_response_rows_bucket{series},le="0"}} 1' in text
+            and f'bicycles_http_response_rows_bucket{series},le="10"}} 3' in text
+            and f'bicycles_http_response_rows_bucket{series},le="+Inf"}} 4' in text
+            and f'bicycles_http_response_rows_count{series}}} 4' in text
+            and f'bicycles_http_response_rows_sum{series}}} 2000015' in text)
+
+
+############
+# /metrics #
+############
+
+
+def test_metrics_endpoint_reports_requests(flask_client):
+    flask_client.get("/api/counts").close()
+    flask_client.get("/api/counts/1").close()
+    response = get_metrics(flask_client)
+    text = response.get_data(as_text=True)
+    assert (response.mimetype == "text/plain"
+            and 'bicycles_http_requests_total{endpoint="api.counts",method="GET",status="200"} 1'
+            in text
+            and 'bicycles_http_requests_total{endpoint="api.count",method="GET",status="404"} 1'
+            in text
+            and 'bicycles_http_response_rows_bucket{endpoint="api.counts",method="GET",le="10"} 1'
+            in text)
+
+
+def test_metrics_count_streamed_rows_and_bytes(flask_client):
+    response = flask_client.get("/api/counts?stream=1")
+    size = len(response.get_data())
+    response.close()
+    text = get_metrics(flask_client).get_data(as_text=True)
+    series = '{endpoint="api.counts",method="GET"}'
+    assert (f"bicycles_http_response_rows_sum{series} 10" in text
+            and f"bicycles_http_response_size_bytes_sum{series} {size}" in text)
+
+
+def test_metrics_endpoint_not_found_without_token(flask_client):
+    assert flask_client.get("/metrics").status_code == 404
+
+
+def test_metrics_endpoint_needs_token(flask_client):
+    flask_client.application.config["METRICS_TOKEN"] = "secret"
+    response = flask_client.get("/metrics", headers={"Authorization": "Bearer wrong"})
+    assert response.status_code == 401
@@ -0,0 +1,55 @@
+import pytest
+
+from bicycles import create_app, pool
+from config import TestConfig
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = pool.Histogram((0.1, 1))
+    for value in (0.05, 0.1, 0.5, 2):
+        histogram.observe(value)
+    snapshot = histogram.snapshot()
+    assert (snapshot["buckets"] == {"0.1": 2, "1": 3, "+Inf": 4} and snapshot["count"] == 4
+            and snapshot["sum"] == 2.65)
+
+
+def test_pool_settings_become_engine_options():
+    class Config(TestConfig):
+        SQLALCHEMY_DATABASE_URI = "postgresql://user@localhost/bicycles"
+        DB_POOL_SIZE = 20
+        DB_POOL_PRE_PING = True
+        SQLALCHEMY_ENGINE_OPTIONS = {"pool_timeout": 5}
+
+    options = create_app(config_class=Config).config["SQLALCHEMY_ENGINE_OPTIONS"]
+    assert (options["pool_size"] == 20 and options["pool_pre_ping"] is True
+            and options["pool_timeout"] == 5 and "max_overflow" not in options
+            and issubclass(options["poolclass"], pool.TimedQueuePool))
+
+
+def test_pool_settings_leave_sqlite_pool_alone():
+    class Config(TestConfig):
+        SQLALCHEMY_DATABASE_URI = "sqlite://"
+        DB_POOL_SIZE = 20
+
+    options = create_app(config_class=Config).config["SQLALCHEMY_ENGINE_OPTIONS"]
+    assert options == {}
+
+
+def test_pool_endpoint_reports_pool(flask_client):
+    flask_client.application.config["ADMIN_TOKEN"] = "secret"
+    flask_client.get("/api/counts")
+    json_data = flask_client.get("/api/admin/pool",
+                                 headers={"Authorization": "Bearer secret"}).get_json()
+    assert "pid" in json_data["pool"] and "wait_seconds" in json_data and "checkouts" in json_data
+
+
+def test_pool_endpoint_not_found_without_admin_token(flask_client):
+    assert flask_client.get("/api/admin/pool").status_code == 404
+
+
+@pytest.mark.parametrize("headers", [{}, {"Authorization": "Bearer wrong"},
+                                     {"Authorization": "secret"}])
+def test_pool_endpoint_needs_admin_token(flask_client, headers):
+    flask_client.application.config["ADMIN_TOKEN"] = "secret"
+    response = flask_client.get("/api/admin/pool", headers=headers)
+    assert response.status_code == 401 and response.headers["WWW-Authenticate"] == "Bearer"
@@ -0,0 +1,112 @@
+import json
+
+import pytest
+from sqlalchemy import text
+
+from bicycles import db
+
+new_count = {
+    'x': -75.17147,
+    'y': 39.95372,
+    'objectid': 60001,
+    'setdate': '2019-09-30',
+    'mcd': 4210160103,
+    'road': 'arch st eastbound lanes',
+    'cntdir': 'east',
+    'fromlmt': '18th st',
+    'tolmt': '17th st',
+    'type': 'Bicycle 2',
+    'latitude': 39.95372,
+    'longitude': -75.17147,
+    'factor': 0,
+    'axle': 1.02,
+    'outdir': 'W',
+    'indir': 'E',
+    'aadb': 210,
+    'co_name': 'Philadelphia',
+    'mun_name': 'Central',
+    'bikepedgro': 'Mixed',
+    'bikepedfac': 'Bike Lane',
+}
+
+
+def invoke(flask_client, *args):
+    return flask_client.application.test_cli_runner().invoke(args=["rollups", *args])
+
+
+@pytest.fixture
+def rollup_client(flask_client):
+    '''
+    The flask client, with ROLLUPS set and the rollups of the counts the fixture inserted
+    directly.
+    '''
+    flask_client.application.config["ROLLUPS"] = True
+    invoke(flask_client, "rebuild")
+    return flask_client
+
+
+def test_writes_dont_need_rollups_by_default(flask_client):
+    db.session.execute(text("DROP TABLE count_rollup"))
+    responses = [flask_client.post("/api/counts", json=new_count),
+                 flask_client.put("/api/counts/140313", json={"co_name": "Camden"}),
+                 flask_client.delete("/api/counts/140302")]
+    stats = flask_client.get("/api/counts/stats?metrics=count").get_json()
+    assert [response.status_code for response in responses] == [201, 200, 200]
+    assert stats == [{"count": 10}]
+
+
+def test_rollups_check_reports_counts_written_directly(flask_client):
+    before = invoke(flask_client, "check")
+    rebuilt = invoke(flask_client, "rebuild")
+    after = invoke(flask_client, "check")
+    assert (before.exit_code == 1 and "groups differ" in before.output
+            and rebuilt.exit_code == 0 and after.exit_code == 0)
+
+
+def test_counts_stats_reads_rollups(flask_client):
+    # the counts the fixture inserted directly aren't in the rollups until they are rebuilt
+    flask_client.application.config["ROLLUPS"] = True
+    flask_client.post("/api/counts", json=new_count)
+    stats = flask_client.get("/api/counts/stats?metrics=count,sum_aadb").get_json()
+    assert stats == [{"count": 1, "sum_aadb": 210}]
+
+
+def test_counts_stats_reads_counts_without_rollups(flask_client):
+    flask_client.application.config["ROLLUPS"] = False
+    flask_client.post("/api/counts", json=new_count)
+    stats = flask_client.get("/api/counts/stats?metrics=count").get_json()
+    assert stats == [{"count": 11}] and invoke(flask_client, "check").exit_code == 1
+
+
+@pytest.mark.parametrize("method, url, body", [
+    ("post", "/api/counts", new_count),
+    ("post", "/api/counts/bulk", [new_count, dict(new_count, aadb=12, co_name="Mercer")]),
+    ("put", "/api/counts/140313", {"co_name": "Camden", "aadb": 5, "setdate": "2019-07-01"}),
+    ("put", "/api/counts/140313", {"road": "not in the rollups"}),
+    ("delete", "/api/counts/140313", None),
+    ("patch", "/api/counts", [{"recordnum": 140313, "fields": {"aadb": 7}},
+                              {"recordnum": 140302, "fields": {"bikepedfac": "Sharrow"}}]),
+])
+def test_writes_keep_rollups_up_to_date(rollup_client, method, url, body):
+    response = getattr(rollup_client, method)(url, json=body)
+    assert response.status_code < 300 and invoke(rollup_client, "check").exit_code == 0
+
+
+def test_load_counts_keeps_rollups_up_to_date(rollup_client, tmp_path):
+    header = "RECORDNUM,SETDATE,LATITUDE,LONGITUDE,AADB,CO_NAME,BIKEPEDFAC\n"
+    lines = ["140313,2019-04-01T00:00:00.000Z,39.95,-75.19,1,Chester,Sharrow\n",
+             "150001,2019-04-02T00:00:00.000Z,39.95,-75.19,2,Chester,Sharrow\n",
+             "150001,2019-05-02T00:00:00.000Z,39.95,-75.19,3,Chester,Bike Lane\n"]
+    path = tmp_path / "counts.csv"
+    path.write_text(header + "".join(lines))
+    result = rollup_client.application.test_cli_runner().invoke(args=["load-counts", str(path)])
+    assert result.exit_code == 0 and invoke(rollup_client, "check").exit_code == 0
+
+
+def test_counts_stats_from_rollups_match_counts(rollup_client):
+    query = "/api/counts/stats?group_by=co_name,bikepedfac,setyear&metrics=count,sum_aadb,avg_aadb"
+    from_rollups = rollup_client.get(query).get_json()
+    rollup_client.application.config["ROLLUPS"] = False
+    # a different order of metrics, so that the response isn't the cached one
+    from_counts = rollup_client.get(query.replace("count,sum_aadb", "sum_aadb,count")).get_json()
+    assert json.dumps(from_rollups, sort_keys=True) == json.dumps(from_counts, sort_keys=True)
@@ -0,0 +1,62 @@
+import datetime
+import decimal
+import json
+
+import pytest
+
+from bicycles import serializers
+
+
+class Row(tuple):
+    '''Stand-in for a result row, which iterates over its values in column order.'''
+
+
+def test_row_encodes_values_by_column_type():
+    serializer = serializers.RowSerializer(["recordnum", "x", "setdate", "road", "prcp"])
+    row = Row((140313, decimal.Decimal("-75.172272"), datetime.datetime(2018, 3, 12, 20),
+               "j f kennedy blvd", 0.25))
+    assert json.loads(serializer.row(row)) == {
+        "recordnum": 140313,
+        "x": -75.172272,
+        "setdate": "2018-03-12T20:00:00",
+        "road": "j f kennedy blvd",
+        "prcp": 0.25,
+    }
+
+
+def test_row_encodes_none_as_null():
+    serializer = serializers.RowSerializer(["aadb", "setdate", "comments"])
+    assert serializer.row(Row((None, None, None))) == '{"aadb":null,"setdate":null,"comments":null}'
+
+
+def test_row_escapes_strings():
+    serializer = serializers.RowSerializer(["comments"])
+    comments = 'said "hi"\n café'
+    assert json.loads(serializer.row(Row((comments,)))) == {"comments": comments}
+
+
+@pytest.mark.parametrize("key, value, expected",
+                         [("route", "3", "3"),
+                          ("setdate", "2018-03-12 20:00:00", "2018-03-12 20:00:00"),
+                          ("not_a_column", decimal.Decimal("1.5"), 1.5),
+                          ("x", float("nan"), None),
+                         ])
+def test_row_falls_back_for_unexpected_types(key, value, expected):
+    serializer = serializers.RowSerializer([key])
+    result = json.loads(serializer.row(Row((value,))))[key]
+    assert result == expected or (expected is None and result != result)
+
+
+def test_rows_matches_dict_encoding():
+    keys = ["recordnum", "latitude", "updated", "co_name"]
+    rows = [Row((1, decimal.Decimal("39.954592"), datetime.datetime(2018, 6, 28), "Philadelphia")),
+            Row((2, None, None, "Camden"))]
+    expected = [{"recordnum": 1, "latitude": 39.954592, "updated": "2018-06-28T00:00:00",
+                 "co_name": "Philadelphia"},
+                {"recordnum": 2, "latitude": None, "updated": None, "co_name": "Camden"}]
+    assert json.loads(serializers.RowSerializer(keys).rows(rows)) == expected
+
+
+def test_serializer_for_is_cached_per_keys():
+    assert (serializers.serializer_for(["recordnum", "aadb"])
+            is serializers.serializer_for(("recordnum", "aadb")))
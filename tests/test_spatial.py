@@ -0,0 +1,189 @@
+import math
+import random
+import threading
+import time
+
+import pytest
+
+from bicycles import create_app, db, models, spatial, spatial_index
+from config import TestConfig
+
+#############
+# GridIndex #
+#############
+
+
+def brute_force_nearest(index, points, lat, lon, k, radius=None):
+    x, y = index._project(lat, lon)
+    distances = []
+    for recordnum, point_lat, point_lon in points:
+        px, py = index._project(point_lat, point_lon)
+        distance = math.hypot(px - x, py - y)
+        if radius is None or distance <= radius:
+            distances.append((distance, recordnum))
+    return [recordnum for _, recordnum in sorted(distances)[:k]]
+
+
+@pytest.fixture
+def points():
+    rng = random.Random(0)
+    return [(n, rng.uniform(39.7, 40.6), rng.uniform(-75.9, -74.4)) for n in range(2000)]
+
+
+@pytest.mark.parametrize("k, radius", [(1, None), (5, None), (20, None), (5, 1000), (50, 2500)])
+def test_nearest_matches_brute_force(points, k, radius):
+    index = spatial.GridIndex.from_points(points)
+    rng = random.Random(1)
+    for _ in range(20):
+        lat, lon = rng.uniform(39.6, 40.7), rng.uniform(-76, -74.3)
+        nearest = [recordnum for recordnum, _ in index.nearest(lat, lon, k, radius)]
+        assert nearest == brute_force_nearest(index, points, lat, lon, k, radius)
+
+
+def test_nearest_returns_distances_in_metres():
+    index = spatial.GridIndex.from_points([(1, 40.0, -75.0), (2, 40.01, -75.0)])
+    (first, first_distance), (second, second_distance) = index.nearest(40.0, -75.0, 2)
+    assert first == 1 and first_distance == 0 and 1110 < second_distance < 1113
+
+
+@pytest.mark.parametrize("lat, lon", [(0, 0), (-80, 100), (1000, 0), (40.0, -80.0)])
+def test_nearest_outside_index_matches_brute_force(points, lat, lon):
+    index = spatial.GridIndex.from_points(points, cell_size=50)
+    nearest = [recordnum for recordnum, _ in index.nearest(lat, lon, 3)]
+    assert nearest == brute_force_nearest(index, points, lat, lon, 3)
+
+
+def test_writes_replace_buckets_queries_may_be_scanning():
+    index = spatial.GridIndex.from_points([(1, 40.0, -75.0), (2, 40.0, -75.00001)])
+    cell = index._points[1]
+    bucket = index._cells[cell]
+    index.insert(3, 40.0, -75.0)
+    index.remove(1)
+    assert sorted(bucket) == [1, 2] and sorted(index._cells[cell]) == [2, 3]
+
+
+def test_nearest_empty_index():
+    assert spatial.GridIndex.from_points([]).nearest(40, -75) == []
+
+
+def test_insert_moves_existing_point():
+    index = spatial.GridIndex.from_points([(1, 40.0, -75.0), (2, 40.5, -75.5)])
+    index.insert(1, 40.5, -75.5001)
+    assert index.nearest(40.0, -75.0, 1)[0][0] == 2 and len(index) == 2
+
+
+def test_remove_point():
+    index = spatial.GridIndex.from_points([(1, 40.0, -75.0), (2, 40.5, -75.5)])
+    index.remove(1)
+    assert [recordnum for recordnum, _ in index.nearest(40.0, -75.0, 5)] == [2]
+
+
+################
+# SpatialIndex #
+################
+
+
+def test_index_built_when_app_is_created(tmp_path):
+    class Config(TestConfig):
+        SQLALCHEMY_DATABASE_URI = "sqlite:///" + str(tmp_path / "counts.db")
+        SPATIAL_INDEX = True
+
+    with create_app(config_class=type("Setup", (Config,), {"SPATIAL_INDEX_PRELOAD": False})) \
+            .app_context():
+        db.create_all()
+        db.session.add(models.BicycleCount(recordnum=1, latitude=39.95, longitude=-75.17))
+        db.session.commit()
+        db.session.remove()
+
+    app = create_app(config_class=Config)
+    state = app.extensions["spatial_index"]
+    state["thread"].join()
+    assert len(state["index"]) == 1
+
+
+def test_index_rebuilt_in_background_while_old_one_is_used(flask_client, monkeypatch):
+    app = flask_client.application
+    app.config["SPATIAL_INDEX"] = True
+    old = spatial_index.get(db.session)
+    state = app.extensions["spatial_index"]
+    state["built"] = time.monotonic() - app.config["SPATIAL_INDEX_MAX_AGE"] - 1
+
+    # hold the rebuild, once it has read the counts, until a count has been written
+    started, release = threading.Event(), threading.Event()
+    from_points = spatial.GridIndex.from_points
+
+    def held_from_points(*args):
+        started.set()
+        release.wait(5)
+        return from_points(*args)
+
+    monkeypatch.setattr(spatial.GridIndex, "from_points", held_from_points)
+    during = spatial_index.get(db.session)
+    assert started.wait(5)
+    spatial_index.insert(1, 10.0, 10.0)
+    release.set()
+    state["thread"].join()
+
+    new = spatial_index.get(db.session)
+    assert during is old and new is not old and new.nearest(10.0, 10.0, k=1)[0][0] == 1
+
+
+#############
+# closest() #
+#############
+
+
+def test_closest_from_index_returns_k_nearest_with_distance(flask_client):
+    flask_client.application.config["SPATIAL_INDEX"] = True
+    response = flask_client.get("/api/counts/closest?lat=39.9546&lon=-75.17227&k=3")
+    json_data = response.get_json()
+    assert (response.status_code == 200 and len(json_data) == 3
+            and json_data[0]["recordnum"] == 140313 and json_data[0]["distance"] < 1
+            and json_data[0]["distance"] <= json_data[1]["distance"] <= json_data[2]["distance"])
+
+
+def test_closest_from_index_within_radius(flask_client):
+    flask_client.application.config["SPATIAL_INDEX"] = True
+    response = flask_client.get("/api/counts/closest?lat=39.9546&lon=-75.17227&radius=1000")
+    json_data = response.get_json()
+    assert (response.status_code == 200
+            and all(count["distance"] <= 1000 for count in json_data)
+            and {count["recordnum"] for count in json_data} == {140313, 140302, 142000})
+
+
+def test_closest_from_index_updated_by_delete(flask_client):
+    flask_client.application.config["SPATIAL_INDEX"] = True
+    flask_client.get("/api/counts/closest?lat=39.9546&lon=-75.17227&k=1")
+    flask_client.delete("/api/counts/140313")
+    response = flask_client.get("/api/counts/closest?lat=39.9546&lon=-75.17227&k=1")
+    assert response.get_json()[0]["recordnum"] != 140313
+
+
+def test_closest_from_index_updated_by_patch(flask_client):
+    flask_client.application.config["SPATIAL_INDEX"] = True
+    flask_client.get("/api/counts/closest?lat=40.2&lon=-75.3&k=1")
+    flask_client.patch("/api/counts", json=[{"recordnum": 137287,
+                                             "fields": {"latitude": 40.2, "longitude": -75.3}}])
+    response = flask_client.get("/api/counts/closest?lat=40.2&lon=-75.3&k=1")
+    assert response.get_json()[0]["recordnum"] == 137287
+
+
+def test_closest_from_index_updated_by_put(flask_client):
+    flask_client.application.config["SPATIAL_INDEX"] = True
+    flask_client.get("/api/counts/closest?lat=40.2&lon=-75.3&k=1")
+    flask_client.put("/api/counts/137287", json={"latitude": 40.2, "longitude": -75.3})
+    response = flask_client.get("/api/counts/closest?lat=40.2&lon=-75.3&k=1")
+    assert response.get_json()[0]["recordnum"] == 137287
+
+
+@pytest.mark.parametrize("query", ["k=0", "k=101", "k=notvalid", "radius=0", "radius=notvalid"])
+def test_closest_bad_params(flask_client, query):
+    response = flask_client.get("/api/counts/closest?lat=39.9546&lon=-75.17227&" + query)
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("query", ["lat=90.5&lon=-75", "lat=-1000&lon=-75", "lat=40&lon=180.1",
+                                   "lat=40&lon=-200"])
+def test_closest_rejects_coordinates_out_of_range(flask_client, query):
+    response = flask_client.get("/api/counts/closest?" + query)
+    assert response.status_code == 400
@@ -0,0 +1,28 @@
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+
+from bicycles import api, caching, statements
+
+
+def test_prepared_statement_numbers_parameters_in_order_of_use():
+    statement = statements.PreparedStatement(
+        text("SELECT :b, :a WHERE x = :b AND y LIKE 'x%'"), postgresql.dialect())
+    assert (statement.prepare.endswith("AS SELECT $1, $2 WHERE x = $1 AND y LIKE 'x%'")
+            and statement.execute.text == f"EXECUTE {statement.name}(:b, :a)")
+
+
+def test_prepared_statement_without_parameters():
+    statement = statements.PreparedStatement(caching.version_statement, postgresql.dialect())
+    assert statement.execute.text == f"EXECUTE {statement.name}"
+
+
+def test_prepared_statement_names_differ_by_sql():
+    names = {statements.PreparedStatement(api.closest_statement(k, radius),
+                                        postgresql.dialect()).name
+             for k in (1, 5) for radius in (False, True)}
+    assert len(names) == 4
+
+
+def test_counts_uses_statement_per_filters(flask_client):
+    response = flask_client.get("/api/counts?prcp=0")
+    assert response.status_code == 404
@@ -0,0 +1,40 @@
+import json
+import logging
+
+from bicycles import request_timing
+
+
+def enable(flask_client, **config):
+    app = flask_client.application
+    app.config.update(config)
+    request_timing.init_app(app)
+
+
+def test_no_server_timing_by_default(flask_client):
+    response = flask_client.get("/api/counts")
+    assert "Server-Timing" not in response.headers
+
+
+def test_server_timing_header_has_phases(flask_client):
+    enable(flask_client, SERVER_TIMING=True)
+    response = flask_client.get("/api/counts")
+    phases = [entry.split(";")[0] for entry in response.headers["Server-Timing"].split(", ")]
+    assert phases == ["db", "fetch", "serialize", "total"]
+
+
+def test_slow_query_log_has_statements(flask_client, caplog):
+    enable(flask_client, SLOW_QUERY_SECONDS=0)
+    with caplog.at_level(logging.WARNING, logger="bicycles.slow_queries"):
+        flask_client.get("/api/counts?bikepedfac=Sharrow").close()
+    entry = json.loads(caplog.records[-1].getMessage())
+    statement = entry["statements"][-1]
+    assert (entry["path"] == "/api/counts?bikepedfac=Sharrow" and entry["status"] == 200
+            and "write" in entry["phases_ms"] and "Sharrow" in statement["params"]
+            and "bikepedfac" in statement["sql"])
+
+
+def test_slow_query_log_skips_fast_requests(flask_client, caplog):
+    enable(flask_client, SLOW_QUERY_SECONDS=60)
+    with caplog.at_level(logging.WARNING, logger="bicycles.slow_queries"):
+        flask_client.get("/api/counts").close()
+    assert not caplog.records
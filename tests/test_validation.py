@@ -0,0 +1,39 @@
+import datetime
+
+import pytest
+
+from bicycles import api, validation
+
+
+def test_check_many_matches_check_of_each_record():
+    records = [{'aadb': 12, 'cntdir': 'east'},
+               {'aadb': 'many', 'cntdir': 'up', 'not_a_param': 1},
+               {'axle': [1], 'setdate': '2018-02-30'}]
+    results = api.count_validator.check_many(records)
+    assert results == [(api.check_required_fields(record), *api.check_params(record))
+                       for record in records]
+
+
+def test_check_new_counts_reports_errors_per_record():
+    errors = api.check_new_counts([{}, "count", {'aadb': 'many'}])
+    assert (errors[0] == ["No parameters submitted."]
+            and errors[1] == ["Count must be a JSON object."]
+            and errors[2][0].startswith("Missing required parameters")
+            and errors[2][1] == "Error(s) in submitted parameters: aadb must be an integer")
+
+
+def test_check_params_unhashable_value():
+    unknown_params, bad_params = api.check_params({'co_name': ['Bucks']})
+    assert bad_params == ["co_name must be one of " + ", ".join(validation.COUNTIES)]
+
+
+@pytest.mark.parametrize("value", ["2018-03-12", "2018-3-5"])
+def test_parse_setdate_good(value):
+    assert validation.parse_setdate(value).date() in (datetime.date(2018, 3, 12),
+                                                      datetime.date(2018, 3, 5))
+
+
+@pytest.mark.parametrize("value", ["2018-02-30", "20180312", "2018-03-12T10:00", "2018-W10-1"])
+def test_parse_setdate_bad(value):
+    with pytest.raises(ValueError):
+        validation.parse_setdate(value)